@@ -0,0 +1,162 @@
+"""
+NAP 文件传输吞吐量基准测试
+
+在子进程中运行参考接收端（utils/file_receive_server.py），对比以下发送方式的吞吐量与事件循环阻塞：
+    旧实现：事件循环中同步 open/read(4096)，每 4KB drain 一次
+    send_file（sendfile）：loop.sendfile 零拷贝发送
+    send_file（回退路径）：线程池中按 1MB 读取后写入
+    NapFileClient（framed）：复用长连接并流水线发送
+
+用法:
+    python benchmarks/bench_nap_transfer.py --size-mb 8 --files 32 --parallel 4
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import struct
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from astrbot.api import logger  # noqa: E402
+from utils.file_receive_server import FileReceiveServer  # noqa: E402
+from utils.file_send_server import recv_all, send_file, write_file_body  # noqa: E402
+from utils.nap_client import NapFileClient  # noqa: E402
+
+
+def run_receiver(save_dir, port_queue):
+    """子进程入口：运行参考接收端直到被终止"""
+    async def serve():
+        server = FileReceiveServer(save_dir, "127.0.0.1", 0)
+        port_queue.put(await server.start())
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def _send_legacy_protocol(path, host, port, write_body):
+    """按旧协议发送一个文件，文件内容由 write_body(writer, path, size) 写出"""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        name = os.path.basename(path).encode("utf-8")
+        size = os.path.getsize(path)
+        writer.write(struct.pack(">I", len(name)) + name + struct.pack(">Q", size))
+        await writer.drain()
+        await write_body(writer, path, size)
+        length = struct.unpack(">I", await recv_all(reader, 4))[0]
+        return (await recv_all(reader, length)).decode("utf-8")
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def legacy_body(writer, path, size):
+    """旧实现：在事件循环中同步读取，每 4KB drain 一次"""
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(4096)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+
+
+async def fallback_body(writer, path, size):
+    """新实现的回退路径（不使用 sendfile）"""
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        await write_file_body(writer, f, size, zero_copy=False)
+    finally:
+        f.close()
+
+
+class LoopLagMonitor:
+    """测量事件循环的最大调度延迟"""
+
+    def __init__(self, tick=0.001):
+        self.tick = tick
+        self.max_lag = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.tick)
+            self.max_lag = max(self.max_lag, time.perf_counter() - start - self.tick)
+
+    def __enter__(self):
+        self.max_lag = 0.0
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+
+async def measure(label, files, send, parallel):
+    """以 parallel 个并发发送所有文件，输出吞吐量与最大事件循环阻塞"""
+    semaphore = asyncio.Semaphore(parallel)
+    total = sum(os.path.getsize(path) for path in files)
+
+    async def one(path):
+        async with semaphore:
+            if not await send(path):
+                raise RuntimeError(f"发送失败: {path}")
+
+    with LoopLagMonitor() as monitor:
+        await asyncio.sleep(0)
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        await asyncio.gather(*(one(path) for path in files))
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+    print(f"{label:<28} {total / elapsed / 1024 / 1024:>9.1f} MB/s  CPU {cpu:>6.2f}s  "
+          f"最大事件循环阻塞 {monitor.max_lag * 1000:>7.2f} ms")
+
+
+async def main(args, port):
+    host = "127.0.0.1"
+    with tempfile.TemporaryDirectory() as tmp:
+        files = []
+        for i in range(args.files):
+            path = Path(tmp) / f"gemini_image_bench_{i}.png"
+            with open(path, "wb") as f:
+                f.write(os.urandom(int(args.size_mb * 1024 * 1024)))
+            files.append(str(path))
+        print(f"{args.files} 个文件 x {args.size_mb:g} MB，并发 {args.parallel}")
+
+        await measure("旧实现（4KB 同步读取）", files,
+                      lambda path: _send_legacy_protocol(path, host, port, legacy_body), args.parallel)
+        await measure("send_file（回退路径）", files,
+                      lambda path: _send_legacy_protocol(path, host, port, fallback_body), args.parallel)
+        await measure("send_file（sendfile）", files, lambda path: send_file(path, host, port), args.parallel)
+        client = NapFileClient(host, port, protocol="framed", max_connections=args.connections)
+        await measure("NapFileClient（framed）", files, client.send_file, args.parallel)
+        await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NAP 文件传输吞吐量基准测试")
+    parser.add_argument("--size-mb", type=float, default=8, help="单个文件大小（MB）")
+    parser.add_argument("--files", type=int, default=32, help="文件数量")
+    parser.add_argument("--parallel", type=int, default=4, help="同时发送的文件数")
+    parser.add_argument("--connections", type=int, default=2, help="NapFileClient 的最大连接数")
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    # 接收端优先写入内存文件系统，避免磁盘成为瓶颈
+    shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    with tempfile.TemporaryDirectory(dir=shm) as save_dir:
+        port_queue = multiprocessing.Queue()
+        receiver = multiprocessing.Process(target=run_receiver, args=(save_dir, port_queue), daemon=True)
+        receiver.start()
+        try:
+            asyncio.run(main(args, port_queue.get(timeout=10)))
+        finally:
+            receiver.terminate()
+            receiver.join()
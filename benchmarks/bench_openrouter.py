@@ -0,0 +1,248 @@
+"""
+OpenRouter 图像生成离线端到端基准测试
+
+在子进程中运行 benchmarks/mock_upstream.py 模拟的 /v1/chat/completions，按配置的延迟分布、
+429/402 比例、内容过滤、纯文本回复与图像大小返回响应，然后以不同并发数驱动 generate_image_openrouter，
+报告吞吐量、p50/p95/p99 延迟与峰值 RSS。不需要真实的 API 密钥，也不消耗额度。
+模拟上游运行在独立进程中，RSS 与 CPU 只包含插件一侧的开销。
+
+用法:
+    python benchmarks/bench_openrouter.py --concurrency 1,4,16,64,256 --requests 256 --image-mb 1,4
+    python benchmarks/bench_openrouter.py --latency lognormal:2,0.5 --rate-limit 0.05 --text-only 0.05
+"""
+import argparse
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+import aiohttp
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from astrbot.api import logger  # noqa: E402
+from mock_upstream import CONTENT_FILTER, ERROR, IMAGE, TEXT, MockReply, MockUpstream  # noqa: E402
+from utils.endpoint_router import EndpointRouter  # noqa: E402
+from utils.hedging import HedgePolicy  # noqa: E402
+from utils.key_pool import ApiKeyPool  # noqa: E402
+from utils.retry_policy import RetryPolicy  # noqa: E402
+from utils.ttp import generate_image_openrouter  # noqa: E402
+
+
+def parse_latency(spec):
+    """
+    解析延迟分布
+
+    支持 fixed:秒、uniform:最小,最大、lognormal:中位数,sigma、exponential:平均值
+
+    Returns:
+        callable: 无参数、返回一个延迟样本（秒）的函数
+    """
+    name, _, params = spec.partition(":")
+    values = [float(value) for value in params.split(",") if value]
+    if name == "fixed":
+        return lambda: values[0]
+    if name == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if name == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    if name == "exponential":
+        return lambda: random.expovariate(1 / values[0])
+    raise ValueError(f"未知的延迟分布: {spec}")
+
+
+class ProfileResponder:
+    """按比例随机返回限流、额度不足、内容过滤、纯文本或图像"""
+
+    def __init__(self, args):
+        self.latency = parse_latency(args.latency)
+        self.image_sizes = [int(float(size) * 1024 * 1024) for size in args.image_mb.split(",")]
+        self.bandwidth = args.bandwidth_mbps * 1024 * 1024 / 8 if args.bandwidth_mbps else 0
+        self.rate_limit = args.rate_limit
+        self.payment = args.payment_required
+        self.content_filter = args.content_filter
+        self.text_only = args.text_only
+        self.retry_after = args.retry_after
+
+    def __call__(self, request, body):
+        roll = random.random()
+        delay = self.latency()
+        if roll < self.rate_limit:
+            return MockReply(ERROR, status=429, delay=min(delay, 0.2), retry_after=self.retry_after)
+        roll -= self.rate_limit
+        if roll < self.payment:
+            return MockReply(ERROR, status=402, delay=min(delay, 0.2))
+        roll -= self.payment
+        if roll < self.content_filter:
+            return MockReply(CONTENT_FILTER, delay=delay)
+        roll -= self.content_filter
+        if roll < self.text_only:
+            return MockReply(TEXT, delay=delay)
+        size = random.choice(self.image_sizes)
+        transfer = size * 4 / 3 / self.bandwidth if self.bandwidth else 0.0
+        return MockReply(IMAGE, delay=delay, transfer=transfer, image_bytes=size)
+
+
+def run_mock_server(args, port_queue, seed):
+    """子进程入口：运行模拟上游直到被终止"""
+    random.seed(seed)
+
+    async def serve():
+        upstream = MockUpstream(ProfileResponder(args))
+        await upstream.start()
+        port_queue.put(upstream.port)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+class RssSampler:
+    """定期采样当前进程的 RSS，记录峰值（优先读取 /proc，不可用时使用 ru_maxrss）"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def current(self):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self._page_size
+        except OSError:
+            # ru_maxrss 在 Linux 上以 KB 为单位、在 macOS 上以字节为单位，且只会增长
+            import resource
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, self.current())
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.peak = self.current()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self.peak = max(self.peak, self.current())
+        return self.peak
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))] if values else float("nan")
+
+
+async def run_level(args, base_url, session, concurrency):
+    """以固定并发数发送 args.requests 个请求"""
+    key_pool = ApiKeyPool([f"sk-bench-{i + 1}" for i in range(args.keys)])
+    router = EndpointRouter([f"{base_url}/endpoint{i + 1}" for i in range(args.endpoints)])
+    retry_policy = RetryPolicy(max_retries=args.max_retries, base_delay=args.retry_base_delay)
+    hedge = HedgePolicy(delay_seconds=args.hedge_delay) if args.hedge_delay > 0 else None
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    outcomes = Counter()
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                result = await generate_image_openrouter(
+                    "benchmark", key_pool, session=session, hedge=hedge, endpoints=router, retry_policy=retry_policy,
+                )
+                outcome = "success" if result else "failure"
+                if result:
+                    os.remove(result.image_path)
+            except ValueError:
+                outcome = "blocked"
+            latencies.append(time.perf_counter() - start)
+            outcomes[outcome] += 1
+
+    sampler = RssSampler()
+    sampler.start()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(args.requests)))
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    peak_rss = await sampler.stop()
+    latencies.sort()
+    attempts = sum(key["requests_total"] for key in key_pool.snapshot())
+    return {
+        "concurrency": concurrency,
+        "wall": wall,
+        "throughput": outcomes["success"] / wall,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "attempts": attempts,
+        "cpu": cpu,
+        "peak_rss": peak_rss,
+        "outcomes": outcomes,
+    }
+
+
+async def bench(args, base_url):
+    levels = [int(value) for value in args.concurrency.split(",")]
+    print(f"延迟 {args.latency}，图像 {args.image_mb} MB，429 {args.rate_limit:.0%}，402 {args.payment_required:.0%}，"
+          f"内容过滤 {args.content_filter:.0%}，纯文本 {args.text_only:.0%}，"
+          f"{args.keys} 个密钥，{args.endpoints} 个端点，每档 {args.requests} 个请求")
+    print(f"{'并发':>6} {'吞吐(张/s)':>10} {'p50':>8} {'p95':>8} {'p99':>8} {'尝试':>6} {'CPU(s)':>7} "
+          f"{'峰值RSS':>9}  结果")
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        for concurrency in levels:
+            row = await run_level(args, base_url, session, concurrency)
+            outcomes = ", ".join(f"{name} {count}" for name, count in sorted(row["outcomes"].items()))
+            print(f"{row['concurrency']:>6} {row['throughput']:>10.2f} {row['p50']:>7.2f}s {row['p95']:>7.2f}s "
+                  f"{row['p99']:>7.2f}s {row['attempts']:>6} {row['cpu']:>7.2f} "
+                  f"{row['peak_rss'] / 1024 / 1024:>7.1f}MB  {outcomes}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="使用本地模拟上游的 OpenRouter 图像生成基准测试")
+    parser.add_argument("--concurrency", default="1,4,16,64,256", help="逗号分隔的并发数")
+    parser.add_argument("--requests", type=int, default=256, help="每个并发档位的请求数")
+    parser.add_argument("--latency", default="lognormal:1,0.5",
+                        help="首字节延迟分布：fixed:秒 / uniform:最小,最大 / lognormal:中位数,sigma / exponential:平均值")
+    parser.add_argument("--image-mb", default="1,4", help="逗号分隔的图像大小（MB，解码后），随机选择")
+    parser.add_argument("--bandwidth-mbps", type=float, default=0, help="模拟的下行带宽（Mbit/s），0 表示不限制")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="返回 429 的比例")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="429 响应的 Retry-After（秒）")
+    parser.add_argument("--payment-required", type=float, default=0.0,
+                        help="返回 402 的比例（密钥会按额度不足冷却一小时）")
+    parser.add_argument("--content-filter", type=float, default=0.0, help="以内容过滤结束的比例")
+    parser.add_argument("--text-only", type=float, default=0.0, help="只返回文本的比例")
+    parser.add_argument("--keys", type=int, default=8, help="模拟的API密钥数量")
+    parser.add_argument("--endpoints", type=int, default=1, help="模拟的端点数量（同一个服务的不同路径）")
+    parser.add_argument("--max-retries", type=int, default=3, help="重试次数上限")
+    parser.add_argument("--retry-base-delay", type=float, default=0.2, help="重试退避基准时间（秒）")
+    parser.add_argument("--hedge-delay", type=float, default=0, help="对冲请求的等待时间（秒），0 表示不对冲")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子")
+    parser.add_argument("--log-level", default="CRITICAL", help="插件日志级别，默认不输出以免影响测量")
+    args = parser.parse_args()
+
+    logger.setLevel(getattr(logging, args.log_level.upper()))
+
+    random.seed(args.seed)
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=run_mock_server, args=(args, port_queue, args.seed), daemon=True)
+    server.start()
+    try:
+        port = port_queue.get(timeout=10)
+        asyncio.run(bench(args, f"http://127.0.0.1:{port}"))
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == "__main__":
+    main()
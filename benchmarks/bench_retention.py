@@ -0,0 +1,125 @@
+"""
+images 目录清理基准测试
+
+对比旧的「每次保存都 glob + stat 整个目录」清理方式与后台过期堆清理器，
+在包含大量文件的目录上的耗时以及对事件循环的阻塞。
+
+用法:
+    python benchmarks/bench_retention.py --files 50000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from utils.retention import ImageRetentionSweeper  # noqa: E402
+
+
+def populate(images_dir, count, expired_ratio):
+    """创建测试文件，其中 expired_ratio 比例的文件修改时间设为一小时前"""
+    images_dir.mkdir(parents=True, exist_ok=True)
+    old = time.time() - 3600
+    expired = int(count * expired_ratio)
+    for i in range(count):
+        prefix = "gemini_image" if i % 2 else "siliconflow_image"
+        ext = "png" if i % 2 else "jpeg"
+        path = images_dir / f"{prefix}_20250101_000000_{i:08x}.{ext}"
+        with open(path, "wb") as f:
+            f.write(b"\0" * 64)
+        if i < expired:
+            os.utime(path, (old, old))
+
+
+def count_expired(images_dir, prefix, ttl_seconds=15 * 60):
+    """统计目录中仍然存在的过期文件数量"""
+    cutoff = time.time() - ttl_seconds
+    with os.scandir(images_dir) as it:
+        return sum(1 for item in it if item.name.startswith(prefix) and item.stat().st_mtime < cutoff)
+
+
+async def legacy_cleanup(images_dir):
+    """旧实现：在事件循环中同步 glob 三种模式并 stat 每个文件"""
+    cutoff_time = datetime.now() - timedelta(minutes=15)
+    for pattern in ["gemini_image_*.png", "gemini_image_*.jpg", "gemini_image_*.jpeg"]:
+        for file_path in images_dir.glob(pattern):
+            try:
+                if datetime.fromtimestamp(file_path.stat().st_mtime) < cutoff_time:
+                    file_path.unlink()
+            except Exception:
+                pass
+
+
+class LoopLagMonitor:
+    """测量事件循环的最大调度延迟"""
+
+    def __init__(self, tick=0.001):
+        self.tick = tick
+        self.max_lag = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.tick)
+            self.max_lag = max(self.max_lag, time.perf_counter() - start - self.tick)
+
+    def __enter__(self):
+        self.max_lag = 0.0
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+
+async def measure(label, coro_factory, repeat=1):
+    with LoopLagMonitor() as monitor:
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            await coro_factory()
+        elapsed = (time.perf_counter() - start) / repeat
+        await asyncio.sleep(0.01)
+    print(f"{label:<40} {elapsed * 1000:>10.2f} ms  最大事件循环阻塞 {monitor.max_lag * 1000:>8.2f} ms")
+    return elapsed
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"目录文件数: {args.files}，过期比例: {args.expired_ratio}")
+
+        legacy_dir = Path(tmp) / "legacy"
+        populate(legacy_dir, args.files, args.expired_ratio)
+        await measure("旧实现: 首次保存时清理", lambda: legacy_cleanup(legacy_dir))
+        await measure("旧实现: 之后每次保存的清理开销", lambda: legacy_cleanup(legacy_dir), repeat=args.saves)
+        print(f"旧实现遗留的过期 siliconflow_image_* 文件: {count_expired(legacy_dir, 'siliconflow_image_')}")
+
+        sweeper_dir = Path(tmp) / "sweeper"
+        populate(sweeper_dir, args.files, args.expired_ratio)
+        sweeper = ImageRetentionSweeper(sweeper_dir, ttl_seconds=15 * 60)
+        await measure("清理器: 启动时建立索引并清理过期文件", sweeper.rescan)
+
+        def track_batch():
+            for i in range(args.saves):
+                sweeper.track(sweeper_dir / f"gemini_image_new_{i}.png", 64)
+
+        start = time.perf_counter()
+        track_batch()
+        per_track = (time.perf_counter() - start) / args.saves
+        print(f"{'清理器: 每次保存的登记开销':<40} {per_track * 1e6:>10.2f} us")
+        await measure("清理器: 周期清理（无过期文件）", sweeper.sweep, repeat=args.saves)
+        print(f"清理器遗留的过期 siliconflow_image_* 文件: {count_expired(sweeper_dir, 'siliconflow_image_')}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="images 目录清理基准测试")
+    parser.add_argument("--files", type=int, default=50000, help="目录中的文件数量")
+    parser.add_argument("--expired-ratio", type=float, default=0.1, help="已过期文件的比例")
+    parser.add_argument("--saves", type=int, default=20, help="模拟的保存次数")
+    asyncio.run(main(parser.parse_args()))
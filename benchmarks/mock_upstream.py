@@ -0,0 +1,156 @@
+"""
+本地模拟的 OpenAI 兼容 /v1/chat/completions 上游
+
+每个请求的行为由 responder 决定（状态码、首字节延迟、传输耗时、返回内容），
+供追踪回放与离线基准测试使用，不需要真实的 API 密钥与额度。
+任意以 /v1/chat/completions 结尾的路径都会被处理，因此可以用不同的路径前缀模拟多个端点。
+"""
+import asyncio
+import base64
+import json
+import os
+from dataclasses import dataclass
+from aiohttp import web
+
+
+# 响应种类
+IMAGE = "image"                   # 返回 message.images 中的 base64 图像
+TEXT = "text"                     # 只返回文本，没有图像
+CONTENT_FILTER = "content_filter" # finish_reason 为内容过滤
+ERROR = "error"                   # 返回 status 对应的错误 JSON
+DROP = "drop"                     # 发送部分响应后断开连接
+
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+@dataclass
+class MockReply:
+    """单个请求的模拟响应"""
+    kind: str = IMAGE
+    status: int = 200
+    delay: float = 0.0            # 返回响应头之前的等待时间（秒）
+    transfer: float = 0.0         # 响应体的传输耗时（秒），按块均匀发送
+    image_bytes: int = 64 * 1024  # 图像解码后的大小
+    retry_after: float = None     # 错误响应的 Retry-After（秒）
+
+
+_image_cache = {}
+
+
+def fake_image_base64(size):
+    """
+    生成指定解码大小的伪 PNG base64 数据（文件头正确，内容为随机字节）
+
+    相同大小只生成一次，按 64KB 取整以限制缓存数量。
+    """
+    size = max(len(_PNG_SIGNATURE), (size + 0xFFFF) & ~0xFFFF)
+    data = _image_cache.get(size)
+    if data is None:
+        raw = _PNG_SIGNATURE + os.urandom(size - len(_PNG_SIGNATURE))
+        data = _image_cache[size] = base64.b64encode(raw)
+    return data
+
+
+def _completion(content, finish_reason="stop", native_finish_reason=None, images=None):
+    message = {"role": "assistant", "content": content}
+    if images is not None:
+        message["images"] = images
+    choice = {"index": 0, "message": message, "finish_reason": finish_reason}
+    if native_finish_reason:
+        choice["native_finish_reason"] = native_finish_reason
+    return {
+        "id": "mock",
+        "choices": [choice],
+        "usage": {"prompt_tokens": 10, "completion_tokens": 1290, "total_tokens": 1300},
+    }
+
+
+def render_body(reply):
+    """按模拟响应生成响应体字节"""
+    if reply.kind == IMAGE:
+        placeholder = "@@IMAGE@@"
+        skeleton = json.dumps(_completion("", images=[
+            {"type": "image_url", "image_url": {"url": placeholder}}
+        ])).encode()
+        before, after = skeleton.split(placeholder.encode())
+        return before + b"data:image/png;base64," + fake_image_base64(reply.image_bytes) + after
+    if reply.kind == TEXT:
+        return json.dumps(_completion("I can't draw that, but here is a description instead.")).encode()
+    if reply.kind == CONTENT_FILTER:
+        return json.dumps(_completion("", "content_filter", "IMAGE_SAFETY")).encode()
+    message = {402: "Insufficient credits", 429: "Rate limit exceeded"}.get(reply.status, "Upstream error")
+    return json.dumps({"error": {"code": reply.status, "message": message}}).encode()
+
+
+class MockUpstream:
+    """在本机随机端口上运行的模拟上游"""
+
+    def __init__(self, responder, host="127.0.0.1", port=0, chunk_size=256 * 1024):
+        """
+        Args:
+            responder (callable): 接收 (aiohttp request, 请求体字节)、返回 MockReply 的函数，可以是协程函数
+            host (str): 监听地址
+            port (int): 监听端口，0 表示随机分配
+            chunk_size (int): 响应体分块发送的大小
+        """
+        self.responder = responder
+        self.host = host
+        self.port = port
+        self.chunk_size = chunk_size
+        self.requests = 0
+        self.request_bytes = 0
+        self._runner = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        """启动服务，返回基础地址"""
+        app = web.Application(client_max_size=256 * 1024 * 1024)
+        app.router.add_post("/{tail:.*}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle(self, request):
+        if not request.path.endswith("/v1/chat/completions"):
+            raise web.HTTPNotFound()
+        body = await request.read()
+        self.requests += 1
+        self.request_bytes += len(body)
+        reply = self.responder(request, body)
+        if asyncio.iscoroutine(reply):
+            reply = await reply
+        if reply.delay:
+            await asyncio.sleep(reply.delay)
+
+        payload = render_body(reply)
+        status = reply.status if reply.kind in (ERROR, DROP) else 200
+        response = web.StreamResponse(status=status, headers={"Content-Type": "application/json"})
+        if reply.retry_after is not None:
+            response.headers["Retry-After"] = f"{reply.retry_after:g}"
+        if reply.kind != DROP:
+            response.content_length = len(payload)
+        await response.prepare(request)
+        if reply.kind == DROP:
+            await response.write(payload[:len(payload) // 2])
+            request.transport.close()
+            return response
+
+        chunks = range(0, len(payload), self.chunk_size)
+        pause = reply.transfer / len(chunks) if reply.transfer and len(chunks) else 0
+        for offset in chunks:
+            await response.write(payload[offset:offset + self.chunk_size])
+            if pause:
+                await asyncio.sleep(pause)
+        await response.write_eof()
+        return response
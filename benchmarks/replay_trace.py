@@ -0,0 +1,219 @@
+"""
+追踪日志回放
+
+读取插件写出的 trace.jsonl，按原始到达时间把每个请求重新交给 generate_image_openrouter，
+上游由本地模拟服务代替：每个请求按原记录中各次尝试的状态码、首字节延迟、传输耗时与响应大小依次返回，
+用于复现线上问题，以及在相同流量下对比不同版本的表现。
+回放时沿用原记录的关联ID（通过 X-Request-Id 传给模拟上游），原记录之外的额外尝试按成功请求的中位数返回图像。
+
+用法:
+    python benchmarks/replay_trace.py cache/traces/trace.jsonl --speed 2 --output /tmp/replay.jsonl
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import statistics
+import sys
+import time
+from collections import Counter, deque
+from pathlib import Path
+import aiohttp
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from mock_upstream import CONTENT_FILTER, DROP, ERROR, IMAGE, TEXT, MockReply, MockUpstream  # noqa: E402
+from utils.endpoint_router import EndpointRouter  # noqa: E402
+from utils.hedging import HedgePolicy  # noqa: E402
+from utils.key_pool import ApiKeyPool  # noqa: E402
+from utils.retry_policy import RetryPolicy  # noqa: E402
+from utils.tracing import TraceLogger  # noqa: E402
+from utils.ttp import generate_image_openrouter  # noqa: E402
+
+# 上游没有响应时模拟服务的等待时间，超过客户端超时
+_HANG_SECONDS = 3600
+
+
+def load_records(path):
+    """读取追踪文件，返回按到达时间排序的记录，以及没有上游请求的记录数"""
+    records = []
+    skipped = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            # 命中缓存或合并到其他请求的记录没有访问上游，回放时跳过
+            if record.get("cached") or record.get("coalesced") or not record.get("attempts"):
+                skipped += 1
+                continue
+            records.append(record)
+    records.sort(key=lambda item: item["ts"])
+    return records, skipped
+
+
+def attempt_reply(attempt):
+    """把原记录中的一次尝试转换为模拟响应"""
+    kind = attempt["kind"]
+    status = attempt.get("status") or 200
+    upstream = attempt.get("upstream", attempt["elapsed"])
+    transfer = attempt.get("download", 0.0)
+    size = max(attempt.get("response_bytes", 0) * 3 // 4, 1024)
+    if kind == "image":
+        return MockReply(IMAGE, delay=upstream, transfer=transfer, image_bytes=size)
+    if kind == "no_image":
+        return MockReply(TEXT, delay=upstream, transfer=transfer)
+    if kind == "content_filter":
+        return MockReply(CONTENT_FILTER, delay=upstream)
+    if kind in ("rate_limited", "key_rejected", "api_error", "server_error"):
+        return MockReply(ERROR, status=status, delay=upstream, retry_after=attempt.get("retry_after"))
+    if kind == "network":
+        return MockReply(DROP, delay=upstream)
+    if kind == "cancelled":
+        # 原请求被对冲请求取消，只知道它至少需要这么久
+        return MockReply(IMAGE, delay=attempt["elapsed"] * 2, image_bytes=size)
+    # timeout / error：不返回响应，由客户端超时
+    return MockReply(IMAGE, delay=_HANG_SECONDS)
+
+
+class TraceResponder:
+    """按关联ID依次返回原记录中各次尝试的响应"""
+
+    def __init__(self, records):
+        self.scripts = {record["id"]: deque(attempt_reply(a) for a in record["attempts"]) for record in records}
+        successes = [a for record in records for a in record["attempts"] if a["kind"] == "image"]
+        if successes:
+            typical = sorted(successes, key=lambda a: a["elapsed"])[len(successes) // 2]
+            self.default = attempt_reply(typical)
+        else:
+            self.default = MockReply(IMAGE, delay=1.0)
+        self.unscripted = 0
+
+    def __call__(self, request, body):
+        script = self.scripts.get(request.headers.get("X-Request-Id"))
+        if script:
+            return script.popleft()
+        self.unscripted += 1
+        return self.default
+
+
+def synthetic_references(record):
+    """生成与原记录数量、请求体大小相近的参考图片（base64）"""
+    count = record.get("reference_count", 0)
+    if not count:
+        return None
+    each = max(1024, (record.get("payload_bytes", 0) - 512) // count * 3 // 4)
+    raw = b"\xff\xd8\xff\xe0" + os.urandom(each)
+    return [base64.b64encode(raw).decode()] * count
+
+
+async def replay(args):
+    records, skipped = load_records(args.trace)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        print("追踪文件中没有可回放的记录")
+        return
+
+    responder = TraceResponder(records)
+    upstream = MockUpstream(responder)
+    base_url = await upstream.start()
+
+    key_count = max(a["key"] for record in records for a in record["attempts"])
+    endpoint_count = max(a["endpoint"] for record in records for a in record["attempts"])
+    key_pool = ApiKeyPool([f"sk-replay-{i + 1}" for i in range(key_count)])
+    router = EndpointRouter([f"{base_url}/endpoint{i + 1}" for i in range(endpoint_count)])
+    retry_policy = RetryPolicy(max_retries=args.max_retries, deadline=args.deadline)
+    hedge = HedgePolicy(delay_seconds=args.hedge_delay) if args.hedge_delay > 0 else None
+    tracer = TraceLogger(args.output, max_bytes=0, enabled=bool(args.output))
+
+    results = []
+
+    async def run_one(record):
+        trace = tracer.begin(record.get("command", "generate"), trace_id=record["id"])
+        trace.reference_count = record.get("reference_count", 0)
+        outcome = "failure"
+        error = None
+        try:
+            result = await generate_image_openrouter(
+                "replay", key_pool, input_images=synthetic_references(record), session=session,
+                hedge=hedge, endpoints=router, retry_policy=retry_policy, trace=trace,
+            )
+            if result:
+                outcome = "success"
+                os.remove(result.image_path)
+        except ValueError as e:
+            outcome, error = "blocked", e
+        except Exception as e:
+            outcome, error = "error", e
+        trace.finish(outcome, error)
+        tracer.emit(trace)
+        results.append((record, trace.to_dict()))
+
+    start = time.monotonic()
+    first_ts = records[0]["ts"]
+    print(f"回放 {len(records)} 条记录（跳过 {skipped} 条未访问上游的记录），"
+          f"{key_count} 个密钥，{endpoint_count} 个端点，速度 x{args.speed:g}")
+    async with aiohttp.ClientSession() as session:
+        tasks = []
+        for record in records:
+            due = (record["ts"] - first_ts) / args.speed
+            delay = due - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(run_one(record)))
+        await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - start
+    await tracer.close()
+    await upstream.stop()
+    report(results, elapsed, upstream, responder)
+    if args.output:
+        print(f"回放追踪已写入 {args.output}")
+
+
+def _percentiles(values):
+    if not values:
+        return "-"
+    values = sorted(values)
+    pick = [values[min(len(values) - 1, int(len(values) * q))] for q in (0.5, 0.95, 0.99)]
+    return " / ".join(f"{value:.2f}s" for value in pick)
+
+
+def report(results, elapsed, upstream, responder):
+    """输出原始记录与回放结果的对比"""
+    original = Counter(record["outcome"] for record, _ in results)
+    replayed = Counter(new["outcome"] for _, new in results)
+    matched = sum(1 for record, new in results if record["outcome"] == new["outcome"])
+    print(f"\n耗时 {elapsed:.1f}s，上游请求 {upstream.requests} 次（原记录之外 {responder.unscripted} 次）")
+    print(f"结果一致: {matched}/{len(results)}")
+    for outcome in sorted(set(original) | set(replayed)):
+        print(f"  {outcome:<8} 原始 {original[outcome]:>5}  回放 {replayed[outcome]:>5}")
+
+    def upstream_total(trace):
+        # 原始记录的 duration 包含参考图片获取与发送，只比较从序列化到最后一次尝试结束的耗时
+        return max(a["sent"] + a["elapsed"] for a in trace["attempts"]) - trace["phases"].get("serialize", [0])[0]
+
+    print("生成耗时 p50 / p95 / p99:")
+    print(f"  原始  {_percentiles([upstream_total(record) for record, _ in results])}")
+    print(f"  回放  {_percentiles([upstream_total(new) for _, new in results if new['attempts']])}")
+    print(f"平均尝试次数: 原始 {statistics.mean(len(r['attempts']) for r, _ in results):.2f}，"
+          f"回放 {statistics.mean(len(n['attempts']) for _, n in results):.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="按原始到达时间回放追踪日志")
+    parser.add_argument("trace", help="trace.jsonl 路径")
+    parser.add_argument("--speed", type=float, default=1.0, help="回放速度倍数，2 表示以两倍速度到达")
+    parser.add_argument("--limit", type=int, default=0, help="最多回放的记录数，0 表示全部")
+    parser.add_argument("--max-retries", type=int, default=3, help="重试次数上限")
+    parser.add_argument("--deadline", type=float, default=180, help="单个请求的截止时间（秒）")
+    parser.add_argument("--hedge-delay", type=float, default=0, help="对冲请求的等待时间（秒），0 表示不对冲")
+    parser.add_argument("--output", default="", help="把回放产生的追踪记录写入该文件，便于对比版本")
+    asyncio.run(replay(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,48 @@
+import asyncio
+import re
+import time
+from pathlib import Path
 from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult
 from astrbot.api.star import Context, Star, register
 from astrbot.api import logger
 from astrbot.api.all import *
-from astrbot.core.message.components import Reply, Plain, Image
-from .utils.ttp import generate_image_openrouter
+from astrbot.core.message.components import Image, Plain
+from .utils.ttp import DEFAULT_OPENROUTER_MODEL, ImageGenerationResult, generate_image_openrouter
+from .utils.http_client import SharedHttpClient
+from .utils.key_pool import ApiKeyPool
+from .utils.result_cache import ResultCache, make_cache_key
+from .utils.single_flight import SingleFlight
+from .utils.retention import ImageRetentionSweeper
+from .utils.stream_decoder import default_images_dir
+from .utils.image_preprocess import ReferenceImagePreprocessor
+from .utils.reference_images import ReferenceImageExtractor
+from .utils.image_fetcher import ReferenceImageFetcher
+from .utils.hedging import HedgePolicy
+from .utils.endpoint_router import EndpointRouter
+from .utils.circuit_breaker import STATE_LABELS
+from .utils.retry_policy import RetryBudget, RetryPolicy
+from .utils.metrics import MetricsRegistry, PrometheusExporter
+from .utils.tracing import TraceLogger
+from .utils.nap_client import NapFileClient, NapStreamSink
+from .utils.image_transcode import ImageTranscoder
+from .utils.fair_scheduler import FairScheduler, SchedulerRejected
+
+# /aiimg生成 -n 4 描述：一次生成多张变体
+VARIANT_PATTERN = re.compile(r"^-n\s*(\d+)\s*")
+
+# 状态命令中显示的阶段名称
+PHASE_LABELS = {
+    "reference": "参考图片获取",
+    "preprocess": "参考图片预处理",
+    "serialize": "请求序列化",
+    "upstream": "上游等待",
+    "download": "响应下载解码",
+    "disk": "磁盘写入",
+    "transcode": "输出转码",
+    "queue": "排队等待",
+    "total": "生成总耗时",
+    "delivery": "发送",
+}
 
 @register("gemini-25-image-openrouter", "喵喵", "使用openrouter的免费api生成图片", "1.3")
 class MyPlugin(Star):
@@ -16,11 +55,469 @@ class MyPlugin(Star):
         if old_api_key and not self.openrouter_api_keys:
             self.openrouter_api_keys = [old_api_key]
         
+        # 密钥池：跟踪每个密钥的冷却、错误率、并发数与用量，按请求选择最优密钥
+        self.key_pool = ApiKeyPool(
+            self.openrouter_api_keys,
+            daily_request_limit=config.get("key_daily_request_limit", 0),
+            daily_token_limit=config.get("key_daily_token_limit", 0),
+            rotate_threshold=config.get("key_rotate_threshold", 0.9),
+            default_cooldown=config.get("key_cooldown_seconds", 60),
+            failure_threshold=config.get("breaker_failure_threshold", 5),
+            breaker_open_seconds=config.get("key_breaker_open_seconds", 60),
+        )
+        
         # 自定义API base支持
         self.custom_api_base = config.get("custom_api_base", "").strip()
+        # 多端点路由：按 EWMA 延迟、成功率与并发数选择端点，都未配置时使用 OpenRouter
+        api_bases = list(config.get("api_endpoints", []))
+        if self.custom_api_base:
+            api_bases.append(self.custom_api_base)
+        self.endpoint_router = EndpointRouter(
+            api_bases,
+            failure_threshold=config.get("breaker_failure_threshold", 5),
+            breaker_open_seconds=config.get("breaker_open_seconds", 30),
+        )
+        self.model = DEFAULT_OPENROUTER_MODEL
+        # 单个响应最多保存的图像数，以及 -n 多张变体生成时单条命令的并发上限
+        self.max_images_per_response = max(1, config.get("max_images_per_response", 4))
+        self.max_variants = max(1, config.get("max_variants", 4))
+        # 批量生成：单条命令的描述数上限，以及所有批量命令共享的并发上限
+        self.batch_max_prompts = max(1, config.get("batch_max_prompts", 10))
+        self.batch_semaphore = asyncio.Semaphore(max(1, config.get("batch_concurrency", 3)))
+
+        # 公平调度：按用户与群的令牌桶限流，全局并发上限，超出时按群加权公平排队，队列过长时拒绝
+        self.scheduler = None
+        if config.get("scheduler_enabled", True):
+            group_weights = {}
+            for item in config.get("scheduler_group_weights", []):
+                group_id, _, weight = str(item).partition(":")
+                try:
+                    group_weights[group_id.strip()] = float(weight)
+                except ValueError:
+                    logger.warning(f"忽略无效的群权重配置: {item}")
+            self.scheduler = FairScheduler(
+                max_in_flight=config.get("scheduler_max_in_flight", 8),
+                max_queue=config.get("scheduler_max_queue", 20),
+                max_queue_per_group=config.get("scheduler_max_queue_per_group", 5),
+                user_rate_per_minute=config.get("user_rate_per_minute", 6),
+                user_burst=config.get("user_burst", 4),
+                group_rate_per_minute=config.get("group_rate_per_minute", 20),
+                group_burst=config.get("group_burst", 10),
+                group_weights=group_weights,
+            )
+            max_cost = self.scheduler.max_cost()
+            if max_cost is not None and self.max_variants > max_cost:
+                logger.warning(f"max_variants ({self.max_variants}) 大于令牌桶容量 ({max_cost})，"
+                               f"-n 超过 {max_cost} 的请求将被拒绝，请调大 user_burst / group_burst")
         
         self.nap_server_address = config.get("nap_server_address")
         self.nap_server_port = config.get("nap_server_port")
+        # NAP 文件传输：分帧协议下复用长连接并流水线发送多个文件
+        self.nap_client = NapFileClient(
+            self.nap_server_address or "localhost",
+            self.nap_server_port or 3658,
+            protocol=config.get("nap_protocol", "legacy"),
+            max_connections=config.get("nap_max_connections", 2),
+            dedup=config.get("nap_dedup_enabled", True),
+        )
+        # 图像发送方式：local 直接发送本地路径，upload 生成后上传到 NAP，stream 边解码边发送到 NAP（不写本地磁盘）
+        self.nap_delivery_mode = config.get("nap_delivery_mode", "local")
+        if self.nap_delivery_mode == "stream" and self.nap_client.protocol != "framed":
+            logger.warning("nap_delivery_mode=stream 需要 nap_protocol=framed，改为 upload 模式")
+            self.nap_delivery_mode = "upload"
+
+        # 插件生命周期内共享的HTTP客户端，避免每次请求重新建立DNS/TCP/TLS连接
+        self.http_client = SharedHttpClient()
+
+        # 结果缓存：相同模型、提示词与参考图片的请求直接返回缓存文件
+        self.result_cache = None
+        if config.get("result_cache_enabled", True):
+            self.result_cache = ResultCache(
+                Path(__file__).parent / "cache" / "results",
+                max_bytes=config.get("result_cache_max_mb", 200) * 1024 * 1024,
+                ttl_seconds=config.get("result_cache_ttl_minutes", 1440) * 60,
+            )
+
+        # 相同请求并发时只调用一次上游，所有请求共享结果
+        self.single_flight = SingleFlight()
+
+        # 后台清理 images 目录中过期或超出配额的图像
+        self.retention = ImageRetentionSweeper(
+            default_images_dir(),
+            ttl_seconds=config.get("image_retention_minutes", 15) * 60,
+            max_bytes=config.get("image_retention_max_mb", 500) * 1024 * 1024,
+        )
+
+        # 参考图片下载：复用共享连接，按URL/文件ID与内容摘要缓存，重复编辑同一张图时不再下载
+        self.reference_fetcher = ReferenceImageFetcher(
+            self.http_client.get_session,
+            Path(__file__).parent / "cache" / "references",
+            max_download_bytes=config.get("ref_fetch_max_mb", 15) * 1024 * 1024,
+            timeout=config.get("ref_fetch_timeout", 20),
+            memory_bytes=config.get("ref_fetch_memory_mb", 64) * 1024 * 1024,
+            fresh_seconds=config.get("ref_fetch_fresh_seconds", 600),
+        )
+
+        # 参考图片提取：并发转换、按内容去重，并限制数量与总大小
+        self.reference_extractor = ReferenceImageExtractor(
+            max_images=config.get("ref_image_max_count", 6),
+            max_total_bytes=config.get("ref_image_max_total_mb", 20) * 1024 * 1024,
+            fetcher=self.reference_fetcher,
+        )
+
+        # 参考图片上传前的缩放与重新压缩
+        self.preprocessor = ReferenceImagePreprocessor(
+            max_edge=config.get("ref_image_max_edge", 1536),
+            output_format=config.get("ref_image_format", "jpeg"),
+            quality=config.get("ref_image_quality", 85),
+        )
+
+        # 生成结果的输出转码：转换格式、限制尺寸并去除元数据，缩小发送到聊天平台的文件
+        self.transcoder = ImageTranscoder(
+            output_format=config.get("output_image_format", "original"),
+            quality=config.get("output_image_quality", 85),
+            max_width=config.get("output_image_max_width", 0),
+            max_height=config.get("output_image_max_height", 0),
+            strip_metadata=config.get("output_strip_metadata", True),
+            keep_original=config.get("output_keep_original", False),
+            max_workers=config.get("output_transcode_workers", 2),
+        )
+
+        # 对冲请求：主请求迟迟未完成时用另一个密钥并行请求，降低长尾延迟
+        self.hedge = None
+        if config.get("hedge_enabled", False) and (len(self.key_pool) > 1 or len(self.endpoint_router) > 1):
+            self.hedge = HedgePolicy(
+                delay_seconds=config.get("hedge_delay_seconds", 30),
+                max_per_minute=config.get("hedge_max_per_minute", 3),
+            )
+
+        # 重试策略：按错误类型退避重试，受单次请求截止时间与全局重试预算约束
+        self.retry_policy = RetryPolicy(
+            max_retries=config.get("retry_max_retries", 3),
+            base_delay=config.get("retry_base_delay", 1.0),
+            max_delay=config.get("retry_max_delay", 20),
+            deadline=config.get("request_deadline_seconds", 180),
+            retry_empty_image=config.get("retry_empty_image", True),
+            budget=RetryBudget(ratio=config.get("retry_budget_ratio", 0.2)),
+        )
+
+        # 运行指标：各阶段耗时、请求结果计数、缓存命中率与进行中的请求数
+        self.generations_in_flight = 0
+        self.metrics = MetricsRegistry()
+        self._register_gauges()
+        self.metrics_exporter = None
+        metrics_port = config.get("metrics_port", 0)
+        if metrics_port:
+            self.metrics_exporter = PrometheusExporter(self.metrics, port=metrics_port)
+
+        # 追踪日志：每次生成输出一行 JSONL（关联ID、阶段时间、密钥序号、数据大小与结果），不含提示词与密钥
+        self.tracer = TraceLogger(
+            Path(__file__).parent / "cache" / "traces" / "trace.jsonl",
+            max_bytes=config.get("trace_log_max_mb", 20) * 1024 * 1024,
+            enabled=config.get("trace_log_enabled", True),
+        )
+
+    def _register_gauges(self):
+        """注册在读取时计算的指标"""
+        metrics = self.metrics
+        metrics.describe("generations", "Image generation requests by outcome")
+        metrics.register_gauge("generations_in_flight", "Image generations currently running",
+                               lambda: self.generations_in_flight)
+        metrics.register_gauge("upstream_in_flight", "Distinct upstream generations currently running",
+                               lambda: self.single_flight.in_flight())
+        metrics.register_gauge("coalesced_requests", "Requests that joined an identical in-flight generation",
+                               lambda: self.single_flight.coalesced, metric_type="counter")
+        metrics.register_gauge("key_requests", "Requests sent with each API key", lambda: {
+            (("key", key["index"]),): key["requests_total"] for key in self.key_pool.snapshot()
+        }, metric_type="counter")
+        metrics.register_gauge("key_rate_limited", "429/402 responses for each API key", lambda: {
+            (("key", key["index"]),): key["rate_limited_total"] for key in self.key_pool.snapshot()
+        }, metric_type="counter")
+        metrics.register_gauge("key_errors", "Failed requests for each API key", lambda: {
+            (("key", key["index"]),): key["errors_total"] for key in self.key_pool.snapshot()
+        }, metric_type="counter")
+        metrics.register_gauge("key_in_flight", "In-flight requests for each API key", lambda: {
+            (("key", key["index"]),): key["in_flight"] for key in self.key_pool.snapshot()
+        })
+        metrics.register_gauge("scheduler_in_flight", "Generations admitted by the fair scheduler",
+                               lambda: self.scheduler.in_flight if self.scheduler else 0)
+        metrics.register_gauge("scheduler_queue_depth", "Generations waiting in the fair scheduler queue",
+                               lambda: self.scheduler.stats()["queued"] if self.scheduler else 0)
+        metrics.register_gauge("scheduler_rejected", "Requests rejected by the fair scheduler by reason", lambda: {
+            (("reason", reason),): count for reason, count in self.scheduler.stats()["rejected"].items()
+        } if self.scheduler else {}, metric_type="counter")
+        metrics.register_gauge("result_cache_hit_rate", "Result cache hit rate",
+                               lambda: self.result_cache.stats()["hit_rate"] if self.result_cache else 0)
+        metrics.register_gauge("reference_fetch", "Reference image fetches by source", lambda: {
+            (("source", name),): value for name, value in self.reference_fetcher.stats().items()
+            if name != "memory_bytes"
+        }, metric_type="counter")
+
+    async def initialize(self):
+        """插件加载完成后由 AstrBot 在事件循环中调用"""
+        self._start_background_tasks()
+
+    def _start_background_tasks(self):
+        """
+        启动图像清理与指标导出等后台任务（可重复调用）
+
+        后台任务需要运行中的事件循环，不能在 __init__ 中启动；不调用 initialize 的 AstrBot 版本在首次生成时启动。
+        """
+        self.retention.start()
+        if self.metrics_exporter:
+            self.metrics_exporter.start()
+
+    async def terminate(self):
+        """插件卸载时释放共享资源"""
+        await self.retention.stop()
+        if self.metrics_exporter:
+            await self.metrics_exporter.stop()
+        await self.tracer.close()
+        await self.nap_client.close()
+        await self.reference_fetcher.close()
+        await self.http_client.close()
+        self.preprocessor.close()
+        self.transcoder.close()
+
+    async def _generate_image(self, prompt, reference_images, trace=None, variant=0):
+        """
+        生成图像，命中结果缓存时直接返回缓存文件而不调用上游，
+        相同请求并发时合并为一次上游调用
+
+        Args:
+            prompt (str): 图像描述
+            reference_images (list): ReferenceImageExtractor 提取的参考图片
+            trace (TraceRecord): 本次请求的追踪记录
+            variant (int): 多张变体生成时的序号（从1开始），变体之间以及与单张生成之间不会合并；
+                变体的目的是得到不同的图像，因此不读写结果缓存
+
+        Returns:
+            ImageGenerationResult: 生成结果，失败时返回None
+        """
+        self._start_background_tasks()
+        cache_key = make_cache_key(self.model, prompt, [image.digest for image in reference_images], variant)
+        use_cache = self.result_cache is not None and not variant
+        input_images = [image.data for image in reference_images]
+        trace = trace or self.tracer.begin()
+        trace.reference_count = len(reference_images)
+        if use_cache:
+            entry = await self.result_cache.get(cache_key)
+            if entry:
+                logger.info("命中结果缓存，跳过上游请求")
+                self.metrics.inc("generations", outcome="cached")
+                trace.cached = True
+                trace.finish("cached")
+                result, *extra_images = [
+                    ImageGenerationResult(
+                        image_path=image.path,
+                        image_url=f"file://{image.path}",
+                        image_format=image.image_format,
+                        size=image.size,
+                        cached=True,
+                    )
+                    for image in (entry, *entry.extra_images)
+                ]
+                result.extra_images = extra_images
+                return result
+
+        # 相同的进行中请求共享一次上游调用，单个调用方取消不会影响其他调用方
+        self.generations_in_flight += 1
+        trace.coalesced = self.single_flight.running(cache_key)
+        try:
+            result = await self.single_flight.do(
+                cache_key, lambda: self._generate_uncached(cache_key, prompt, input_images, trace, use_cache)
+            )
+        except ValueError as e:
+            self.metrics.inc("generations", outcome="blocked")
+            trace.finish("blocked", e)
+            raise
+        except Exception as e:
+            self.metrics.inc("generations", outcome="error")
+            trace.finish("error", e)
+            raise
+        finally:
+            self.generations_in_flight -= 1
+        outcome = "success" if result else "failure"
+        self.metrics.inc("generations", outcome=outcome)
+        trace.finish(outcome)
+        return result
+
+    async def _generate_uncached(self, cache_key, prompt, input_images, trace, use_cache=True):
+        """预处理参考图片并调用上游生成图像，成功后写入结果缓存（use_cache 为 False 时不写入）"""
+        if input_images:
+            with self.metrics.timer("preprocess"), trace.phase("preprocess"):
+                input_images = await self.preprocessor.process_all(input_images)
+        result = await generate_image_openrouter(
+            prompt,
+            self.key_pool,
+            model=self.model,
+            input_images=input_images,
+            session=self.http_client.get_session(),
+            hedge=self.hedge,
+            endpoints=self.endpoint_router,
+            retry_policy=self.retry_policy,
+            trace=trace,
+            sink_factory=self._stream_sink if self.nap_delivery_mode == "stream" else None,
+            max_images=self.max_images_per_response,
+        )
+        # 直接发送到 NAP 的图像不在本地，不参与转码、清理与结果缓存
+        if result and not result.remote and self.transcoder.enabled:
+            with trace.phase("transcode"):
+                result = await self.transcoder.transcode(result)
+        if result:
+            # 合并的请求共享同一个结果，只在实际调用上游的一方记录阶段耗时
+            self.metrics.observe_timings(result.timings)
+        if result and not result.remote:
+            self.retention.track_result(result)
+            if use_cache:
+                await self.result_cache.put(cache_key, result.image_path, result.image_format,
+                                            [(image.image_path, image.image_format) for image in result.extra_images])
+        return result
+
+    async def _generate_variants(self, prompt, reference_images, traces):
+        """
+        并发生成多张变体，每张变体独立调用上游（由密钥池分配到不同的健康密钥）
+
+        只生成一张时与单张生成相同（使用结果缓存），多张时每张变体都重新生成。
+
+        Args:
+            prompt (str): 图像描述
+            reference_images (list): 参考图片
+            traces (list): 每张变体的追踪记录，数量即变体数
+
+        Returns:
+            tuple: (成功的生成结果列表, 失败的数量)
+
+        Raises:
+            Exception: 所有变体都失败且至少一张抛出异常时，抛出第一个异常
+        """
+        outcomes = await asyncio.gather(
+            *(self._generate_image(prompt, reference_images, trace, variant if len(traces) > 1 else 0)
+              for variant, trace in enumerate(traces, 1)),
+            return_exceptions=True,
+        )
+        results = [outcome for outcome in outcomes if isinstance(outcome, ImageGenerationResult)]
+        errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+        for error in errors:
+            logger.warning(f"变体生成失败: {error}")
+        if not results and errors:
+            raise errors[0]
+        return results, len(outcomes) - len(results)
+
+    async def _image_reply(self, event, results, failed=0, caption=None):
+        """
+        构建包含所有生成图像的回复，单张图像时与 event.image_result 相同
+
+        Args:
+            event (AstrMessageEvent): 消息事件
+            results (list): 生成结果
+            failed (int): 生成失败的变体数量
+            caption (str): 图像前的说明文字（可选）
+
+        Returns:
+            MessageEventResult: 回复消息
+        """
+        images = [image for result in results for image in (result, *result.extra_images)]
+        paths = await asyncio.gather(*(self._deliver(image) for image in images))
+        if len(paths) == 1 and not failed and not caption:
+            return event.image_result(paths[0])
+        chain = [Plain(caption)] if caption else []
+        chain += [Image.fromFileSystem(path) for path in paths]
+        if failed:
+            chain.append(Plain(f"{failed} 张图像生成失败"))
+        return event.chain_result(chain)
+
+    @staticmethod
+    def _requester(event):
+        """返回 (用户ID, 调度分组ID)，私聊按用户单独分组"""
+        user_id = str(event.get_sender_id())
+        group_id = event.get_group_id()
+        return user_id, str(group_id) if group_id else f"private:{user_id}"
+
+    def _admit(self, event, cost=1):
+        """
+        向公平调度器申请生成名额（扣除令牌并在需要时排队）
+
+        Returns:
+            SchedulerTicket: 调度票据，未启用调度时返回None
+
+        Raises:
+            SchedulerRejected: 超过速率限制或队列已满
+        """
+        if self.scheduler is None:
+            return None
+        return self.scheduler.submit(*self._requester(event), cost=cost)
+
+    async def _wait_turn(self, ticket, trace):
+        """等待排队中的请求轮到执行，记录排队耗时"""
+        if ticket is not None and not ticket.admitted:
+            with self.metrics.timer("queue"), trace.phase("queue"):
+                await ticket.wait()
+
+    def _reject(self, event, error, traces):
+        """记录被调度器拒绝的请求并构建回复"""
+        logger.info(f"请求被调度器拒绝（{error.reason}）: {error}")
+        for trace in traces:
+            trace.finish("rejected", error)
+            self.tracer.emit(trace)
+        return event.chain_result([Plain(f"⏳ {error}")])
+
+    async def _generate_batch_item(self, index, prompt, reference_images, requester):
+        """
+        在批量并发上限内生成一张图像
+
+        第一项的令牌已在批量命令开始时扣除，之后的各项等待令牌补充后再扣除（等待期间不占用批量并发名额）。
+
+        Returns:
+            tuple: (序号, 描述, 生成结果或None, 失败原因或None, 追踪记录)
+        """
+        trace = self.tracer.begin("batch")
+        if self.scheduler is not None and index:
+            with self.metrics.timer("queue"), trace.phase("queue"):
+                await self.scheduler.acquire(*requester)
+        async with self.batch_semaphore:
+            ticket = None
+            try:
+                if self.scheduler is not None:
+                    ticket = self.scheduler.submit(*requester, charge=False)
+                    await self._wait_turn(ticket, trace)
+                result = await self._generate_image(prompt, reference_images, trace)
+            except SchedulerRejected as e:
+                trace.finish("rejected", e)
+                return index, prompt, None, str(e), trace
+            except ValueError as e:
+                reason = "内容安全限制" if "内容过滤器阻止了图像生成" in str(e) else str(e)
+                return index, prompt, None, reason, trace
+            except Exception as e:
+                logger.error(f"批量生成第 {index + 1} 张时出现错误: {e}")
+                return index, prompt, None, str(e) or type(e).__name__, trace
+            finally:
+                if ticket is not None:
+                    ticket.release()
+        return index, prompt, result, None if result else "生成失败", trace
+
+    def _stream_sink(self, image_format):
+        return NapStreamSink(self.nap_client, image_format)
+
+    async def _deliver(self, result):
+        """
+        按 nap_delivery_mode 准备要发送的图像路径
+
+        upload / stream 模式下把本地图像上传到 NAP，上传失败时退回发送本地路径。
+
+        Args:
+            result (ImageGenerationResult): 生成结果
+
+        Returns:
+            str: 发送给平台的图像路径
+        """
+        if self.nap_delivery_mode == "local" or result.remote:
+            return result.image_path
+        remote_path = await self.nap_client.send_file(result.image_path)
+        if not remote_path:
+            logger.warning("上传图像到 NAP 失败，改为发送本地路径")
+            return result.image_path
+        return remote_path
 
     @filter.command_group("aiimg", alias=["aiimg"])
     async def aiimg_group(self, event: AstrMessageEvent):
@@ -31,8 +528,11 @@ class MyPlugin(Star):
 可用命令：
 • `/aiimg` - 显示此帮助信息
 • `/aiimg生成 [描述]` - 普通图像生成
+• `/aiimg生成 -n 4 [描述]` - 一次生成多张变体
+• `/aiimg批量` - 批量生成（命令后每行一个描述）
 • `/aiimg手办化` - 手办风格转换（需要参考图片）
 • `/aiimg帮助` - 显示帮助信息
+• `/aiimg状态` - 查看密钥与端点状态（管理员）
 
 示例：
 • `/aiimg生成 一只可爱的小猫`
@@ -48,8 +548,11 @@ class MyPlugin(Star):
 可用命令：
 • `/aiimg` - 显示此帮助信息
 • `/aiimg生成 [描述]` - 普通图像生成
+• `/aiimg生成 -n 4 [描述]` - 一次生成多张变体
+• `/aiimg批量` - 批量生成（命令后每行一个描述）
 • `/aiimg手办化` - 手办风格转换（需要参考图片）
 • `/aiimg帮助` - 显示帮助信息
+• `/aiimg状态` - 查看密钥与端点状态（管理员）
 
 示例：
 • `/aiimg生成 一只可爱的小猫`
@@ -68,70 +571,58 @@ class MyPlugin(Star):
         message_text = event.message_str.strip()
         image_description = message_text.replace('/aiimg生成', '', 1).strip()
         image_description = image_description.replace('/aiimg', '', 1).strip()
+        # -n N：并发生成 N 张变体，数量受 max_variants 限制
+        variants = 1
+        match = VARIANT_PATTERN.match(image_description)
+        if match:
+            variants = min(max(1, int(match.group(1))), self.max_variants)
+            image_description = image_description[match.end():]
         
         # 注释掉提示词净化功能
         # image_description = self.sanitize_prompt(image_description)
         
-        openrouter_api_keys = self.openrouter_api_keys
-        nap_server_address = self.nap_server_address
-        nap_server_port = self.nap_server_port
+        traces = [self.tracer.begin("generate") for _ in range(variants)]
+        trace = traces[0]
 
-        # 根据参数决定是否使用参考图片
-        input_images = []
-        use_reference_images = True  # Command mode always tries to use reference images
-        
-        if use_reference_images:
-            # 从当前对话上下文中获取图片信息
-            if hasattr(event, 'message_obj') and event.message_obj and hasattr(event.message_obj, 'message'):
-                for comp in event.message_obj.message:
-                    if isinstance(comp, Image):
-                        try:
-                            base64_data = await comp.convert_to_base64()
-                            input_images.append(base64_data)
-                        except (IOError, ValueError, OSError) as e:
-                            logger.warning(f"转换当前消息中的参考图片到base64失败: {e}")
-                        except Exception as e:
-                            logger.error(f"处理当前消息中的图片时出现未预期的错误: {e}")
-                    elif isinstance(comp, Reply):
-                        # 修复引用消息中的图片获取逻辑
-                        # Reply组件的chain字段包含被引用的消息内容
-                        if comp.chain:
-                            for reply_comp in comp.chain:
-                                if isinstance(reply_comp, Image):
-                                    try:
-                                        base64_data = await reply_comp.convert_to_base64()
-                                        input_images.append(base64_data)
-                                        logger.info(f"从引用消息中获取到图片")
-                                    except (IOError, ValueError, OSError) as e:
-                                        logger.warning(f"转换引用消息中的参考图片到base64失败: {e}")
-                                    except Exception as e:
-                                        logger.error(f"处理引用消息中的图片时出现未预期的错误: {e}")
-                        else:
-                            logger.debug("引用消息的chain为空，无法获取图片内容")
-            
-            # 记录使用的图片数量
-            if input_images:
-                logger.info(f"使用了 {len(input_images)} 张参考图片进行图像生成")
-            else:
-                logger.info("未找到参考图片，执行纯文本图像生成")
+        # 公平调度：按用户与群限流，超过全局并发上限时排队
+        try:
+            ticket = self._admit(event, cost=variants)
+        except SchedulerRejected as e:
+            yield self._reject(event, e, traces)
+            return
 
         # 调用生成图像的函数
         try:
-            image_url, image_path = await generate_image_openrouter(
-                image_description, 
-                openrouter_api_keys, 
-                input_images=input_images,
-                api_base=self.custom_api_base if self.custom_api_base else None
-            )
+            if ticket is not None and ticket.position:
+                yield event.chain_result([Plain(f"⏳ 当前排队第 {ticket.position} 位，请稍候")])
+            # 通过限流后才从当前消息与引用消息中提取参考图片（并发转换、去重并限制数量与大小），排队期间同时进行
+            with self.metrics.timer("reference"), trace.phase("reference"):
+                reference_images = await self.reference_extractor.extract(event)
+            # 记录使用的图片数量
+            if reference_images:
+                logger.info(f"使用了 {len(reference_images)} 张参考图片进行图像生成")
+            else:
+                logger.info("未找到参考图片，执行纯文本图像生成")
+            await self._wait_turn(ticket, trace)
+            results, failed = await self._generate_variants(image_description, reference_images, traces)
+            # 发送期间不占用生成名额
+            if ticket is not None:
+                ticket.release()
             
-            if not image_url or not image_path:
+            if not results:
                 # 生成失败，发送错误消息
                 error_chain = [Plain("图像生成失败，请检查API配置和网络连接。")]
                 yield event.chain_result(error_chain)
                 return
             
-            # 使用 AstrBot 的标准方法返回图片
-            yield event.image_result(image_path)
+            for result in results:
+                logger.debug(f"图像生成完成，使用密钥 #{result.api_key_index}，耗时: {result.timings}")
+            # 使用 AstrBot 的标准方法返回图片；生成器在消息发送后才会继续执行，据此统计发送耗时
+            delivery_start = time.monotonic()
+            yield await self._image_reply(event, results, failed)
+            delivery_seconds = time.monotonic() - delivery_start
+            self.metrics.observe("delivery", delivery_seconds)
+            trace.mark("delivery", delivery_start, delivery_seconds)
                 
         except (ConnectionError, TimeoutError) as e:
             logger.error(f"网络连接错误导致图像生成失败: {e}")
@@ -153,6 +644,73 @@ class MyPlugin(Star):
             error_chain = [Plain(f"图像生成失败: {str(e)}")]
             yield event.chain_result(error_chain)
             return
+        finally:
+            if ticket is not None:
+                ticket.release()
+            for variant_trace in traces:
+                self.tracer.emit(variant_trace)
+
+    @filter.command("aiimg批量")
+    async def aiimg_batch(self, event: AstrMessageEvent):
+        """批量生成：每行一个描述，并发生成并在每张完成时立即发送"""
+        message_text = event.message_str.strip()
+        prompts_text = message_text.replace('/aiimg批量', '', 1)
+        prompts_text = prompts_text.replace('aiimg批量', '', 1)
+        prompts = [line.strip() for line in prompts_text.splitlines() if line.strip()]
+        if not prompts:
+            yield event.chain_result([Plain("请在命令后每行写一个图像描述，例如：\n/aiimg批量\n一只小猫\n一只小狗")])
+            return
+        if len(prompts) > self.batch_max_prompts:
+            yield event.chain_result([Plain(f"一次最多批量生成 {self.batch_max_prompts} 张，"
+                                            f"已忽略之后的 {len(prompts) - self.batch_max_prompts} 个描述")])
+            prompts = prompts[:self.batch_max_prompts]
+
+        # 第一项立即扣除令牌（超过速率时拒绝整个批量），之后的每一项在令牌补充后再扣除并排队；
+        # 通过限流后才提取参考图片
+        requester = self._requester(event)
+        if self.scheduler is not None:
+            try:
+                self.scheduler.charge(*requester)
+            except SchedulerRejected as e:
+                yield self._reject(event, e, [])
+                return
+
+        # 所有描述共用同一组参考图片
+        with self.metrics.timer("reference"):
+            reference_images = await self.reference_extractor.extract(event)
+        logger.info(f"批量生成 {len(prompts)} 张图像，参考图片 {len(reference_images)} 张")
+
+        # 所有描述同时开始排队，由共享的批量并发上限控制同时请求上游的数量；按完成顺序逐张发送
+        tasks = [
+            asyncio.create_task(self._generate_batch_item(index, prompt, reference_images, requester))
+            for index, prompt in enumerate(prompts)
+        ]
+        failures = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                index, prompt, result, reason, trace = await next_done
+                if result is None:
+                    failures.append((index, prompt, reason))
+                    self.tracer.emit(trace)
+                    continue
+                delivery_start = time.monotonic()
+                yield await self._image_reply(event, [result], caption=f"{index + 1}. {prompt}")
+                delivery_seconds = time.monotonic() - delivery_start
+                self.metrics.observe("delivery", delivery_seconds)
+                trace.mark("delivery", delivery_start, delivery_seconds)
+                self.tracer.emit(trace)
+        finally:
+            # 命令被中断时取消尚未完成的生成
+            for task in tasks:
+                task.cancel()
+
+        if not failures:
+            yield event.chain_result([Plain(f"批量生成完成：{len(prompts)} 张全部成功")])
+            return
+        lines = [f"批量生成完成：成功 {len(prompts) - len(failures)} 张，失败 {len(failures)} 张"]
+        for index, prompt, reason in sorted(failures):
+            lines.append(f"{index + 1}. {prompt[:30]}：{reason}")
+        yield event.chain_result([Plain("\n".join(lines))])
 
     @filter.command("aiimg手办化")
     async def aiimg_figure(self, event: AstrMessageEvent):
@@ -175,69 +733,52 @@ class MyPlugin(Star):
         # 注释掉提示词净化功能
         # image_description = self.sanitize_prompt(image_description)
         
-        openrouter_api_keys = self.openrouter_api_keys
-        nap_server_address = self.nap_server_address
-        nap_server_port = self.nap_server_port
+        # 手办化模式必须使用参考图片（先只检查消息中是否有图片组件，不下载）
+        missing_reference = [Plain("手办化模式必须包含参考图片，请先发送图片再使用 `/aiimg手办化` 命令")]
+        if not self.reference_extractor.collect_components(event):
+            yield event.chain_result(missing_reference)
+            return
+        trace = self.tracer.begin("figure")
 
-        # 手办化模式必须使用参考图片
-        input_images = []
-        use_reference_images = True
-            
-        if use_reference_images:
-            # 从当前对话上下文中获取图片信息
-            if hasattr(event, 'message_obj') and event.message_obj and hasattr(event.message_obj, 'message'):
-                for comp in event.message_obj.message:
-                    if isinstance(comp, Image):
-                        try:
-                            base64_data = await comp.convert_to_base64()
-                            input_images.append(base64_data)
-                        except (IOError, ValueError, OSError) as e:
-                            logger.warning(f"转换当前消息中的参考图片到base64失败: {e}")
-                        except Exception as e:
-                            logger.error(f"处理当前消息中的图片时出现未预期的错误: {e}")
-                    elif isinstance(comp, Reply):
-                        # 修复引用消息中的图片获取逻辑
-                        # Reply组件的chain字段包含被引用的消息内容
-                        if comp.chain:
-                            for reply_comp in comp.chain:
-                                if isinstance(reply_comp, Image):
-                                    try:
-                                        base64_data = await reply_comp.convert_to_base64()
-                                        input_images.append(base64_data)
-                                        logger.info(f"从引用消息中获取到图片")
-                                    except (IOError, ValueError, OSError) as e:
-                                        logger.warning(f"转换引用消息中的参考图片到base64失败: {e}")
-                                    except Exception as e:
-                                        logger.error(f"处理引用消息中的图片时出现未预期的错误: {e}")
-                        else:
-                            logger.debug("引用消息的chain为空，无法获取图片内容")
-            
-            # 记录使用的图片数量
-            if input_images:
-                logger.info(f"使用了 {len(input_images)} 张参考图片进行图像生成")
-            else:
-                # 手办化模式必须包含参考图片
-                error_chain = [Plain("手办化模式必须包含参考图片，请先发送图片再使用 `/aiimg手办化` 命令")]
-                yield event.chain_result(error_chain)
-                return
+        # 公平调度：按用户与群限流，超过全局并发上限时排队
+        try:
+            ticket = self._admit(event)
+        except SchedulerRejected as e:
+            yield self._reject(event, e, [trace])
+            return
 
         # 调用生成图像的函数
         try:
-            image_url, image_path = await generate_image_openrouter(
-                image_description,
-                openrouter_api_keys,
-                input_images=input_images,
-                api_base=self.custom_api_base if self.custom_api_base else None
-            )
+            if ticket is not None and ticket.position:
+                yield event.chain_result([Plain(f"⏳ 当前排队第 {ticket.position} 位，请稍候")])
+            # 通过限流后才下载与转换参考图片，排队期间同时进行
+            with self.metrics.timer("reference"), trace.phase("reference"):
+                reference_images = await self.reference_extractor.extract(event)
+            if not reference_images:
+                # 图片全部转换失败
+                trace.finish("failure")
+                yield event.chain_result(missing_reference)
+                return
+            logger.info(f"使用了 {len(reference_images)} 张参考图片进行图像生成")
+            await self._wait_turn(ticket, trace)
+            result = await self._generate_image(image_description, reference_images, trace)
+            # 发送期间不占用生成名额
+            if ticket is not None:
+                ticket.release()
             
-            if not image_url or not image_path:
+            if not result:
                 # 生成失败，发送错误消息
                 error_chain = [Plain("图像生成失败，请检查API配置和网络连接。")]
                 yield event.chain_result(error_chain)
                 return
             
-            # 使用 AstrBot 的标准方法返回图片
-            yield event.image_result(image_path)
+            logger.debug(f"图像生成完成，使用密钥 #{result.api_key_index}，耗时: {result.timings}")
+            # 使用 AstrBot 的标准方法返回图片；生成器在消息发送后才会继续执行，据此统计发送耗时
+            delivery_start = time.monotonic()
+            yield await self._image_reply(event, [result])
+            delivery_seconds = time.monotonic() - delivery_start
+            self.metrics.observe("delivery", delivery_seconds)
+            trace.mark("delivery", delivery_start, delivery_seconds)
                 
         except (ConnectionError, TimeoutError) as e:
             logger.error(f"网络连接错误导致图像生成失败: {e}")
@@ -259,3 +800,85 @@ class MyPlugin(Star):
             error_chain = [Plain(f"图像生成失败: {str(e)}")]
             yield event.chain_result(error_chain)
             return
+        finally:
+            if ticket is not None:
+                ticket.release()
+            self.tracer.emit(trace)
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("aiimg状态")
+    async def aiimg_status(self, event: AstrMessageEvent):
+        """查看运行指标以及API密钥与端点的健康与熔断状态"""
+        yield event.chain_result([Plain(self._format_status())])
+
+    def _format_status(self):
+        """生成状态命令的文本"""
+        lines = ["📊 AI图像生成状态", ""]
+        success = self.metrics.counter("generations", outcome="success")
+        failure = self.metrics.counter("generations", outcome="failure") + self.metrics.counter("generations", outcome="error")
+        lines.append(f"请求：成功 {success}，失败 {failure}，"
+                     f"内容拦截 {self.metrics.counter('generations', outcome='blocked')}，"
+                     f"缓存命中 {self.metrics.counter('generations', outcome='cached')}")
+        lines.append(f"进行中：{self.generations_in_flight}（上游 {self.single_flight.in_flight()}，"
+                     f"合并 {self.single_flight.coalesced} 次）")
+        if self.scheduler:
+            scheduler = self.scheduler.stats()
+            rejected = scheduler["rejected"]
+            lines.append(f"调度：进行中 {scheduler['in_flight']}，排队 {scheduler['queued']}，"
+                         f"限流拒绝 {rejected['user_rate'] + rejected['group_rate']}，"
+                         f"队列满拒绝 {rejected['queue_full']}")
+        if self.result_cache:
+            cache = self.result_cache.stats()
+            lines.append(f"结果缓存：命中率 {cache['hit_rate']:.0%}，{cache['entries']} 个文件，"
+                         f"{cache['bytes'] / 1024 / 1024:.1f} MB")
+        fetch = self.reference_fetcher.stats()
+        lines.append(f"参考图片：缓存命中 {fetch['hits']}，重新验证 {fetch['revalidated']}，下载 {fetch['downloads']}，"
+                     f"下载失败改用组件转换 {fetch['fallbacks']}")
+        nap = self.nap_client.stats()
+        if nap["files"]:
+            lines.append(f"NAP传输：{nap['files']} 个文件，{nap['bytes'] / 1024 / 1024:.1f} MB，"
+                         f"连接 {nap['connections']} 个（累计建立 {nap['opened']} 个）")
+        if self.transcoder.transcoded:
+            lines.append(f"输出转码：{self.transcoder.transcoded} 张，节省 "
+                         f"{self.transcoder.bytes_saved / 1024 / 1024:.1f} MB")
+        if nap["dedup_hits"]:
+            lines.append(f"NAP去重：命中 {nap['dedup_hits']} 次，节省 {nap['bytes_saved'] / 1024 / 1024:.1f} MB")
+
+        phases = self.metrics.phase_summary()
+        if phases:
+            lines += ["", "阶段耗时（最近15分钟 p50 / p95 / p99）："]
+            for phase, label in PHASE_LABELS.items():
+                if phase in phases:
+                    summary = phases[phase]
+                    lines.append(f"• {label}: {_format_seconds(summary['p50'])} / {_format_seconds(summary['p95'])} / "
+                                 f"{_format_seconds(summary['p99'])}（{summary['count']} 次）")
+
+        lines += ["", "API端点："]
+        for endpoint in self.endpoint_router.snapshot():
+            breaker = endpoint["breaker"]
+            latency = f"{endpoint['ewma_latency']:.1f}s" if endpoint["ewma_latency"] is not None else "-"
+            line = (f"• #{endpoint['index']} {endpoint['host']} [{STATE_LABELS[breaker['state']]}] "
+                    f"延迟 {latency}，错误率 {endpoint['error_rate']:.0%}，进行中 {endpoint['in_flight']}")
+            if breaker["retry_in"]:
+                line += f"，{breaker['retry_in']:.0f} 秒后探测"
+            lines.append(line)
+
+        lines += ["", "API密钥："]
+        for key in self.key_pool.snapshot():
+            breaker = key["breaker"]
+            line = (f"• #{key['index']} [{STATE_LABELS[breaker['state']]}] "
+                    f"24h请求 {key['requests_24h']}，错误率 {key['error_rate']:.0%}，进行中 {key['in_flight']}，"
+                    f"累计 {key['requests_total']} 次 / 限流 {key['rate_limited_total']} / 错误 {key['errors_total']}")
+            if key["cooldown"]:
+                line += f"，冷却 {key['cooldown']:.0f} 秒"
+            if breaker["retry_in"]:
+                line += f"，{breaker['retry_in']:.0f} 秒后探测"
+            lines.append(line)
+        if not self.key_pool.keys:
+            lines.append("• 未配置")
+        return "\n".join(lines)
+
+
+def _format_seconds(seconds):
+    """格式化耗时，小于1秒时使用毫秒"""
+    return f"{seconds * 1000:.0f}ms" if seconds < 1 else f"{seconds:.1f}s"
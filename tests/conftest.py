@@ -0,0 +1,12 @@
+"""
+测试公共设置
+
+插件目录本身就是 AstrBot 加载的包，utils 下的模块之间使用相对导入，测试以 utils 为顶层包导入，
+因此把插件目录加入 sys.path。运行测试需要与插件相同的环境（已安装 AstrBot、aiohttp 与 Pillow）：
+
+    python -m pytest -q tests
+"""
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,92 @@
+import time
+
+from utils.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from utils.endpoint_router import EndpointRouter
+from utils.key_pool import ApiKeyPool
+
+
+def later(seconds):
+    return time.monotonic() + seconds
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=3, open_seconds=30)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    assert 29 < breaker.retry_in() <= 30
+
+
+def test_success_resets_consecutive_failures():
+    breaker = CircuitBreaker("test", failure_threshold=3)
+    for _ in range(10):
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+    assert breaker.state == CLOSED
+
+
+def test_opens_on_timeout_ratio():
+    breaker = CircuitBreaker("test", failure_threshold=100, timeout_rate=0.5, min_requests=4)
+    breaker.record_success()
+    breaker.record_success()
+    breaker.record_failure(timeout=True)
+    assert breaker.state == CLOSED               # 样本不足
+    breaker.record_failure(timeout=True)
+    assert breaker.state == OPEN
+
+
+def test_half_open_allows_limited_probes_and_closes_on_success():
+    breaker = CircuitBreaker("test", failure_threshold=1, open_seconds=10, half_open_probes=1)
+    breaker.record_failure()
+    now = later(11)
+    assert breaker.available(now)
+    assert breaker.state == HALF_OPEN
+    assert breaker.allow(now)
+    assert not breaker.allow(now)                 # 探测名额已被占用
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_failed_probe_reopens_with_doubled_cooldown():
+    breaker = CircuitBreaker("test", failure_threshold=1, open_seconds=10, max_open_seconds=15)
+    breaker.record_failure()
+    assert breaker.allow(later(11))
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert 14 < breaker.retry_in() <= 15         # 10 * 2，不超过上限
+    assert breaker.opened_count == 2
+
+
+def test_cancelled_probe_returns_its_slot():
+    breaker = CircuitBreaker("test", failure_threshold=1, open_seconds=10)
+    breaker.record_failure()
+    now = later(11)
+    assert breaker.allow(now)
+    breaker.record_cancel()
+    assert breaker.allow(now)
+
+
+def test_key_pool_skips_keys_with_open_breakers():
+    pool = ApiKeyPool(["a", "b"], failure_threshold=2, breaker_open_seconds=60)
+    for _ in range(2):
+        lease = pool.acquire(exclude={2})
+        assert lease.index == 1
+        pool.release(lease, status=500)
+    for _ in range(3):
+        lease = pool.acquire()
+        assert lease.index == 2
+        pool.release(lease, status=200)
+
+
+def test_endpoint_router_returns_none_when_every_endpoint_is_open():
+    router = EndpointRouter(["http://a.example", "http://b.example"], failure_threshold=1, breaker_open_seconds=60)
+    for _ in range(2):
+        endpoint = router.acquire()
+        router.release(endpoint, failed=True)
+    assert router.acquire() is None
+    assert 59 < router.next_available_in() <= 60
@@ -0,0 +1,76 @@
+"""大量并发生成请求互不干扰：每个调用方拿到的都是自己那次请求的图像"""
+import asyncio
+import base64
+import functools
+import json
+import random
+
+import aiohttp
+from aiohttp import web
+
+from utils.key_pool import ApiKeyPool
+from utils.stream_decoder import FileImageSink
+from utils.ttp import generate_image_openrouter
+
+CONCURRENT_REQUESTS = 300
+
+
+def image_bytes(request_no):
+    """每个请求独有的图像内容，大小也各不相同，便于发现错位或截断"""
+    return f"image-{request_no}|".encode() * (50 + request_no % 97)
+
+
+async def handle_completions(request):
+    body = await request.json()
+    prompt = body["messages"][0]["content"]
+    request_no = int(prompt.rsplit("#", 1)[1])
+    # 打乱完成顺序，让请求在事件循环中充分交错
+    await asyncio.sleep(random.uniform(0, 0.02))
+    data = base64.b64encode(image_bytes(request_no)).decode()
+    payload = {"choices": [{"message": {
+        "content": "",
+        "images": [{"type": "image_url", "image_url": {"url": f"data:image/png;base64,{data}"}}],
+    }}]}
+    response = web.StreamResponse(headers={"Content-Type": "application/json"})
+    await response.prepare(request)
+    raw = json.dumps(payload).encode()
+    # 分成小块发送，使 data URI 跨越多次读取
+    for start in range(0, len(raw), 777):
+        await response.write(raw[start:start + 777])
+    await response.write_eof()
+    return response
+
+
+def test_concurrent_generations_return_their_own_images(tmp_path):
+    async def scenario():
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", handle_completions)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        try:
+            key_pool = ApiKeyPool([f"key-{i}" for i in range(4)])
+            sink_factory = functools.partial(FileImageSink, images_dir=tmp_path)
+            async with aiohttp.ClientSession() as session:
+                results = await asyncio.gather(*(
+                    generate_image_openrouter(
+                        f"picture #{request_no}", key_pool, api_base=f"http://127.0.0.1:{port}",
+                        session=session, sink_factory=sink_factory,
+                    )
+                    for request_no in range(CONCURRENT_REQUESTS)
+                ))
+        finally:
+            await runner.cleanup()
+        return results
+
+    results = asyncio.run(scenario())
+
+    assert all(result is not None for result in results)
+    assert len({result.image_path for result in results}) == CONCURRENT_REQUESTS
+    for request_no, result in enumerate(results):
+        with open(result.image_path, "rb") as f:
+            assert f.read() == image_bytes(request_no)
+        assert result.size == len(image_bytes(request_no))
+    assert len(list(tmp_path.iterdir())) == CONCURRENT_REQUESTS
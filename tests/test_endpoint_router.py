@@ -0,0 +1,115 @@
+import time
+
+import pytest
+
+from utils.circuit_breaker import CLOSED, OPEN
+from utils.endpoint_router import OPENROUTER_API_BASE, EndpointRouter
+
+A = "http://a.example"
+B = "http://b.example"
+
+
+def sample(router, index, latency, failed=False):
+    """在指定端点上完成一次请求"""
+    endpoint = router.acquire(exclude={state.index for state in router.endpoints if state.index != index})
+    assert endpoint.index == index
+    router.release(endpoint, latency=None if failed else latency, failed=failed)
+    return endpoint
+
+
+def test_bases_are_normalized_and_default_to_openrouter():
+    router = EndpointRouter([f"{A}/", A, " ", B])
+    assert [state.api_base for state in router.endpoints] == [A, B]
+    assert router.endpoints[0].url == f"{A}/v1/chat/completions"
+    assert [state.api_base for state in EndpointRouter([]).endpoints] == [OPENROUTER_API_BASE]
+
+
+def test_ewma_latency():
+    router = EndpointRouter([A], alpha=0.5)
+    sample(router, 1, 2.0)
+    assert router.endpoints[0].ewma_latency == 2.0
+    sample(router, 1, 4.0)
+    assert router.endpoints[0].ewma_latency == pytest.approx(3.0)
+
+
+def test_prefers_the_faster_endpoint():
+    router = EndpointRouter([A, B])
+    sample(router, 1, 3.0)
+    sample(router, 2, 1.0)
+    for _ in range(3):
+        endpoint = router.acquire()
+        assert endpoint.index == 2
+        router.release(endpoint, latency=1.0)
+
+
+def test_in_flight_requests_spread_load():
+    router = EndpointRouter([A, B])
+    sample(router, 1, 1.0)
+    sample(router, 2, 1.5)
+    first = router.acquire()
+    second = router.acquire()
+    # A 有一个进行中的请求后预期耗时为 2.0，超过 B 的 1.5
+    assert (first.index, second.index) == (1, 2)
+    assert router.acquire().index == 1           # 2.0 < 1.5 * 2
+
+
+def test_error_rate_lowers_the_score():
+    router = EndpointRouter([A, B], failure_threshold=100)
+    sample(router, 1, 1.0)
+    sample(router, 2, 1.5)
+    for _ in range(3):
+        sample(router, 1, None, failed=True)
+    # A 的成功率为 25%，预期耗时 1.0 / 0.25 = 4.0
+    assert router.acquire().index == 2
+
+
+def test_failover_excludes_failed_endpoints_until_none_are_left():
+    router = EndpointRouter([A, B], failure_threshold=100)
+    first = router.acquire()
+    router.release(first, failed=True)
+    second = router.acquire(exclude={first.index})
+    assert second.index != first.index
+    assert not router.untried({first.index, second.index})
+    router.release(second, failed=True)
+    # 全部失败过时仍从未熔断的端点中选择
+    assert router.acquire(exclude={1, 2}) is not None
+
+
+def test_endpoint_recovers_after_successful_probe():
+    router = EndpointRouter([A, B], failure_threshold=1, breaker_open_seconds=0.05)
+    sample(router, 2, 1.0)
+    sample(router, 1, None, failed=True)
+    endpoint = router.endpoints[0]
+    assert endpoint.breaker.state == OPEN
+    assert router.acquire(exclude={2}).index == 2   # A 熔断中，只能使用 B
+    router.release(router.endpoints[1], latency=1.0)
+    time.sleep(0.06)
+
+    probe = router.acquire(exclude={2})
+    assert probe is endpoint
+    router.release(probe, latency=0.5)
+    assert endpoint.breaker.state == CLOSED
+    assert router.acquire().index == 1
+
+
+def test_idle_endpoint_is_estimated_at_the_average_latency():
+    router = EndpointRouter([A, B], probe_interval=60)
+    sample(router, 1, 1.0)
+    sample(router, 2, 5.0)
+    assert router.acquire().index == 1
+    router.release(router.endpoints[0], latency=1.0)
+    # B 长时间未使用，按平均延迟 (1.0 + 5.0) / 2 = 3.0 估计，A 忙碌时重新得到流量
+    router.endpoints[1].last_used -= 61
+    busy = [router.acquire() for _ in range(2)]
+    assert [endpoint.index for endpoint in busy] == [1, 1]
+    assert router.acquire().index == 2
+
+
+def test_cancelled_requests_are_not_recorded():
+    router = EndpointRouter([A], failure_threshold=1)
+    endpoint = router.acquire()
+    router.release(endpoint, latency=9.0, cancelled=True)
+    snapshot = router.snapshot()[0]
+    assert snapshot["in_flight"] == 0 and snapshot["failures"] == 0
+    assert snapshot["ewma_latency"] is None and snapshot["error_rate"] == 0
+    assert endpoint.breaker.state == CLOSED
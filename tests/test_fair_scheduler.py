@@ -0,0 +1,188 @@
+import asyncio
+
+import pytest
+
+from utils import fair_scheduler
+from utils.fair_scheduler import FairScheduler, SchedulerRejected, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(fair_scheduler.time, "monotonic", fake)
+    return fake
+
+
+def unlimited(**kwargs):
+    """不限流的调度器，只测试排队"""
+    kwargs.setdefault("user_rate_per_minute", 0)
+    kwargs.setdefault("group_rate_per_minute", 0)
+    return FairScheduler(**kwargs)
+
+
+def test_token_bucket_charges_full_cost_and_refills(clock):
+    bucket = TokenBucket(rate_per_minute=60, burst=3)
+    assert bucket.available(3)
+    bucket.take(3)
+    assert bucket.tokens == 0
+    assert not bucket.available(1)
+    assert bucket.wait_time(2) == pytest.approx(2.0)
+    clock.now += 2
+    assert bucket.available(2) and not bucket.available(3)
+    # 超过容量的 cost 永远无法满足
+    clock.now += 60
+    assert not bucket.available(4)
+    assert bucket.wait_time(4) == float("inf")
+
+
+def test_charge_rejects_cost_over_burst_without_taking_tokens(clock):
+    async def run():
+        scheduler = FairScheduler(user_rate_per_minute=6, user_burst=3, group_rate_per_minute=20, group_burst=10)
+        assert scheduler.max_cost() == 3
+        with pytest.raises(SchedulerRejected) as raised:
+            scheduler.submit("u", "g", cost=4)
+        # 被拒绝的请求不扣除令牌，之后按容量请求仍然可以通过
+        scheduler.submit("u", "g", cost=3).release()
+        return scheduler, raised.value
+
+    scheduler, error = asyncio.run(run())
+    assert error.reason == "too_large"
+    assert scheduler.rejected["too_large"] == 1
+    assert FairScheduler(user_rate_per_minute=0, group_rate_per_minute=0).max_cost() is None
+
+
+def test_batch_charge_consumes_every_token(clock):
+    scheduler = FairScheduler(user_rate_per_minute=6, user_burst=5, group_rate_per_minute=0)
+    scheduler.charge("u", "g", cost=5)
+    with pytest.raises(SchedulerRejected) as raised:
+        scheduler.charge("u", "g", cost=1)
+    assert raised.value.reason == "user_rate"
+    assert raised.value.retry_after == pytest.approx(10.0)
+
+
+def test_group_bucket_is_shared_by_users(clock):
+    scheduler = FairScheduler(user_rate_per_minute=6, user_burst=3, group_rate_per_minute=6, group_burst=3)
+    for user in ("a", "b", "c"):
+        scheduler.charge(user, "g")
+    with pytest.raises(SchedulerRejected) as raised:
+        scheduler.charge("d", "g")
+    assert raised.value.reason == "group_rate"
+    scheduler.charge("d", "other")
+
+
+def test_wfq_interleaves_groups_by_weight():
+    async def run():
+        scheduler = unlimited(max_in_flight=1, max_queue=20, max_queue_per_group=10, group_weights={"heavy": 2})
+        running = scheduler.submit("u", "x")
+        tickets = [(group, scheduler.submit("u", group)) for group in ["flood"] * 4 + ["heavy"] * 4]
+        order = []
+        running.release()
+        while len(order) < len(tickets):
+            admitted = next((group, ticket) for group, ticket in tickets
+                            if ticket.admitted and not ticket.released)
+            order.append(admitted[0])
+            admitted[1].release()
+        return order
+
+    order = asyncio.run(run())
+    # 权重为2的群每轮得到两倍的份额，刷屏的群不会阻塞其他群
+    assert order[:3].count("heavy") == 2
+    assert order[:6].count("heavy") == 4
+
+
+def test_position_and_wait():
+    async def run():
+        scheduler = unlimited(max_in_flight=1)
+        first = scheduler.submit("u", "a")
+        second = scheduler.submit("u", "b")
+        third = scheduler.submit("u", "c")
+        assert (first.position, second.position, third.position) == (0, 1, 2)
+        waiter = asyncio.create_task(second.wait())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        first.release()
+        await asyncio.wait_for(waiter, 1)
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+    assert stats == {"in_flight": 1, "queued": 1, "rejected": {"user_rate": 0, "group_rate": 0,
+                                                                 "too_large": 0, "queue_full": 0}}
+
+
+def test_queue_is_shed_per_group_and_in_total():
+    async def run():
+        scheduler = unlimited(max_in_flight=1, max_queue=3, max_queue_per_group=2)
+        scheduler.submit("u", "a")
+        scheduler.submit("u", "a")
+        scheduler.submit("u", "a")
+        with pytest.raises(SchedulerRejected) as per_group:
+            scheduler.submit("u", "a")
+        scheduler.submit("u", "b")
+        with pytest.raises(SchedulerRejected) as total:
+            scheduler.submit("u", "c")
+        return scheduler, per_group.value, total.value
+
+    scheduler, per_group, total = asyncio.run(run())
+    assert per_group.reason == total.reason == "queue_full"
+    assert scheduler.rejected["queue_full"] == 2
+
+
+def test_cancelled_ticket_leaves_queue_and_frees_slot():
+    async def run():
+        scheduler = unlimited(max_in_flight=1)
+        running = scheduler.submit("u", "a")
+        abandoned = scheduler.submit("u", "b")
+        waiting = scheduler.submit("u", "c")
+        abandoned.release()
+        abandoned.release()               # 重复释放无副作用
+        assert scheduler.stats()["queued"] == 1
+        running.release()
+        return scheduler, abandoned, waiting
+
+    scheduler, abandoned, waiting = asyncio.run(run())
+    assert not abandoned.admitted
+    assert waiting.admitted
+    assert scheduler.in_flight == 1 and scheduler.stats()["queued"] == 0
+
+
+def test_cost_counts_against_concurrency():
+    async def run():
+        scheduler = unlimited(max_in_flight=4)
+        variants = scheduler.submit("u", "a", cost=3)
+        queued = scheduler.submit("u", "b", cost=2)
+        assert not queued.admitted
+        variants.release()
+        return scheduler, queued
+
+    scheduler, queued = asyncio.run(run())
+    assert queued.admitted and scheduler.in_flight == 2
+
+
+def test_acquire_waits_for_tokens_instead_of_rejecting():
+    async def run():
+        # 每 50ms 补充一个令牌
+        scheduler = FairScheduler(user_rate_per_minute=1200, user_burst=1, group_rate_per_minute=0)
+        scheduler.charge("u", "g")
+        with pytest.raises(SchedulerRejected):
+            scheduler.charge("u", "g")
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.gather(scheduler.acquire("u", "g"), scheduler.acquire("u", "g"))
+        elapsed = loop.time() - start
+        with pytest.raises(SchedulerRejected) as raised:
+            await scheduler.acquire("u", "g", cost=2)
+        return scheduler, elapsed, raised.value
+
+    scheduler, elapsed, error = asyncio.run(run())
+    assert elapsed >= 0.09
+    assert error.reason == "too_large"
+    # 等待中的 acquire 不计入限流拒绝次数
+    assert scheduler.rejected["user_rate"] == 1
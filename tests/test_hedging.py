@@ -0,0 +1,93 @@
+import asyncio
+import base64
+import functools
+
+import aiohttp
+from aiohttp import web
+
+from utils.endpoint_router import EndpointRouter
+from utils.hedging import HedgePolicy
+from utils.key_pool import ApiKeyPool
+from utils.stream_decoder import FileImageSink
+from utils.ttp import generate_image_openrouter
+
+
+def test_quota_is_only_consumed_by_try_acquire():
+    hedge = HedgePolicy(max_per_minute=2)
+    assert hedge.available() and hedge.available()
+    assert hedge.try_acquire() and hedge.try_acquire()
+    assert not hedge.available()
+    assert not hedge.try_acquire()
+    assert hedge.hedged == 2
+
+
+def test_delay_uses_p90_of_samples():
+    hedge = HedgePolicy(delay_seconds=1, min_samples=10)
+    for seconds in range(1, 10):
+        hedge.observe(seconds)
+    assert hedge.delay() == 1                  # 样本不足时使用固定阈值
+    hedge.observe(10)
+    assert hedge.delay() == 10
+
+
+def run_against_mock(behavior, scenario):
+    """behavior: 密钥 -> 响应前的等待秒数；每个密钥返回以自身命名的图像"""
+    seen = []
+
+    async def handle(request):
+        key = request.headers["Authorization"].split()[1]
+        seen.append(key)
+        await asyncio.sleep(behavior[key])
+        data = base64.b64encode(key.encode() * 8).decode()
+        return web.json_response({"choices": [{"message": {
+            "content": "", "images": [{"image_url": {"url": f"data:image/png;base64,{data}"}}],
+        }}]})
+
+    async def run():
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        try:
+            async with aiohttp.ClientSession() as session:
+                return await scenario(f"http://127.0.0.1:{runner.addresses[0][1]}", session)
+        finally:
+            await runner.cleanup()
+
+    return asyncio.run(run()), seen
+
+
+def test_hedge_wins_and_loser_latency_is_sampled(tmp_path):
+    hedge = HedgePolicy(delay_seconds=0.1, use_p90=False)
+    sink = functools.partial(FileImageSink, images_dir=tmp_path)
+
+    async def scenario(base, session):
+        return await generate_image_openrouter("p", ApiKeyPool(["slow", "fast"]), api_base=base, session=session,
+                                               hedge=hedge, sink_factory=sink)
+
+    result, seen = run_against_mock({"slow": 1.0, "fast": 0.0}, scenario)
+    assert seen == ["slow", "fast"]
+    with open(result.image_path, "rb") as f:
+        assert f.read().startswith(b"fast")
+    assert hedge.stats()["wins"] == 1
+    # 胜出的对冲请求与被取消的主请求各一个样本，主请求的样本不短于对冲阈值
+    assert len(hedge._samples) == 2
+    assert max(hedge._samples) >= 0.1
+    assert list(tmp_path.iterdir()) == [tmp_path / result.image_path.rsplit("/", 1)[-1]]
+
+
+def test_hedge_never_reuses_the_primary_key(tmp_path):
+    hedge = HedgePolicy(delay_seconds=0.05, use_p90=False)
+    sink = functools.partial(FileImageSink, images_dir=tmp_path)
+
+    async def scenario(base, session):
+        router = EndpointRouter([base, base + "/"])
+        return await generate_image_openrouter("p", ApiKeyPool(["only"]), session=session, hedge=hedge,
+                                               endpoints=router, sink_factory=sink)
+
+    result, seen = run_against_mock({"only": 0.3}, scenario)
+    assert result is not None
+    assert seen == ["only"]
+    assert hedge.hedged == 0
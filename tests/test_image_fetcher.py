@@ -0,0 +1,219 @@
+"""参考图片下载器的测试，使用本地 aiohttp 服务端模拟图片来源"""
+import asyncio
+import base64
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from utils.image_fetcher import ImageFetchError, ImageTooLargeError, ReferenceImageFetcher
+
+LAST_MODIFIED = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+
+class ImageOrigin:
+    """图片来源服务端：按名称返回内容，支持 ETag / Last-Modified 条件请求"""
+
+    def __init__(self):
+        self.images = {}
+        self.requests = []        # (名称, If-None-Match, If-Modified-Since, 状态码)
+        self.runner = None
+        self.base = None
+
+    def put(self, name, data, etag=None):
+        self.images[name] = (data, etag or f'"{name}-{len(data)}"')
+
+    async def handle(self, request):
+        name = request.match_info["name"]
+        if_none_match = request.headers.get("If-None-Match")
+        if_modified_since = request.headers.get("If-Modified-Since")
+        if name == "slow":
+            await asyncio.sleep(0.05)
+            name = "a"
+        if name == "streamed":
+            self.requests.append((name, if_none_match, if_modified_since, 200))
+            response = web.StreamResponse()
+            await response.prepare(request)
+            for _ in range(10):
+                await response.write(b"x" * 1024)
+            await response.write_eof()
+            return response
+        if name not in self.images:
+            self.requests.append((name, if_none_match, if_modified_since, 404))
+            raise web.HTTPNotFound()
+        data, etag = self.images[name]
+        if if_none_match == etag:
+            self.requests.append((name, if_none_match, if_modified_since, 304))
+            return web.Response(status=304, headers={"ETag": etag})
+        self.requests.append((name, if_none_match, if_modified_since, 200))
+        return web.Response(body=data, headers={"ETag": etag, "Last-Modified": LAST_MODIFIED})
+
+    async def __aenter__(self):
+        app = web.Application()
+        app.router.add_get("/{name}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.base = f"http://127.0.0.1:{self.runner.addresses[0][1]}"
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.runner.cleanup()
+
+    def url(self, name):
+        return f"{self.base}/{name}"
+
+    def downloads(self, name):
+        return sum(1 for item in self.requests if item[0] == name and item[3] == 200)
+
+
+class FakeImage:
+    """消息中的图片组件"""
+
+    def __init__(self, url):
+        self.url = url
+        self.converted = 0
+
+    async def convert_to_base64(self):
+        self.converted += 1
+        return "Y29tcG9uZW50"
+
+
+def run_with_fetcher(tmp_path, scenario, **options):
+    async def run():
+        async with ImageOrigin() as origin, aiohttp.ClientSession() as session:
+            fetcher = ReferenceImageFetcher(lambda: session, tmp_path / "cache", **options)
+            try:
+                return await scenario(origin, fetcher)
+            finally:
+                await fetcher.close()
+
+    return asyncio.run(run())
+
+
+def test_fresh_entries_skip_the_network(tmp_path):
+    async def scenario(origin, fetcher):
+        origin.put("a", b"A" * 100)
+        first = await fetcher.fetch(origin.url("a"))
+        second = await fetcher.fetch(origin.url("a"))
+        return origin, fetcher, first, second
+
+    origin, fetcher, first, second = run_with_fetcher(tmp_path, scenario, fresh_seconds=600)
+    assert first == second == b"A" * 100
+    assert len(origin.requests) == 1
+    assert fetcher.stats()["hits"] == 1 and fetcher.stats()["downloads"] == 1
+
+
+def test_stale_entries_are_revalidated_with_conditional_headers(tmp_path):
+    async def scenario(origin, fetcher):
+        origin.put("a", b"A" * 100)
+        await fetcher.fetch(origin.url("a"))
+        unchanged = await fetcher.fetch(origin.url("a"))
+        origin.put("a", b"B" * 80, etag='"changed"')
+        changed = await fetcher.fetch(origin.url("a"))
+        return origin, fetcher, unchanged, changed
+
+    origin, fetcher, unchanged, changed = run_with_fetcher(tmp_path, scenario, fresh_seconds=0)
+    assert unchanged == b"A" * 100
+    assert changed == b"B" * 80
+    etag = '"a-100"'
+    assert origin.requests == [
+        ("a", None, None, 200),
+        ("a", etag, LAST_MODIFIED, 304),
+        ("a", etag, LAST_MODIFIED, 200),
+    ]
+    stats = fetcher.stats()
+    assert stats["revalidated"] == 1 and stats["downloads"] == 2
+
+
+def test_download_size_cap(tmp_path):
+    async def scenario(origin, fetcher):
+        origin.put("big", b"B" * 5000)
+        errors = []
+        for name in ("big", "streamed"):
+            with pytest.raises(ImageTooLargeError) as raised:
+                await fetcher.fetch(origin.url(name))
+            errors.append(raised.value)
+        # 超过大小限制时不退回组件转换
+        component = FakeImage(origin.url("big"))
+        with pytest.raises(ImageTooLargeError):
+            await fetcher.fetch_base64(component)
+        return fetcher, component, errors
+
+    fetcher, component, errors = run_with_fetcher(tmp_path, scenario, max_download_bytes=4096)
+    assert "5000" in str(errors[0])              # 由 Content-Length 提前判断
+    assert "4096" in str(errors[1])              # 流式读取中途超过上限
+    assert component.converted == 0
+    assert fetcher.stats()["downloads"] == 0
+
+
+def test_memory_cache_evicts_least_recently_used(tmp_path):
+    async def scenario(origin, fetcher):
+        for name in "abc":
+            origin.put(name, name.encode() * 100)
+        await fetcher.fetch(origin.url("a"))
+        await fetcher.fetch(origin.url("b"))
+        await fetcher.fetch(origin.url("a"))         # a 最近使用过，b 成为最久未使用的项
+        await fetcher.fetch(origin.url("c"))
+        in_memory = set(fetcher._blobs.values())
+        # 被淘汰的内容从磁盘缓存读取，不重新下载
+        evicted = await fetcher.fetch(origin.url("b"))
+        return origin, fetcher, in_memory, evicted
+
+    origin, fetcher, in_memory, evicted = run_with_fetcher(tmp_path, scenario, memory_bytes=250)
+    assert in_memory == {b"a" * 100, b"c" * 100}
+    assert evicted == b"b" * 100
+    assert origin.downloads("b") == 1
+    assert fetcher.stats()["memory_bytes"] <= 250
+
+
+def test_fetch_errors_fall_back_to_component_conversion(tmp_path):
+    async def scenario(origin, fetcher):
+        missing = FakeImage(origin.url("missing"))
+        local = FakeImage("/tmp/local.png")
+        results = [await fetcher.fetch_base64(missing), await fetcher.fetch_base64(local)]
+        with pytest.raises(ImageFetchError):
+            await fetcher.fetch(origin.url("missing"))
+        return fetcher, missing, local, results
+
+    fetcher, missing, local, results = run_with_fetcher(tmp_path, scenario)
+    assert results == ["Y29tcG9uZW50", "Y29tcG9uZW50"]
+    assert missing.converted == local.converted == 1
+    # 只有下载失败才计入退回次数，非 HTTP 来源本来就使用组件转换
+    assert fetcher.stats()["fallbacks"] == 1
+
+
+def test_fetch_base64_encodes_downloaded_bytes(tmp_path):
+    async def scenario(origin, fetcher):
+        origin.put("a", b"\x89PNG data")
+        return await fetcher.fetch_base64(FakeImage(origin.url("a")))
+
+    assert base64.b64decode(run_with_fetcher(tmp_path, scenario)) == b"\x89PNG data"
+
+
+def test_concurrent_fetches_download_once(tmp_path):
+    async def scenario(origin, fetcher):
+        origin.put("a", b"A" * 100)
+        results = await asyncio.gather(*(fetcher.fetch(origin.url("slow"), key="slow") for _ in range(5)))
+        return origin, results
+
+    origin, results = run_with_fetcher(tmp_path, scenario)
+    assert results == [b"A" * 100] * 5
+    assert len(origin.requests) == 1
+
+
+def test_index_persists_across_instances(tmp_path):
+    async def first(origin, fetcher):
+        origin.put("a", b"A" * 100)
+        await fetcher.fetch(origin.url("a"), key="file-a")
+
+    run_with_fetcher(tmp_path, first)
+
+    async def second(origin, fetcher):
+        # 新的服务端上没有该图片，只能来自磁盘缓存
+        return await fetcher.fetch(origin.url("a"), key="file-a"), origin
+
+    data, origin = run_with_fetcher(tmp_path, second)
+    assert data == b"A" * 100
+    assert origin.requests == []
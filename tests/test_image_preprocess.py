@@ -0,0 +1,99 @@
+import asyncio
+import base64
+import io
+
+import pytest
+
+PIL = pytest.importorskip("PIL")
+from PIL import Image as PILImage  # noqa: E402
+
+from utils.image_preprocess import (  # noqa: E402
+    ReferenceImagePreprocessor, preprocess_image_bytes, sniff_base64_mime, sniff_image_mime,
+)
+
+
+def encode(image, pil_format, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, format=pil_format, **options)
+    return buffer.getvalue()
+
+
+def noise(size):
+    return PILImage.effect_noise(size, 64).convert("RGB")
+
+
+def data_uri(data, mime):
+    return f"data:{mime};base64,{base64.b64encode(data).decode()}"
+
+
+def decode_uri(uri):
+    header, _, data = uri.partition(",")
+    return header[5:].split(";")[0], base64.b64decode(data)
+
+
+def process(image, **options):
+    preprocessor = ReferenceImagePreprocessor(**options)
+    try:
+        return asyncio.run(preprocessor.process(image))
+    finally:
+        preprocessor.close()
+
+
+def test_sniff_formats():
+    assert sniff_image_mime(encode(PILImage.new("RGB", (4, 4)), "PNG")) == "image/png"
+    assert sniff_image_mime(encode(PILImage.new("RGB", (4, 4)), "JPEG")) == "image/jpeg"
+    assert sniff_image_mime(encode(PILImage.new("RGB", (4, 4)), "WEBP")) == "image/webp"
+    assert sniff_image_mime(b"not an image") is None
+    assert sniff_base64_mime(base64.b64encode(b"GIF89a....").decode()) == "image/gif"
+    assert sniff_base64_mime("!!!") is None
+
+
+def test_large_image_is_resized_to_max_edge():
+    data = encode(noise((1200, 600)), "PNG")
+    output, mime = preprocess_image_bytes(data, max_edge=300, output_format="jpeg")
+    assert mime == "image/jpeg"
+    with PILImage.open(io.BytesIO(output)) as image:
+        assert image.size == (300, 150)
+
+
+def test_small_image_is_passed_through_unchanged():
+    data = encode(noise((64, 64)), "PNG")
+    assert preprocess_image_bytes(data, max_edge=1536, output_format="jpeg") == (data, "image/png")
+
+
+def test_transparent_image_is_flattened_for_jpeg():
+    data = encode(PILImage.new("RGBA", (800, 800), (255, 0, 0, 0)), "PNG")
+    output, mime = preprocess_image_bytes(data, max_edge=400, output_format="jpeg")
+    with PILImage.open(io.BytesIO(output)) as image:
+        assert image.mode == "RGB"
+        assert image.getpixel((0, 0)) == (255, 255, 255)
+
+
+def test_original_mode_keeps_bytes_and_corrects_mime():
+    jpeg = encode(noise((2000, 100)), "JPEG")
+    mime, data = decode_uri(process(data_uri(jpeg, "image/png"), output_format="original"))
+    # 声明为 PNG 的 JPEG 数据：内容不变，MIME 改为真实格式
+    assert data == jpeg
+    assert mime == "image/jpeg"
+
+
+def test_declared_mime_is_kept_when_format_is_unknown():
+    assert decode_uri(process(data_uri(b"custom bytes", "image/heic"), output_format="original")) == \
+        ("image/heic", b"custom bytes")
+
+
+def test_undecodable_input_falls_back_to_the_original():
+    corrupt = data_uri(b"\x89PNG\r\n\x1a\n" + b"\0" * 64, "image/png")
+    assert process(corrupt, output_format="jpeg") == corrupt
+    invalid_base64 = "data:image/png;base64,@@@"
+    assert process(invalid_base64, output_format="jpeg") == invalid_base64
+
+
+def test_process_all_keeps_order():
+    images = [data_uri(encode(noise((32, 32)), "PNG"), "image/png"), data_uri(b"plain", "image/gif")]
+    preprocessor = ReferenceImagePreprocessor(output_format="original")
+    try:
+        results = asyncio.run(preprocessor.process_all(images))
+    finally:
+        preprocessor.close()
+    assert [decode_uri(result)[0] for result in results] == ["image/png", "image/gif"]
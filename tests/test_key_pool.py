@@ -0,0 +1,127 @@
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from utils.key_pool import ApiKeyPool, _parse_reset, parse_retry_after
+
+
+def cooldown_of(pool, index):
+    return pool.keys[index - 1].cooldown_until - time.monotonic()
+
+
+def test_parse_retry_after_seconds_date_and_missing():
+    assert parse_retry_after({"Retry-After": "12"}) == 12
+    assert parse_retry_after({"Retry-After": "-3"}) == 0
+    date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=90), usegmt=True)
+    assert 85 < parse_retry_after({"Retry-After": date}) <= 90
+    assert parse_retry_after({"Retry-After": "not a date"}) is None
+    assert parse_retry_after({}) is None
+    # 没有 Retry-After 时使用 X-RateLimit-Reset
+    assert parse_retry_after({"X-RateLimit-Reset": "30"}) == 30
+
+
+def test_parse_reset_epochs_and_relative_seconds():
+    now = time.time()
+    assert 58 < _parse_reset(str(int((now + 60) * 1000))) <= 60      # 毫秒时间戳
+    assert 58 < _parse_reset(str(int(now + 60))) <= 60               # 秒时间戳
+    assert _parse_reset("45") == 45                                  # 相对秒数
+    assert _parse_reset(str(int(now - 60))) == 0                     # 已过去的时间
+    assert _parse_reset(None) is None
+    assert _parse_reset("soon") is None
+
+
+def test_429_without_retry_after_uses_default_cooldown():
+    pool = ApiKeyPool(["a", "b"], default_cooldown=60)
+    lease = pool.acquire()
+    pool.release(lease, status=429)
+    assert 59 < cooldown_of(pool, lease.index) <= 60
+    assert pool.acquire().index != lease.index
+    assert pool.keys[lease.index - 1].rate_limited_total == 1
+
+
+def test_429_honours_retry_after():
+    pool = ApiKeyPool(["a"], default_cooldown=60)
+    pool.release(pool.acquire(), status=429, headers={"Retry-After": "5"})
+    assert 4 < cooldown_of(pool, 1) <= 5
+    assert pool.acquire() is None
+    assert 4 < pool.next_available_in() <= 5
+
+
+def test_402_cools_down_for_an_hour():
+    pool = ApiKeyPool(["a"], default_cooldown=60)
+    pool.release(pool.acquire(), status=402)
+    assert 3599 < cooldown_of(pool, 1) <= 3600
+
+
+def test_least_loaded_key_is_selected():
+    pool = ApiKeyPool(["a", "b", "c"])
+    leases = [pool.acquire() for _ in range(3)]
+    assert sorted(lease.index for lease in leases) == [1, 2, 3]
+    pool.release(leases[1], status=200)
+    # 只有 #2 没有进行中的请求
+    assert pool.acquire().index == 2
+
+
+def test_error_rate_breaks_ties():
+    pool = ApiKeyPool(["a", "b"], failure_threshold=100)
+    for _ in range(3):
+        pool.release(pool.acquire(exclude={2}), status=500)
+    assert pool.acquire().index == 2
+
+
+def test_keys_drain_at_rotate_threshold():
+    pool = ApiKeyPool(["a", "b"], daily_request_limit=10, rotate_threshold=0.5)
+    for _ in range(5):
+        pool.release(pool.acquire(exclude={2}), status=200)
+    busy = [pool.acquire(exclude={1}) for _ in range(2)]
+    # #1 已用到阈值，即使 #2 有进行中的请求也优先使用 #2
+    assert pool.acquire().index == 2
+    for lease in busy:
+        pool.release(lease, status=200)
+    # 没有健康密钥时仍然使用接近上限的密钥
+    assert pool.acquire(exclude={2}).index == 1
+    assert pool.snapshot()[0]["usage_ratio"] >= 0.5
+
+
+def test_exhausted_rate_limit_header_expires_after_reset():
+    pool = ApiKeyPool(["a", "b"])
+    lease = pool.acquire(exclude={2})
+    pool.release(lease, status=200, headers={"X-RateLimit-Limit": "100", "X-RateLimit-Remaining": "0",
+                                             "X-RateLimit-Reset": "30"})
+    state = pool.keys[0]
+    assert 29 < state.cooldown_until - time.monotonic() <= 30
+    assert pool.acquire(exclude={2}) is None
+    # 重置时间过后冷却结束，剩余额度不再有效，密钥回到健康状态
+    state.cooldown_until = state.rate_reset_at = time.monotonic() - 1
+    assert pool.snapshot()[0]["usage_ratio"] == 0
+    assert state.rate_remaining is None
+    # #2 有进行中的请求时选择 #1（若 #1 仍被视为接近上限则会选择 #2）
+    assert pool.acquire(exclude={1}).index == 2
+    assert pool.acquire().index == 1
+
+
+def test_rate_limit_header_without_reset_expires_after_default_cooldown():
+    pool = ApiKeyPool(["a"], default_cooldown=60)
+    pool.release(pool.acquire(), status=200, headers={"X-RateLimit-Limit": "10", "X-RateLimit-Remaining": "1"})
+    state = pool.keys[0]
+    assert pool.snapshot()[0]["usage_ratio"] == pytest.approx(0.9)
+    assert 59 < state.rate_reset_at - time.monotonic() <= 60
+
+
+def test_cancelled_release_is_not_an_error():
+    pool = ApiKeyPool(["a"], failure_threshold=1)
+    pool.release(pool.acquire(), cancelled=True)
+    snapshot = pool.snapshot()[0]
+    assert snapshot["error_rate"] == 0 and snapshot["errors_total"] == 0
+    assert snapshot["in_flight"] == 0
+    assert pool.acquire() is not None
+
+
+def test_usage_tokens_are_recorded():
+    pool = ApiKeyPool(["a"], daily_token_limit=1000)
+    pool.release(pool.acquire(), status=200, usage={"total_tokens": 250, "cost": 0.01})
+    state = pool.keys[0]
+    assert state.total_tokens == 250 and state.total_cost == pytest.approx(0.01)
+    assert pool.snapshot()[0]["usage_ratio"] == pytest.approx(0.25)
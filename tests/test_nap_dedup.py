@@ -0,0 +1,112 @@
+"""按内容去重（协议版本3的 LOOKUP）"""
+import asyncio
+import contextlib
+import hashlib
+
+from utils.file_receive_server import FileReceiveServer
+from utils.nap_client import NapFileClient
+from utils.nap_protocol import MAGIC, RESPONSE_HEADER, STATUS_NOT_FOUND, STATUS_OK, encode_hello, encode_lookup
+
+
+@contextlib.asynccontextmanager
+async def session(tmp_path, **client_options):
+    server = FileReceiveServer(tmp_path / "received", host="127.0.0.1", port=0)
+    await server.start()
+    client = NapFileClient("127.0.0.1", server.port, protocol="framed", **client_options)
+    try:
+        yield server, client
+    finally:
+        await client.close()
+        await server.stop()
+
+
+def write(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_repeated_content_is_not_sent_again(tmp_path):
+    first = write(tmp_path / "local" / "a.png", b"same image" * 1000)
+    copy = write(tmp_path / "local" / "b.png", b"same image" * 1000)
+
+    async def run():
+        async with session(tmp_path) as (server, client):
+            paths = [await client.send_file(first), await client.send_file(copy)]
+            return paths, client.stats(), server.files_received, server.dedup_hits
+
+    paths, stats, files_received, server_hits = asyncio.run(run())
+    assert paths[0] == paths[1]
+    assert files_received == 1 and server_hits == 1
+    assert stats["dedup_hits"] == 1 and stats["bytes_saved"] == 10000
+
+
+def test_lookup_miss_when_remote_file_was_deleted_or_changed(tmp_path):
+    local = write(tmp_path / "local" / "a.png", b"content" * 100)
+
+    async def run():
+        async with session(tmp_path) as (server, client):
+            remote = await client.send_file(local)
+            # 接收端的文件被删除后 LOOKUP 未命中，客户端重新发送
+            (tmp_path / "received" / "a.png").unlink()
+            again = await client.send_file(local)
+            # 文件被其他内容覆盖（大小不同）时同样视为不存在
+            with open(again, "wb") as f:
+                f.write(b"other")
+            third = await client.send_file(local)
+            return remote, again, third, server.files_received, client.stats()["dedup_hits"]
+
+    remote, again, third, files_received, hits = asyncio.run(run())
+    assert remote == again == third
+    assert files_received == 3 and hits == 0
+    assert open(third, "rb").read() == b"content" * 100
+
+
+def test_unknown_content_is_sent_without_lookup(tmp_path):
+    paths = [write(tmp_path / "local" / f"{i}.png", bytes([i]) * 100) for i in range(3)]
+
+    async def run():
+        async with session(tmp_path) as (server, client):
+            for path in paths:
+                await client.send_file(path)
+            return server.dedup_hits, client.stats()
+
+    hits, stats = asyncio.run(run())
+    assert hits == 0 and stats["dedup_hits"] == 0 and stats["files"] == 3
+
+
+def test_dedup_disabled_always_sends(tmp_path):
+    local = write(tmp_path / "local" / "a.png", b"x" * 100)
+
+    async def run():
+        async with session(tmp_path, dedup=False) as (server, client):
+            await client.send_file(local)
+            await client.send_file(local)
+            return server.files_received
+
+    assert asyncio.run(run()) == 2
+
+
+def test_streamed_files_are_indexed_by_the_receiver(tmp_path):
+    data = b"streamed" * 500
+
+    async def run():
+        async with session(tmp_path) as (server, client):
+            stream = await client.open_stream("s.png")
+            await stream.write(data[:1000])
+            await stream.write(data[1000:])
+            remote = await stream.finish()
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(encode_hello())
+            await reader.readexactly(len(MAGIC) + 1)
+            responses = []
+            for request_id, digest in ((1, hashlib.sha256(data).digest()), (2, hashlib.sha256(b"nope").digest())):
+                writer.write(encode_lookup(request_id, digest))
+                header = RESPONSE_HEADER.unpack(await reader.readexactly(RESPONSE_HEADER.size))
+                responses.append((header[1], (await reader.readexactly(header[2])).decode()))
+            writer.close()
+            return remote, responses
+
+    remote, responses = asyncio.run(run())
+    assert responses == [(STATUS_OK, remote), (STATUS_NOT_FOUND, "")]
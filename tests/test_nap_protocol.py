@@ -0,0 +1,293 @@
+"""NAP 传输客户端与参考接收端（file_receive_server）之间的协议测试"""
+import asyncio
+import contextlib
+import os
+import struct
+
+from utils.file_receive_server import FileReceiveServer
+from utils.nap_client import NapFileClient
+from utils.nap_protocol import (MAGIC, OP_STREAM_DATA, OP_STREAM_END, OP_STREAM_OPEN, RESPONSE_HEADER, STATUS_ERROR,
+                                STATUS_OK, encode_hello, encode_put, encode_stream_frame)
+
+
+@contextlib.asynccontextmanager
+async def receiver(save_dir):
+    server = FileReceiveServer(save_dir, host="127.0.0.1", port=0)
+    await server.start()
+    try:
+        yield server
+    finally:
+        await server.stop()
+
+
+def make_files(directory, count, size=50_000):
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = directory / f"file_{i}.bin"
+        path.write_bytes(bytes([i % 256]) * (size + i))
+        paths.append(path)
+    return paths
+
+
+async def read_response(reader):
+    request_id, status, length = RESPONSE_HEADER.unpack(await reader.readexactly(RESPONSE_HEADER.size))
+    return request_id, status, (await reader.readexactly(length)).decode("utf-8")
+
+
+def test_handshake_negotiates_version_and_pipelined_responses_keep_order(tmp_path):
+    async def run():
+        async with receiver(tmp_path / "received") as server:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(encode_hello(1))
+            assert await reader.readexactly(len(MAGIC) + 1) == MAGIC + bytes([1])
+            # 两个请求一次写出，不等待第一个响应
+            writer.write(encode_put(7, "a.bin", 3) + b"abc" + encode_put(8, "b.bin", 2) + b"de")
+            await writer.drain()
+            responses = [await read_response(reader), await read_response(reader)]
+            writer.close()
+            return responses
+
+    responses = asyncio.run(run())
+    assert [(request_id, status) for request_id, status, _ in responses] == [(7, STATUS_OK), (8, STATUS_OK)]
+    with open(responses[0][2], "rb") as f:
+        assert f.read() == b"abc"
+    with open(responses[1][2], "rb") as f:
+        assert f.read() == b"de"
+
+
+def test_interleaved_stream_frames(tmp_path):
+    async def run():
+        async with receiver(tmp_path / "received") as server:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(encode_hello())
+            await reader.readexactly(len(MAGIC) + 1)
+            writer.write(b"".join([
+                encode_stream_frame(OP_STREAM_OPEN, 1, b"one.png"),
+                encode_stream_frame(OP_STREAM_OPEN, 2, b"two.png"),
+                encode_stream_frame(OP_STREAM_DATA, 1, b"11"),
+                encode_stream_frame(OP_STREAM_DATA, 2, b"22"),
+                encode_stream_frame(OP_STREAM_DATA, 1, b"11"),
+                encode_stream_frame(OP_STREAM_END, 2),
+                encode_stream_frame(OP_STREAM_END, 1),
+                encode_stream_frame(OP_STREAM_END, 99),
+            ]))
+            await writer.drain()
+            responses = [await read_response(reader) for _ in range(3)]
+            writer.close()
+            return responses
+
+    (first_id, _, second), (second_id, _, first), (unknown_id, status, _) = asyncio.run(run())
+    assert (first_id, second_id) == (2, 1)
+    assert open(first, "rb").read() == b"1111"
+    assert open(second, "rb").read() == b"22"
+    assert (unknown_id, status) == (99, STATUS_ERROR)
+
+
+def test_pipelining_over_pooled_connections(tmp_path):
+    paths = make_files(tmp_path / "local", 24)
+
+    async def run():
+        async with receiver(tmp_path / "received") as server:
+            client = NapFileClient("127.0.0.1", server.port, protocol="framed", max_connections=2, max_pipeline=4)
+            try:
+                remote_paths = await asyncio.gather(*(client.send_file(str(path)) for path in paths))
+                return remote_paths, client.stats(), server.connections
+            finally:
+                await client.close()
+
+    remote_paths, stats, server_connections = asyncio.run(run())
+    for path, remote_path in zip(paths, remote_paths):
+        assert remote_path == str(tmp_path / "received" / path.name)
+        with open(remote_path, "rb") as f:
+            assert f.read() == path.read_bytes()
+    assert stats["files"] == 24
+    assert stats["opened"] == server_connections <= 2
+
+
+def test_connection_is_reused_after_idle_close(tmp_path):
+    path, = make_files(tmp_path / "local", 1)
+
+    async def run():
+        async with receiver(tmp_path / "received") as server:
+            client = NapFileClient("127.0.0.1", server.port, protocol="framed", idle_timeout=0.05, dedup=False)
+            try:
+                first = await client.send_file(str(path))
+                await asyncio.sleep(0.2)
+                second = await client.send_file(str(path))
+                return first, second, client.stats()
+            finally:
+                await client.close()
+
+    first, second, stats = asyncio.run(run())
+    assert first == second
+    assert stats["opened"] == 2 and stats["files"] == 2
+
+
+def test_stream_upload_and_abort_deletes_partial_file(tmp_path):
+    received = tmp_path / "received"
+
+    async def run():
+        async with receiver(received) as server:
+            client = NapFileClient("127.0.0.1", server.port, protocol="framed")
+            try:
+                done = await client.open_stream("complete.png")
+                await done.write(b"x" * 1000)
+                await done.write(b"y" * 10)
+                remote_path = await done.finish()
+
+                partial = await client.open_stream("partial.png")
+                await partial.write(b"z" * 1000)
+                await asyncio.sleep(0.05)
+                existed = (received / "partial.png").exists()
+                await partial.abort()
+                # 中止帧之后的请求完成，说明中止已被处理
+                await (await client.open_stream("after.png")).finish()
+                return remote_path, existed
+            finally:
+                await client.close()
+
+    remote_path, existed = asyncio.run(run())
+    assert open(remote_path, "rb").read() == b"x" * 1000 + b"y" * 10
+    assert existed
+    assert not (received / "partial.png").exists()
+
+
+def test_disconnect_mid_stream_deletes_partial_file(tmp_path):
+    received = tmp_path / "received"
+
+    async def run():
+        async with receiver(received) as server:
+            client = NapFileClient("127.0.0.1", server.port, protocol="framed")
+            stream = await client.open_stream("partial.png")
+            await stream.write(b"z" * 1000)
+            await asyncio.sleep(0.05)
+            existed = (received / "partial.png").exists()
+            await client.close()
+            await asyncio.sleep(0.1)
+            return existed
+
+    assert asyncio.run(run())
+    assert not (received / "partial.png").exists()
+
+
+def test_legacy_protocol_sends_one_file_per_connection(tmp_path):
+    paths = make_files(tmp_path / "local", 3)
+
+    async def run():
+        async with receiver(tmp_path / "received") as server:
+            client = NapFileClient("127.0.0.1", server.port, protocol="legacy")
+            remote_paths = [await client.send_file(str(path)) for path in paths]
+            return remote_paths, server.connections
+
+    remote_paths, connections = asyncio.run(run())
+    assert connections == 3
+    for path, remote_path in zip(paths, remote_paths):
+        assert open(remote_path, "rb").read() == path.read_bytes()
+
+
+def test_framed_client_reports_legacy_only_receiver(tmp_path):
+    """只支持旧协议的接收端把握手当作文件名长度，客户端应失败而不是挂起"""
+    path, = make_files(tmp_path / "local", 1, size=10)
+
+    async def legacy_only(reader, writer):
+        try:
+            name_len = struct.unpack(">I", await reader.readexactly(4))[0]
+            await reader.readexactly(min(name_len, 1))
+        except asyncio.IncompleteReadError:
+            pass
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(legacy_only, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        client = NapFileClient("127.0.0.1", port, protocol="framed", connect_timeout=2)
+        try:
+            return await client.send_file(str(path))
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+
+    assert asyncio.run(run()) is None
+
+
+def test_missing_local_file_does_not_break_the_connection(tmp_path):
+    path, = make_files(tmp_path / "local", 1)
+
+    async def run():
+        async with receiver(tmp_path / "received") as server:
+            client = NapFileClient("127.0.0.1", server.port, protocol="framed")
+            try:
+                missing = await client.send_file(str(tmp_path / "missing.bin"))
+                present = await client.send_file(str(path))
+                return missing, present, client.stats()["opened"]
+            finally:
+                await client.close()
+
+    missing, present, opened = asyncio.run(run())
+    assert missing is None
+    assert present is not None and os.path.exists(present)
+    assert opened == 1
+
+
+def test_delete_only_removes_files_in_the_save_directory(tmp_path):
+    outside = tmp_path / "outside.bin"
+    outside.write_bytes(b"keep me")
+    path, = make_files(tmp_path / "local", 1, size=10)
+
+    async def run():
+        async with receiver(tmp_path / "received") as server:
+            client = NapFileClient("127.0.0.1", server.port, protocol="framed")
+            try:
+                remote = await client.send_file(str(path))
+                results = [
+                    await client.delete(remote),
+                    await client.delete(remote),
+                    await client.delete(str(outside)),
+                    await client.delete(str(tmp_path / "received" / ".." / "outside.bin")),
+                ]
+                # 删除后同样内容不会再命中去重
+                again = await client.send_file(str(path))
+                return remote, again, results, server.files_deleted, server.files_received
+            finally:
+                await client.close()
+
+    remote, again, results, deleted, received = asyncio.run(run())
+    assert results == [True, False, False, False]
+    assert deleted == 1 and received == 2
+    assert remote == again and os.path.exists(again)
+    assert outside.read_bytes() == b"keep me"
+
+
+def test_unkept_streamed_images_are_deleted_on_the_receiver(tmp_path):
+    import base64
+    import json
+
+    from utils.nap_client import NapStreamSink
+    from utils.stream_decoder import StreamingImageExtractor
+
+    received = tmp_path / "received"
+    uris = [f"data:image/png;base64,{base64.b64encode(bytes([i]) * 3000).decode()}" for i in range(3)]
+    body = json.dumps({"images": uris}).encode()
+
+    async def run():
+        async with receiver(received) as server:
+            client = NapFileClient("127.0.0.1", server.port, protocol="framed")
+            try:
+                extractor = StreamingImageExtractor(sink_factory=lambda fmt: NapStreamSink(client, fmt), max_images=3)
+                await extractor.feed(body)
+                await extractor.finish()
+                assert [image.local for image in extractor.images] == [False] * 3
+                assert len(list(received.iterdir())) == 3
+                kept = extractor.images[1]
+                await extractor.abort(keep=[kept])
+                # 删除请求不等待响应，之后的请求完成时删除已被处理（同一连接上按顺序响应）
+                await (await client.open_stream("barrier.png")).finish()
+                return kept
+            finally:
+                await client.close()
+
+    kept = asyncio.run(run())
+    assert sorted(path.name for path in received.iterdir()) == sorted([os.path.basename(kept.location), "barrier.png"])
+    assert open(kept.location, "rb").read() == bytes([1]) * 3000
@@ -0,0 +1,118 @@
+import asyncio
+import base64
+
+import pytest
+
+from utils import reference_images
+from utils.reference_images import ReferenceImageExtractor
+
+
+class FakeImage:
+    """消息中的图片组件，按 url 返回预先设定的 base64 数据"""
+
+    def __init__(self, url, data=None, fail=False):
+        self.url = url
+        self.data = data
+        self.fail = fail
+        self.converted = 0
+
+    async def convert_to_base64(self):
+        self.converted += 1
+        await asyncio.sleep(0)
+        if self.fail:
+            raise IOError("download failed")
+        return self.data
+
+
+class FakeReply:
+    def __init__(self, *chain):
+        self.chain = list(chain)
+
+
+class FakeMessage:
+    def __init__(self, *components):
+        self.message = list(components)
+
+
+class FakeEvent:
+    def __init__(self, *components):
+        self.message_obj = FakeMessage(*components)
+
+
+@pytest.fixture(autouse=True)
+def fake_components(monkeypatch):
+    # 使用不依赖 AstrBot 组件构造参数的替身，提取逻辑只通过 isinstance 判断组件类型
+    monkeypatch.setattr(reference_images, "Image", FakeImage)
+    monkeypatch.setattr(reference_images, "Reply", FakeReply)
+
+
+def payload(tag, size=30):
+    return base64.b64encode(tag.encode() * size).decode()
+
+
+def extract(event, **options):
+    return asyncio.run(ReferenceImageExtractor(**options).extract(event))
+
+
+def test_images_from_message_and_reply_keep_order():
+    event = FakeEvent(FakeImage("a", payload("a")), FakeReply(FakeImage("b", payload("b"))))
+    images = extract(event)
+    assert [image.data for image in images] == [payload("a"), payload("b")]
+    assert [image.source for image in images] == ["message", "reply"]
+    assert images[0].size == 30
+
+
+def test_same_component_in_message_and_reply_is_converted_once():
+    shared = FakeImage("same", payload("a"))
+    duplicate = FakeImage("same", payload("a"))
+    images = extract(FakeEvent(shared, FakeReply(duplicate)))
+    assert len(images) == 1
+    assert shared.converted == 1 and duplicate.converted == 0
+
+
+def test_identical_content_from_different_urls_is_deduplicated():
+    images = extract(FakeEvent(FakeImage("u1", payload("a")), FakeReply(FakeImage("u2", payload("a")))))
+    assert len(images) == 1
+    assert images[0].source == "message"
+
+
+def test_max_count_limit():
+    event = FakeEvent(*(FakeImage(tag, payload(tag)) for tag in "abcd"))
+    images = extract(event, max_images=2)
+    assert [image.data for image in images] == [payload("a"), payload("b")]
+
+
+def test_max_total_bytes_skips_images_that_do_not_fit():
+    event = FakeEvent(FakeImage("a", payload("a", 60)), FakeImage("b", payload("b", 60)),
+                      FakeImage("c", payload("c", 30)))
+    images = extract(event, max_total_bytes=100)
+    # b 超出剩余额度被跳过，之后更小的 c 仍然可以使用
+    assert [image.data for image in images] == [payload("a", 60), payload("c", 30)]
+
+
+def test_failed_conversions_are_skipped():
+    event = FakeEvent(FakeImage("a", fail=True), FakeImage("b", payload("b")))
+    assert [image.data for image in extract(event)] == [payload("b")]
+
+
+def test_conversions_respect_concurrency_limit():
+    active = 0
+    peak = 0
+
+    class SlowImage(FakeImage):
+        async def convert_to_base64(self):
+            nonlocal active, peak
+            active += 1
+            peak = max(peak, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+            return self.data
+
+    images = extract(FakeEvent(*(SlowImage(str(i), payload(str(i))) for i in range(8))), concurrency=3)
+    assert len(images) == 6           # 默认最多 6 张
+    assert peak == 3
+
+
+def test_event_without_images():
+    assert extract(FakeEvent()) == []
+    assert extract(FakeEvent(FakeReply())) == []
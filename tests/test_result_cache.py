@@ -0,0 +1,137 @@
+import asyncio
+import time
+
+from utils.result_cache import ResultCache, digest_reference_image, make_cache_key
+
+
+def write_image(path, size):
+    path.write_bytes(b"\x89PNG" + b"\0" * (size - 4))
+    return str(path)
+
+
+def test_cache_key_normalizes_prompt_and_keeps_reference_order():
+    key = make_cache_key("model", "一只  小猫")
+    assert make_cache_key("model", " 一只 小猫 ") == key
+    assert make_cache_key("model", "一只　小猫") == key            # 全角空格
+    assert make_cache_key("other", "一只 小猫") != key
+    a, b = digest_reference_image("data:image/png;base64,AAAA"), digest_reference_image("BBBB")
+    assert a == digest_reference_image("AAAA")
+    assert make_cache_key("model", "p", [a, b]) != make_cache_key("model", "p", [b, a])
+
+
+def test_variants_use_distinct_keys():
+    keys = {make_cache_key("model", "p", variant=variant) for variant in range(4)}
+    assert len(keys) == 4
+    assert make_cache_key("model", "p", variant=0) == make_cache_key("model", "p")
+
+
+def test_put_get_and_reload_from_disk(tmp_path):
+    cache_dir = tmp_path / "cache"
+    source = write_image(tmp_path / "generated.png", 100)
+
+    async def run():
+        cache = ResultCache(cache_dir)
+        assert await cache.get("k") is None
+        entry = await cache.put("k", source, "png")
+        assert entry.size == 100
+        assert (await cache.get("k")).path == entry.path
+        # 新实例从缓存目录重建索引
+        reloaded = ResultCache(cache_dir)
+        return cache.stats(), await reloaded.get("k")
+
+    stats, entry = asyncio.run(run())
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["entries"] == 1
+    assert entry is not None and entry.image_format == "png"
+    with open(entry.path, "rb") as f:
+        assert f.read().startswith(b"\x89PNG")
+
+
+def test_cached_file_survives_removal_of_source(tmp_path):
+    source = tmp_path / "generated.png"
+    write_image(source, 64)
+
+    async def run():
+        cache = ResultCache(tmp_path / "cache")
+        await cache.put("k", str(source), "png")
+        source.unlink()
+        return await cache.get("k")
+
+    entry = asyncio.run(run())
+    assert entry is not None
+    with open(entry.path, "rb") as f:
+        assert len(f.read()) == 64
+
+
+def test_lru_eviction_by_total_size(tmp_path):
+    async def run():
+        cache = ResultCache(tmp_path / "cache", max_bytes=250)
+        for name in "abc":
+            await cache.put(name, write_image(tmp_path / f"{name}.png", 100), "png")
+            if name == "b":
+                await cache.get("a")          # a 最近使用过，b 成为最久未使用的项
+        return cache, [name for name in "abc" if await cache.get(name) is not None]
+
+    cache, present = asyncio.run(run())
+    assert present == ["a", "c"]
+    assert cache.total_bytes == 200
+    assert len(list((tmp_path / "cache").iterdir())) == 2
+
+
+def test_expired_entries_are_removed(tmp_path):
+    async def run():
+        cache = ResultCache(tmp_path / "cache", ttl_seconds=60)
+        entry = await cache.put("k", write_image(tmp_path / "a.png", 10), "png")
+        entry.created_at = time.time() - 61
+        return await cache.get("k"), cache.stats()
+
+    entry, stats = asyncio.run(run())
+    assert entry is None
+    assert stats["entries"] == 0 and stats["bytes"] == 0
+    assert list((tmp_path / "cache").iterdir()) == []
+
+
+def test_extra_images_are_cached_and_reloaded_with_the_result(tmp_path):
+    cache_dir = tmp_path / "cache"
+    primary = write_image(tmp_path / "a.png", 100)
+    extras = [(write_image(tmp_path / "b.png", 30), "png"), (write_image(tmp_path / "c.webp", 20), "webp")]
+
+    async def run():
+        cache = ResultCache(cache_dir)
+        await cache.put("k", primary, "png", extras)
+        entry = await cache.get("k")
+        reloaded = ResultCache(cache_dir)
+        return cache, entry, await reloaded.get("k")
+
+    cache, entry, reloaded = asyncio.run(run())
+    assert cache.total_bytes == 150
+    for cached in (entry, reloaded):
+        assert cached.size == 100 and cached.total_size == 150
+        assert [(image.size, image.image_format) for image in cached.extra_images] == [(30, "png"), (20, "webp")]
+
+
+def test_extra_images_are_evicted_with_the_result(tmp_path):
+    async def run():
+        cache = ResultCache(tmp_path / "cache", max_bytes=200)
+        await cache.put("a", write_image(tmp_path / "a.png", 100), "png",
+                        [(write_image(tmp_path / "a1.png", 50), "png")])
+        await cache.put("b", write_image(tmp_path / "b.png", 100), "png")
+        return cache, await cache.get("a"), await cache.get("b")
+
+    cache, evicted, kept = asyncio.run(run())
+    assert evicted is None and kept is not None
+    assert cache.total_bytes == 100
+    assert [path.name for path in (tmp_path / "cache").iterdir()] == ["b.png"]
+
+
+def test_orphan_extra_images_are_removed_on_reload(tmp_path):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    write_image(cache_dir / "k-1.png", 10)
+
+    async def run():
+        cache = ResultCache(cache_dir)
+        return await cache.get("k"), cache.stats()
+
+    entry, stats = asyncio.run(run())
+    assert entry is None and stats["entries"] == 0
+    assert list(cache_dir.iterdir()) == []
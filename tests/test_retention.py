@@ -0,0 +1,100 @@
+import asyncio
+import os
+import time
+
+from utils.retention import ImageRetentionSweeper
+from utils.ttp import ImageGenerationResult
+
+
+def write_image(directory, name, size, age=0):
+    """写入指定大小的文件，并把修改时间设为 age 秒之前"""
+    path = directory / name
+    path.write_bytes(b"\0" * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return str(path), mtime
+
+
+def remaining(directory):
+    return sorted(path.name for path in directory.iterdir())
+
+
+def test_sweep_removes_only_expired_files(tmp_path):
+    sweeper = ImageRetentionSweeper(tmp_path, ttl_seconds=600)
+    for name, age in (("gemini_image_old", 900), ("gemini_image_new", 60), ("siliconflow_image_old", 700)):
+        path, mtime = write_image(tmp_path, name, 10, age)
+        sweeper.track(path, 10, mtime)
+
+    removed = asyncio.run(sweeper.sweep())
+    assert removed == 2
+    assert remaining(tmp_path) == ["gemini_image_new"]
+    assert sweeper.total_bytes == 10 and sweeper.removed_files == 2
+
+
+def test_over_quota_removes_oldest_files_first(tmp_path):
+    sweeper = ImageRetentionSweeper(tmp_path, ttl_seconds=3600, max_bytes=250)
+    for name, age in (("gemini_image_b", 200), ("gemini_image_a", 300), ("gemini_image_c", 100),
+                      ("gemini_image_d", 50)):
+        path, mtime = write_image(tmp_path, name, 100, age)
+        sweeper.track(path, 100, mtime)
+
+    asyncio.run(sweeper.sweep())
+    # 400 字节超过 250 的配额，按修改时间从最旧的开始删除，直到不超过配额
+    assert remaining(tmp_path) == ["gemini_image_c", "gemini_image_d"]
+    assert sweeper.total_bytes == 200
+
+
+def test_untracked_prefixes_are_ignored(tmp_path):
+    sweeper = ImageRetentionSweeper(tmp_path, ttl_seconds=60)
+    path, mtime = write_image(tmp_path, "user_upload.png", 10, 3600)
+    sweeper.track(path, 10, mtime)
+
+    async def run():
+        await sweeper.rescan()
+        return await sweeper.sweep()
+
+    assert asyncio.run(run()) == 0
+    assert remaining(tmp_path) == ["user_upload.png"]
+    assert sweeper.total_bytes == 0
+
+
+def test_rescan_finds_untracked_files_with_their_size(tmp_path):
+    write_image(tmp_path, "gemini_image_old", 30, 900)
+    write_image(tmp_path, "gemini_image_new", 40, 10)
+    sweeper = ImageRetentionSweeper(tmp_path, ttl_seconds=600)
+
+    asyncio.run(sweeper.rescan())
+    assert remaining(tmp_path) == ["gemini_image_new"]
+    assert sweeper.total_bytes == 40
+
+
+def test_retracking_a_file_replaces_its_entry(tmp_path):
+    sweeper = ImageRetentionSweeper(tmp_path, ttl_seconds=600)
+    path, _ = write_image(tmp_path, "gemini_image_a", 10, 900)
+    sweeper.track(path, 10, time.time() - 900)
+    # 文件被重新写入后再次登记，旧的堆项不应导致文件被删除或重复计算大小
+    sweeper.track(path, 25)
+
+    assert asyncio.run(sweeper.sweep()) == 0
+    assert sweeper.total_bytes == 25
+    assert remaining(tmp_path) == ["gemini_image_a"]
+
+
+def test_track_result_counts_kept_originals_with_their_size(tmp_path):
+    sweeper = ImageRetentionSweeper(tmp_path, ttl_seconds=3600, max_bytes=150)
+    original, _ = write_image(tmp_path, "gemini_image_1.png", 120)
+    transcoded, _ = write_image(tmp_path, "gemini_image_1_transcoded.webp", 20)
+    extra, _ = write_image(tmp_path, "gemini_image_2.png", 30)
+    result = ImageGenerationResult(
+        transcoded, f"file://{transcoded}", "webp", size=20, original_path=original, original_size=120,
+        extra_images=[ImageGenerationResult(extra, f"file://{extra}", "png", size=30)],
+    )
+
+    sweeper.track_result(result)
+    assert sweeper.total_bytes == 170
+
+    # 原图按实际大小计入配额；让原图成为最旧的文件，超过配额时先被清理
+    sweeper.track(original, 120, time.time() - 60)
+    asyncio.run(sweeper.sweep())
+    assert remaining(tmp_path) == ["gemini_image_1_transcoded.webp", "gemini_image_2.png"]
+    assert sweeper.total_bytes == 50
@@ -0,0 +1,145 @@
+import asyncio
+import json
+
+from utils import stream_decoder
+from utils.retry_policy import (EMPTY_IMAGE, FATAL, NETWORK, RATE_LIMITED, TRANSIENT, RetryBudget, RetryPolicy,
+                                classify_status)
+from utils.ttp import generate_image
+
+
+def test_classify_status():
+    assert classify_status(None) == NETWORK
+    assert classify_status(429) == RATE_LIMITED
+    assert classify_status(401) == RATE_LIMITED
+    assert classify_status(503) == TRANSIENT
+    assert classify_status(408) == TRANSIENT
+    assert classify_status(400) == FATAL
+
+
+def test_backoff_is_capped_and_honours_retry_after():
+    policy = RetryPolicy(base_delay=1, max_delay=4)
+    for retry_number, cap in ((1, 1), (2, 2), (3, 4), (10, 4)):
+        for _ in range(20):
+            assert cap / 2 <= policy.backoff(retry_number) <= cap
+    assert policy.backoff(1, retry_after=30) == 30
+
+
+def test_budget_limits_retries_to_a_ratio_of_requests():
+    budget = RetryBudget(ratio=0.5, min_per_second=0, max_tokens=2)
+    assert budget.try_spend() and budget.try_spend()
+    assert not budget.try_spend()
+    budget.deposit()
+    budget.deposit()
+    assert budget.try_spend()
+    assert not budget.try_spend()
+    assert budget.exhausted == 2
+
+
+def test_wait_stops_on_fatal_max_retries_and_empty_image_setting():
+    async def run():
+        policy = RetryPolicy(max_retries=2, base_delay=0.001, max_delay=0.001, retry_empty_image=False)
+        state = policy.begin()
+        results = [await state.wait(FATAL), await state.wait(EMPTY_IMAGE)]
+        results += [await state.wait(NETWORK) for _ in range(3)]
+        return results, state.retries, policy.retries
+
+    results, retries, total = asyncio.run(run())
+    assert results == [False, False, True, True, False]
+    assert retries == total == 2
+
+
+def test_wait_gives_up_when_backoff_exceeds_deadline():
+    async def run():
+        state = RetryPolicy(deadline=0.5).begin()
+        return await state.wait(RATE_LIMITED, retry_after=10), state.retries
+
+    assert asyncio.run(run()) == (False, 0)
+
+
+def test_wait_respects_exhausted_budget():
+    async def run():
+        budget = RetryBudget(min_per_second=0, max_tokens=1)
+        budget.tokens = 0
+        state = RetryPolicy(base_delay=0.001, budget=budget).begin()
+        return await state.wait(TRANSIENT)
+
+    assert asyncio.run(run()) is False
+
+
+class _FakeResponse:
+    def __init__(self, status, body):
+        self.status = status
+        self.headers = {}
+        self._body = body
+
+    async def json(self, content_type=None):
+        return json.loads(self._body)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+class _FakeContent:
+    def __init__(self, data):
+        self._data = data
+
+    async def iter_chunked(self, size):
+        for start in range(0, len(self._data), size):
+            yield self._data[start:start + size]
+
+
+class _FakeSession:
+    """按顺序返回预设响应的会话，SiliconFlow 的地址是固定的，无法指向本地模拟服务"""
+
+    closed = False
+
+    def __init__(self, responses, images=None):
+        self.responses = list(responses)
+        self.images = dict(images or {})
+        self.posts = 0
+
+    def post(self, url, **kwargs):
+        self.posts += 1
+        return _FakeResponse(*self.responses.pop(0))
+
+    def get(self, url, **kwargs):
+        response = _FakeResponse(200, "null")
+        response.content = _FakeContent(self.images[url])
+        return response
+
+
+def test_siliconflow_retries_non_object_bodies():
+    session = _FakeSession([(200, "null"), (200, "[1, 2]"), (200, '"busy"'), (503, "null")])
+    policy = RetryPolicy(max_retries=3, base_delay=0.001, max_delay=0.001)
+
+    result = asyncio.run(generate_image("p", "key", session=session, retry_policy=policy))
+
+    assert result is None
+    assert session.posts == 4
+    assert policy.retries == 3
+
+
+def test_siliconflow_does_not_retry_non_object_client_errors():
+    session = _FakeSession([(400, "null")])
+    policy = RetryPolicy(max_retries=3, base_delay=0.001, max_delay=0.001)
+
+    assert asyncio.run(generate_image("p", "key", session=session, retry_policy=policy)) is None
+    assert session.posts == 1
+
+
+def test_siliconflow_downloads_the_image_into_the_images_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(stream_decoder, "default_images_dir", lambda: tmp_path)
+    image = b"\xff\xd8\xff" + bytes(range(256)) * 600
+    body = json.dumps({"images": [{"url": "https://cdn.example/a.jpeg"}]})
+    session = _FakeSession([(200, body)], images={"https://cdn.example/a.jpeg": image})
+
+    result = asyncio.run(generate_image("p", "key", session=session))
+
+    assert result.size == len(image)
+    assert result.image_url == "https://cdn.example/a.jpeg"
+    with open(result.image_path, "rb") as f:
+        assert f.read() == image
+    assert [path.name.startswith("siliconflow_image_") for path in tmp_path.iterdir()] == [True]
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+from utils.single_flight import SingleFlight
+
+
+def test_concurrent_calls_with_the_same_key_run_once():
+    calls = []
+
+    async def run():
+        flight = SingleFlight()
+
+        async def work(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            return value
+
+        results = await asyncio.gather(
+            *(flight.do("same", lambda: work("a")) for _ in range(5)),
+            flight.do("other", lambda: work("b")),
+        )
+        return flight, results
+
+    flight, results = asyncio.run(run())
+    assert results == ["a"] * 5 + ["b"]
+    assert sorted(calls) == ["a", "b"]
+    assert flight.coalesced == 4
+    assert flight.in_flight() == 0
+
+
+def test_key_can_run_again_after_completion():
+    async def run():
+        flight = SingleFlight()
+        counter = iter(range(10))
+
+        async def work():
+            return next(counter)
+
+        return [await flight.do("k", work), await flight.do("k", work)]
+
+    assert asyncio.run(run()) == [0, 1]
+
+
+def test_exceptions_are_shared_by_all_waiters():
+    async def run():
+        flight = SingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upstream failed")
+
+        return await asyncio.gather(*(flight.do("k", fail) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_cancelled_waiter_does_not_cancel_the_shared_call():
+    async def run():
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def work():
+            started.set()
+            await asyncio.sleep(0.05)
+            return "image"
+
+        first = asyncio.create_task(flight.do("k", work))
+        await started.wait()
+        second = asyncio.create_task(flight.do("k", work))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        assert flight.running("k")
+        return await second
+
+    assert asyncio.run(run()) == "image"
@@ -0,0 +1,156 @@
+import asyncio
+import base64
+import functools
+import json
+
+import pytest
+
+from utils.stream_decoder import FileImageSink, StreamingImageExtractor
+
+IMAGE = bytes(range(256)) * 40
+
+
+def response_body(uri, text="done"):
+    return json.dumps({"choices": [{"message": {
+        "content": text,
+        "images": [{"type": "image_url", "image_url": {"url": uri}}],
+    }}]}).encode()
+
+
+def data_uri(data=IMAGE, mime="image/png"):
+    return f"data:{mime};base64,{base64.b64encode(data).decode()}"
+
+
+def extract(tmp_path, chunks, max_images=1):
+    """把响应分块喂给解析器，返回 (骨架, 解析器)"""
+    async def run():
+        extractor = StreamingImageExtractor(
+            sink_factory=functools.partial(FileImageSink, images_dir=tmp_path), max_images=max_images,
+        )
+        for chunk in chunks:
+            await extractor.feed(chunk)
+        return await extractor.finish(), extractor
+    return asyncio.run(run())
+
+
+def split(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+def image_of(data, extractor):
+    url = data["choices"][0]["message"]["images"][0]["image_url"]["url"]
+    image = extractor.find(url)
+    assert image is not None
+    with open(image.location, "rb") as f:
+        return image, f.read()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64, 65536])
+def test_data_uri_split_across_chunks(tmp_path, chunk_size):
+    data, extractor = extract(tmp_path, split(response_body(data_uri()), chunk_size))
+
+    image, content = image_of(data, extractor)
+    assert content == IMAGE
+    assert image.image_format == "png"
+    assert image.size == len(IMAGE)
+    assert data["choices"][0]["message"]["content"] == "done"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 5, 4096])
+def test_escaped_slashes(tmp_path, chunk_size):
+    # json.dumps 不转义 "/"，这里按部分服务端的输出手动转义
+    body = response_body(data_uri(mime="image/webp")).replace(b"/", b"\\/")
+    data, extractor = extract(tmp_path, split(body, chunk_size))
+
+    image, content = image_of(data, extractor)
+    assert content == IMAGE
+    assert image.image_format == "webp"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 9, 4096])
+def test_line_wrapped_base64(tmp_path, chunk_size):
+    encoded = base64.encodebytes(IMAGE).decode()        # 每 76 个字符一个换行
+    assert "\n" in encoded
+    body = response_body(f"data:image/jpeg;base64,{encoded}")
+    assert b"\\n" in body
+    data, extractor = extract(tmp_path, split(body, chunk_size))
+
+    image, content = image_of(data, extractor)
+    assert content == IMAGE
+    assert image.image_format == "jpeg"
+
+
+def test_missing_padding(tmp_path):
+    uri = data_uri(IMAGE[:-1]).rstrip("=")
+    data, extractor = extract(tmp_path, [response_body(uri)])
+
+    _, content = image_of(data, extractor)
+    assert content == IMAGE[:-1]
+
+
+def test_text_that_is_not_a_data_uri_is_kept(tmp_path):
+    text = "see data:image/png for details"
+    body = json.dumps({"choices": [{"message": {"content": text}}]}).encode()
+    data, extractor = extract(tmp_path, split(body, 4))
+
+    assert data["choices"][0]["message"]["content"] == text
+    assert extractor.images == []
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_images_beyond_max_images_are_skipped(tmp_path):
+    second = bytes(reversed(IMAGE))
+    body = json.dumps({"choices": [{"message": {"content": "", "images": [
+        {"type": "image_url", "image_url": {"url": data_uri()}},
+        {"type": "image_url", "image_url": {"url": data_uri(second)}},
+    ]}}]}).encode()
+
+    data, extractor = extract(tmp_path, split(body, 1000), max_images=1)
+    assert len(extractor.images) == 1
+    assert len(list(tmp_path.iterdir())) == 1
+
+    data, extractor = extract(tmp_path / "both", split(body, 1000), max_images=2)
+    images = data["choices"][0]["message"]["images"]
+    contents = [open(extractor.find(item["image_url"]["url"]).location, "rb").read() for item in images]
+    assert contents == [IMAGE, second]
+
+
+def test_skeleton_size_is_capped(tmp_path):
+    async def run():
+        extractor = StreamingImageExtractor(sink_factory=functools.partial(FileImageSink, images_dir=tmp_path))
+        await extractor.feed(b'{"text": "')
+        with pytest.raises(ValueError):
+            for _ in range(5):
+                await extractor.feed(b"x" * (1024 * 1024))
+    asyncio.run(run())
+
+
+def test_large_image_does_not_count_towards_skeleton_cap(tmp_path):
+    large = b"\x00" * (6 * 1024 * 1024)
+    data, extractor = extract(tmp_path, split(response_body(data_uri(large)), 65536))
+
+    _, content = image_of(data, extractor)
+    assert content == large
+
+
+def test_abort_removes_partial_and_unkept_images(tmp_path):
+    async def run():
+        extractor = StreamingImageExtractor(
+            sink_factory=functools.partial(FileImageSink, images_dir=tmp_path), max_images=3,
+        )
+        body = json.dumps({"images": [data_uri(), data_uri(), data_uri()]}).encode()
+        # 第三张图像只收到一部分时请求被取消
+        await extractor.feed(body[:-2000])
+        assert len(extractor.images) == 2
+        assert len(list(tmp_path.iterdir())) == 3
+        kept = extractor.images[0]
+        await extractor.abort(keep=[kept])
+        return kept
+
+    kept = asyncio.run(run())
+    assert [path.name for path in tmp_path.iterdir()] == [kept.location.rsplit("/", 1)[-1]]
+
+
+def test_invalid_json_raises_value_error(tmp_path):
+    with pytest.raises(ValueError):
+        extract(tmp_path, [b'{"choices": [', data_uri().encode()])
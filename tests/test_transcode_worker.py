@@ -0,0 +1,65 @@
+"""
+转码的测试：ImageTranscoder 的进程池不使用 fork，且工作模块不导入 AstrBot
+"""
+import asyncio
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+PIL = pytest.importorskip("PIL")
+from PIL import Image as PILImage  # noqa: E402
+
+from utils.image_transcode import ImageTranscoder  # noqa: E402
+from utils.transcode_worker import transcode_image_file  # noqa: E402
+from utils.ttp import ImageGenerationResult  # noqa: E402
+
+PLUGIN_DIR = Path(__file__).resolve().parent.parent
+
+
+def _write_png(path, size=(640, 480)):
+    # 带噪声的图像，保证转码后的 JPEG 小于 PNG
+    image = PILImage.effect_noise(size, 64).convert("RGB")
+    image.save(path, format="PNG")
+    return path
+
+
+def test_worker_module_does_not_import_astrbot():
+    code = "import sys, utils.transcode_worker; print('astrbot' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", code], cwd=PLUGIN_DIR, capture_output=True, text=True,
+                            check=True, env={"PYTHONPATH": str(PLUGIN_DIR)}).stdout
+    assert output.strip() == "False"
+
+
+def test_transcoder_pool_does_not_fork(tmp_path):
+    source = _write_png(tmp_path / "image.png")
+    transcoder = ImageTranscoder(output_format="jpeg", quality=80, max_width=320, max_workers=1)
+
+    async def run():
+        try:
+            result = await transcoder.transcode(
+                ImageGenerationResult(str(source), f"file://{source}", "png", source.stat().st_size))
+            return result, transcoder._executor._mp_context.get_start_method()
+        finally:
+            transcoder.close()
+
+    result, start_method = asyncio.run(run())
+    # fork 会复制整个 AstrBot 进程，工作进程必须由 forkserver 或 spawn 启动
+    assert start_method in ("forkserver", "spawn")
+    assert result.image_format == "jpeg"
+    assert result.original_path is None
+    assert not source.exists()
+    assert Path(result.image_path).stat().st_size == result.size
+    assert transcoder.transcoded == 1
+    with PILImage.open(result.image_path) as image:
+        assert image.format == "JPEG"
+        assert image.width == 320
+
+
+def test_transcode_keeps_original_when_no_gain(tmp_path):
+    source = tmp_path / "tiny.png"
+    PILImage.new("RGB", (8, 8), (255, 0, 0)).save(source, format="PNG")
+
+    assert transcode_image_file(str(source), "png") is None
+    assert source.exists()
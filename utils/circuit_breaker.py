@@ -0,0 +1,144 @@
+import time
+from collections import deque
+from astrbot.api import logger
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 状态在状态命令中的显示名称
+STATE_LABELS = {CLOSED: "正常", OPEN: "熔断", HALF_OPEN: "探测中"}
+
+
+class CircuitBreaker:
+    """
+    熔断器（closed / open / half-open）
+
+    连续失败次数达到阈值，或统计窗口内超时比例过高时打开；打开期间直接拒绝请求，
+    冷却结束后进入半开状态，只放行少量探测请求：探测成功则关闭，失败则以加倍的冷却时间重新打开。
+    """
+
+    def __init__(self, name, failure_threshold=5, timeout_rate=0.5, min_requests=10, window=60,
+                 open_seconds=30, max_open_seconds=300, half_open_probes=1):
+        """
+        Args:
+            name (str): 用于日志的名称，不应包含密钥本身
+            failure_threshold (int): 打开熔断的连续失败次数
+            timeout_rate (float): 打开熔断的窗口内超时比例
+            min_requests (int): 计算超时比例所需的最少请求数
+            window (int): 超时比例的统计窗口（秒）
+            open_seconds (int): 首次打开的冷却时间（秒）
+            max_open_seconds (int): 反复打开时冷却时间的上限（秒）
+            half_open_probes (int): 半开状态下同时放行的探测请求数
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.timeout_rate = timeout_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.half_open_probes = half_open_probes
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_count = 0
+        self._current_open_seconds = open_seconds
+        self._open_until = 0.0
+        self._probes = 0
+        self._recent = deque()        # (时间, 是否超时)
+
+    def _refresh(self, now):
+        if self.state == OPEN and now >= self._open_until:
+            self.state = HALF_OPEN
+            self._probes = 0
+            logger.info(f"{self.name} 熔断冷却结束，进入探测状态")
+
+    def available(self, now=None):
+        """是否可以放行请求（不占用探测名额）"""
+        now = time.monotonic() if now is None else now
+        self._refresh(now)
+        if self.state == CLOSED:
+            return True
+        if self.state == HALF_OPEN:
+            return self._probes < self.half_open_probes
+        return False
+
+    def allow(self, now=None):
+        """
+        申请放行一个请求，半开状态下会占用一个探测名额
+
+        Returns:
+            bool: 是否放行
+        """
+        now = time.monotonic() if now is None else now
+        if not self.available(now):
+            return False
+        if self.state == HALF_OPEN:
+            self._probes += 1
+        return True
+
+    def retry_in(self, now=None):
+        """距离熔断冷却结束还有多少秒，未熔断时为0"""
+        now = time.monotonic() if now is None else now
+        return max(0.0, self._open_until - now) if self.state == OPEN else 0.0
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self._push(False)
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+            self._current_open_seconds = self.open_seconds
+            logger.info(f"{self.name} 探测成功，熔断关闭")
+
+    def record_failure(self, timeout=False):
+        now = time.monotonic()
+        self.consecutive_failures += 1
+        self._push(timeout, now)
+        if self.state == HALF_OPEN:
+            self._current_open_seconds = min(self._current_open_seconds * 2, self.max_open_seconds)
+            self._open(now, "探测失败")
+        elif self.state == CLOSED:
+            if self.consecutive_failures >= self.failure_threshold:
+                self._open(now, f"连续失败 {self.consecutive_failures} 次")
+            elif self._timeout_ratio() >= self.timeout_rate and len(self._recent) >= self.min_requests:
+                self._open(now, f"超时比例 {self._timeout_ratio():.0%}")
+
+    def record_cancel(self):
+        """请求被取消，归还探测名额且不计入统计"""
+        if self.state == HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def _push(self, timeout, now=None):
+        now = time.monotonic() if now is None else now
+        self._recent.append((now, timeout))
+        while self._recent and now - self._recent[0][0] > self.window:
+            self._recent.popleft()
+
+    def _timeout_ratio(self):
+        if not self._recent:
+            return 0.0
+        return sum(1 for _, timeout in self._recent if timeout) / len(self._recent)
+
+    def _open(self, now, reason):
+        self.state = OPEN
+        self.opened_count += 1
+        self._open_until = now + self._current_open_seconds
+        self._recent.clear()
+        logger.warning(f"{self.name} 熔断打开 {self._current_open_seconds:.0f} 秒（{reason}）")
+
+    def snapshot(self):
+        """
+        获取熔断器状态
+
+        Returns:
+            dict: 状态、连续失败次数、剩余冷却时间与累计打开次数
+        """
+        now = time.monotonic()
+        self._refresh(now)
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_in": self.retry_in(now),
+            "opened_count": self.opened_count,
+        }
@@ -0,0 +1,173 @@
+import time
+from collections import deque
+from urllib.parse import urlparse
+from .circuit_breaker import CircuitBreaker
+
+
+# 默认的 OpenRouter API base
+OPENROUTER_API_BASE = "https://openrouter.ai/api"
+
+
+def completions_url(api_base):
+    """根据 API base 拼接 OpenAI 兼容的 chat completions 地址"""
+    return f"{api_base.rstrip('/')}/v1/chat/completions"
+
+
+class EndpointState:
+    """单个上游端点的延迟与健康状态"""
+
+    def __init__(self, index, api_base, breaker_options):
+        self.index = index                # 从1开始的序号
+        self.api_base = api_base
+        self.url = completions_url(api_base)
+        self.host = urlparse(api_base).netloc or api_base   # 仅用于日志
+        self.breaker = CircuitBreaker(f"端点 {self.host}", **breaker_options)
+        self.ewma_latency = None          # 成功请求耗时的指数加权移动平均（秒）
+        self.in_flight = 0
+        self.outcomes = deque()           # (时间, 是否出错)
+        self.requests = 0
+        self.failures = 0
+        self.last_used = 0.0
+
+    def prune(self, now, error_window):
+        while self.outcomes and now - self.outcomes[0][0] > error_window:
+            self.outcomes.popleft()
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, failed in self.outcomes if failed) / len(self.outcomes)
+
+
+class EndpointRouter:
+    """
+    多端点路由
+
+    按「EWMA 延迟 ×（1 + 并发数）÷ 成功率」为每个请求选择预期最快的端点。
+    没有延迟样本或长时间未使用的端点按所有端点的平均延迟估计，
+    使新加入或恢复的端点能重新得到流量。
+    """
+
+    def __init__(self, api_bases, alpha=0.2, error_window=300, probe_interval=120,
+                 failure_threshold=5, breaker_open_seconds=30):
+        """
+        Args:
+            api_bases (list): OpenAI 兼容的 API base 列表
+            alpha (float): EWMA 平滑系数，越大越偏向最近的样本
+            error_window (int): 统计成功率的时间窗口（秒）
+            probe_interval (int): 端点超过该时间未被使用时，按平均延迟重新估计（秒）
+            failure_threshold (int): 端点连续失败多少次后熔断
+            breaker_open_seconds (int): 端点熔断的初始冷却时间（秒）
+        """
+        if isinstance(api_bases, str):
+            api_bases = [api_bases]
+        bases = []
+        for base in api_bases or []:
+            base = (base or "").strip().rstrip("/")
+            if base and base not in bases:
+                bases.append(base)
+        breaker_options = {"failure_threshold": failure_threshold, "open_seconds": breaker_open_seconds}
+        self.endpoints = [
+            EndpointState(i + 1, base, breaker_options) for i, base in enumerate(bases or [OPENROUTER_API_BASE])
+        ]
+        self.alpha = alpha
+        self.error_window = error_window
+        self.probe_interval = probe_interval
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def _default_latency(self):
+        known = [state.ewma_latency for state in self.endpoints if state.ewma_latency is not None]
+        return sum(known) / len(known) if known else 1.0
+
+    def _score(self, state, now, default_latency):
+        state.prune(now, self.error_window)
+        latency = state.ewma_latency
+        if latency is None or now - state.last_used > self.probe_interval:
+            latency = default_latency if latency is None else min(latency, default_latency)
+        success_rate = max(1.0 - state.error_rate(), 0.05)
+        return latency * (1 + state.in_flight) / success_rate
+
+    def acquire(self, exclude=()):
+        """
+        选择预期最快的端点并占用
+
+        Args:
+            exclude (iterable): 本次请求已失败的端点序号；全部排除时仍从所有未熔断的端点中选择
+
+        Returns:
+            EndpointState: 选中的端点，所有端点都处于熔断状态时返回None
+        """
+        now = time.monotonic()
+        allowed = [state for state in self.endpoints if state.breaker.available(now)]
+        candidates = [state for state in allowed if state.index not in exclude] or allowed
+        if not candidates:
+            return None
+        default_latency = self._default_latency()
+        state = min(candidates, key=lambda item: (self._score(item, now, default_latency), item.in_flight, item.index))
+        state.breaker.allow(now)
+        state.in_flight += 1
+        state.requests += 1
+        state.last_used = now
+        return state
+
+    def release(self, state, latency=None, failed=False, cancelled=False, timeout=False):
+        """
+        归还端点并更新其延迟与成功率
+
+        Args:
+            state (EndpointState): acquire 返回的端点
+            latency (float): 成功请求的耗时（秒）
+            failed (bool): 请求是否因端点原因失败（网络错误、超时、5xx）
+            cancelled (bool): 请求被主动取消，不计入统计
+            timeout (bool): 失败是否由超时引起，用于熔断器的超时比例
+        """
+        state.in_flight = max(0, state.in_flight - 1)
+        if cancelled:
+            state.breaker.record_cancel()
+            return
+        state.outcomes.append((time.monotonic(), failed))
+        if failed:
+            state.failures += 1
+            state.breaker.record_failure(timeout=timeout)
+            return
+        state.breaker.record_success()
+        if latency is not None:
+            if state.ewma_latency is None:
+                state.ewma_latency = latency
+            else:
+                state.ewma_latency += self.alpha * (latency - state.ewma_latency)
+
+    def next_available_in(self):
+        """距离最早一个熔断中的端点恢复还有多少秒"""
+        now = time.monotonic()
+        return min(state.breaker.retry_in(now) for state in self.endpoints)
+
+    def untried(self, exclude):
+        """是否还有未失败过且未熔断的端点"""
+        now = time.monotonic()
+        return any(state.index not in exclude and state.breaker.available(now) for state in self.endpoints)
+
+    def snapshot(self):
+        """
+        获取所有端点的状态快照
+
+        Returns:
+            list: 每个端点的状态字典
+        """
+        now = time.monotonic()
+        result = []
+        for state in self.endpoints:
+            state.prune(now, self.error_window)
+            result.append({
+                "index": state.index,
+                "host": state.host,
+                "ewma_latency": state.ewma_latency,
+                "error_rate": state.error_rate(),
+                "in_flight": state.in_flight,
+                "requests": state.requests,
+                "failures": state.failures,
+                "breaker": state.breaker.snapshot(),
+            })
+        return result
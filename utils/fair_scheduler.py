@@ -0,0 +1,317 @@
+import asyncio
+import heapq
+import itertools
+import time
+from astrbot.api import logger
+
+
+class TokenBucket:
+    """令牌桶：按固定速率补充令牌，最多积累 burst 个；cost 超过 burst 的请求永远无法满足，应由调用方拒绝"""
+
+    def __init__(self, rate_per_minute, burst):
+        """
+        Args:
+            rate_per_minute (float): 每分钟补充的令牌数
+            burst (float): 令牌上限（允许的突发请求数）
+        """
+        self.rate = rate_per_minute / 60
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def available(self, cost=1):
+        """令牌是否足够"""
+        self._refill()
+        return self.tokens >= cost
+
+    def take(self, cost=1):
+        """扣除令牌（调用前应先检查 available）"""
+        self._refill()
+        self.tokens -= cost
+
+    def wait_time(self, cost=1):
+        """距离令牌足够还需等待的秒数"""
+        self._refill()
+        missing = cost - self.tokens
+        if missing <= 0:
+            return 0.0
+        if cost > self.burst or self.rate <= 0:
+            return float("inf")
+        return missing / self.rate
+
+    def full(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class SchedulerRejected(Exception):
+    """请求被调度器拒绝（限流或队列已满）"""
+
+    def __init__(self, message, reason, retry_after=None):
+        """
+        Args:
+            message (str): 回复给用户的提示
+            reason (str): user_rate / group_rate / too_large / queue_full
+            retry_after (float): 建议的重试等待时间（秒）
+        """
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class SchedulerTicket:
+    """一次调度申请，由 FairScheduler.submit 创建"""
+
+    def __init__(self, scheduler, group, cost, finish_tag, start_tag):
+        self.scheduler = scheduler
+        self.group = group
+        self.cost = cost
+        self.finish_tag = finish_tag
+        self.start_tag = start_tag
+        self.position = 0             # 提交时在队列中的位置（从1开始），0 表示立即开始
+        self.admitted = False
+        self.released = False
+        self._future = asyncio.get_running_loop().create_future()
+
+    async def wait(self):
+        """等待轮到本请求"""
+        await asyncio.shield(self._future)
+
+    def release(self):
+        """请求完成或放弃排队，释放占用的并发名额（可重复调用）"""
+        if self.released:
+            return
+        self.released = True
+        self.scheduler._release(self)
+
+    def _admit(self):
+        self.admitted = True
+        if not self._future.done():
+            self._future.set_result(None)
+
+
+class FairScheduler:
+    """
+    生成请求的公平调度器
+
+    - 每个用户与每个群一个令牌桶，超过速率的请求直接拒绝
+    - 全局并发上限，超出时排队；队列按群做加权公平排队（WFQ），刷屏的群只会拉长自己的队列
+    - 队列总长度或单个群的排队数超过上限时拒绝新请求（负载削减）
+    """
+
+    def __init__(self, max_in_flight=8, max_queue=20, max_queue_per_group=5, user_rate_per_minute=6,
+                 user_burst=4, group_rate_per_minute=20, group_burst=10, group_weights=None):
+        """
+        Args:
+            max_in_flight (int): 同时进行的生成数上限
+            max_queue (int): 排队请求总数上限
+            max_queue_per_group (int): 单个群的排队请求数上限
+            user_rate_per_minute (float): 每个用户每分钟允许的请求数，0 表示不限制
+            user_burst (int): 每个用户允许的突发请求数
+            group_rate_per_minute (float): 每个群每分钟允许的请求数，0 表示不限制
+            group_burst (int): 每个群允许的突发请求数
+            group_weights (dict): 群ID -> 权重，未列出的群权重为1
+        """
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self.max_queue_per_group = max(1, max_queue_per_group)
+        self.user_rate_per_minute = user_rate_per_minute
+        self.user_burst = user_burst
+        self.group_rate_per_minute = group_rate_per_minute
+        self.group_burst = group_burst
+        self.group_weights = dict(group_weights or {})
+        self.in_flight = 0
+        self.rejected = {"user_rate": 0, "group_rate": 0, "too_large": 0, "queue_full": 0}
+        self._user_buckets = {}
+        self._group_buckets = {}
+        self._queue = []              # (结束标签, 序号, 票据)
+        self._queued_per_group = {}
+        self._group_finish = {}       # 群 -> 最近一个排队请求的虚拟结束时间
+        self._virtual_time = 0.0
+        self._sequence = itertools.count()
+
+    def max_cost(self):
+        """
+        单次请求允许的最大 cost（用户与群令牌桶容量中较小的一个）
+
+        Returns:
+            int: 最大 cost，未启用限流时返回None
+        """
+        limits = [max(1, int(burst)) for rate, burst in ((self.user_rate_per_minute, self.user_burst),
+                                                         (self.group_rate_per_minute, self.group_burst)) if rate > 0]
+        return min(limits) if limits else None
+
+    def charge(self, user_id, group_id, cost=1):
+        """
+        按用户与群的令牌桶扣除全部 cost 个令牌
+
+        Args:
+            user_id (str): 用户ID
+            group_id (str): 群ID
+            cost (int): 令牌数
+
+        Raises:
+            SchedulerRejected: 超过用户或群的速率限制，或 cost 超过 max_cost（此时不扣除任何令牌）
+        """
+        self._check_cost(cost)
+        buckets = self._buckets(user_id, group_id)
+        shortage = self._shortage(buckets, cost)
+        if shortage is not None:
+            reason, wait = shortage
+            self.rejected[reason] += 1
+            scope = "本群请求" if reason == "group_rate" else "请求"
+            raise SchedulerRejected(f"{scope}过于频繁，请 {wait:.0f} 秒后再试", reason, wait)
+        self._take(buckets, cost)
+
+    async def acquire(self, user_id, group_id, cost=1):
+        """
+        等待令牌足够后扣除（超过速率时等待而不是拒绝，例如批量生成中第一项之后的各项）
+
+        Args:
+            user_id (str): 用户ID
+            group_id (str): 群ID
+            cost (int): 令牌数
+
+        Raises:
+            SchedulerRejected: cost 超过 max_cost，永远无法满足
+        """
+        self._check_cost(cost)
+        buckets = self._buckets(user_id, group_id)
+        while True:
+            shortage = self._shortage(buckets, cost)
+            if shortage is None:
+                break
+            await asyncio.sleep(shortage[1])
+        self._take(buckets, cost)
+
+    def _check_cost(self, cost):
+        limit = self.max_cost()
+        if limit is not None and cost > limit:
+            self.rejected["too_large"] += 1
+            raise SchedulerRejected(f"单次最多请求 {limit} 张图像", "too_large")
+
+    def _buckets(self, user_id, group_id):
+        return (
+            ("user_rate", self._bucket(self._user_buckets, user_id, self.user_rate_per_minute, self.user_burst)),
+            ("group_rate", self._bucket(self._group_buckets, group_id, self.group_rate_per_minute, self.group_burst)),
+        )
+
+    @staticmethod
+    def _shortage(buckets, cost):
+        """令牌不足时返回 (原因, 需要等待的秒数)，足够时返回None"""
+        for reason, bucket in buckets:
+            if bucket is not None and not bucket.available(cost):
+                return reason, bucket.wait_time(cost)
+        return None
+
+    @staticmethod
+    def _take(buckets, cost):
+        for _, bucket in buckets:
+            if bucket is not None:
+                bucket.take(cost)
+
+    def submit(self, user_id, group_id, cost=1, charge=True):
+        """
+        申请执行一次生成
+
+        Args:
+            user_id (str): 用户ID
+            group_id (str): 群ID（私聊时使用能区分会话的ID）
+            cost (int): 占用的并发名额与令牌数（例如多张变体生成的数量）
+            charge (bool): 是否扣除令牌（已通过 charge 统一扣除时为False，例如批量生成的每一项）
+
+        Returns:
+            SchedulerTicket: 调度票据，position 为 0 时可以立即开始，否则需要 await ticket.wait()
+
+        Raises:
+            SchedulerRejected: 超过用户或群的速率限制，或队列已满
+        """
+        queued = len(self._queue)
+        must_queue = queued > 0 or self.in_flight + cost > self.max_in_flight
+        if must_queue and self.in_flight > 0:
+            group_queued = self._queued_per_group.get(group_id, 0)
+            if queued >= self.max_queue or group_queued >= self.max_queue_per_group:
+                self.rejected["queue_full"] += 1
+                raise SchedulerRejected(f"当前排队人数过多（{queued} 个请求排队中），请稍后再试", "queue_full")
+        else:
+            must_queue = False
+        if charge:
+            self.charge(user_id, group_id, cost)
+
+        # 加权公平排队：空闲过的群从当前虚拟时间开始，不会积累额度
+        weight = max(0.01, float(self.group_weights.get(group_id, 1)))
+        start_tag = max(self._virtual_time, self._group_finish.get(group_id, 0.0))
+        finish_tag = start_tag + cost / weight
+        ticket = SchedulerTicket(self, group_id, cost, finish_tag, start_tag)
+        if not must_queue:
+            self.in_flight += cost
+            ticket._admit()
+            return ticket
+
+        self._group_finish[group_id] = finish_tag
+        ticket.position = 1 + sum(1 for tag, _, _ in self._queue if tag <= finish_tag)
+        heapq.heappush(self._queue, (finish_tag, next(self._sequence), ticket))
+        self._queued_per_group[group_id] = self._queued_per_group.get(group_id, 0) + 1
+        logger.info(f"生成请求排队中（群 {group_id}，第 {ticket.position} 位）")
+        return ticket
+
+    def _release(self, ticket):
+        if ticket.admitted:
+            self.in_flight -= ticket.cost
+        else:
+            # 放弃排队：从队列中移除（堆很小，直接重建）
+            self._queue = [entry for entry in self._queue if entry[2] is not ticket]
+            heapq.heapify(self._queue)
+            self._dequeued(ticket)
+        self._dispatch()
+
+    def _dispatch(self):
+        """按结束标签顺序放行排队的请求，直到并发名额用完"""
+        while self._queue:
+            ticket = self._queue[0][2]
+            # 队首请求的 cost 超过剩余名额时等待；空闲时总是放行，避免 cost 大于上限的请求永远等待
+            if self.in_flight > 0 and self.in_flight + ticket.cost > self.max_in_flight:
+                return
+            heapq.heappop(self._queue)
+            self._dequeued(ticket)
+            self._virtual_time = max(self._virtual_time, ticket.start_tag)
+            self.in_flight += ticket.cost
+            ticket._admit()
+
+    def _dequeued(self, ticket):
+        remaining = self._queued_per_group.get(ticket.group, 1) - 1
+        if remaining > 0:
+            self._queued_per_group[ticket.group] = remaining
+        else:
+            self._queued_per_group.pop(ticket.group, None)
+
+    @staticmethod
+    def _bucket(buckets, key, rate_per_minute, burst):
+        if rate_per_minute <= 0:
+            return None
+        bucket = buckets.get(key)
+        if bucket is None:
+            if len(buckets) >= 4096:
+                # 删除已经回满的令牌桶（等价于新建），限制内存占用
+                for stale in [name for name, existing in buckets.items() if existing.full()]:
+                    del buckets[stale]
+            bucket = buckets[key] = TokenBucket(rate_per_minute, burst)
+        return bucket
+
+    def stats(self):
+        """
+        获取调度状态
+
+        Returns:
+            dict: 进行中的生成数、排队数、按原因统计的拒绝次数
+        """
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self._queue),
+            "rejected": dict(self.rejected),
+        }
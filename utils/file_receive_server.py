@@ -0,0 +1,331 @@
+"""
+NAP 文件接收端参考实现
+
+同时支持旧协议（每个连接一个文件）与分帧流水线协议（见 nap_protocol），按连接的前4个字节自动区分。
+对收到的每个文件计算 SHA-256，按内容去重的 LOOKUP 请求命中时直接返回已有文件的路径（索引只保存在内存中）。
+DELETE 请求只能删除保存目录中的文件。
+用于本地测试与基准测试，也可以部署在 NAP 所在的主机上：
+
+    python -m utils.file_receive_server --dir /path/to/save --port 3658
+
+不依赖 AstrBot，单独部署时只需要本文件与 nap_protocol.py。
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+from pathlib import Path
+
+try:
+    from .nap_protocol import (FILE_SIZE, MAGIC, OP_DELETE, OP_LOOKUP, OP_PUT, OP_STREAM_ABORT, OP_STREAM_DATA,
+                               OP_STREAM_END, OP_STREAM_OPEN, REQUEST_HEADER, STATUS_ERROR, STATUS_NOT_FOUND,
+                               STATUS_OK, STREAM_HEADER, VERSION, encode_response)
+except ImportError:
+    from nap_protocol import (FILE_SIZE, MAGIC, OP_DELETE, OP_LOOKUP, OP_PUT, OP_STREAM_ABORT, OP_STREAM_DATA,
+                              OP_STREAM_END, OP_STREAM_OPEN, REQUEST_HEADER, STATUS_ERROR, STATUS_NOT_FOUND,
+                              STATUS_OK, STREAM_HEADER, VERSION, encode_response)
+
+logger = logging.getLogger("file_receive_server")
+
+
+class FileReceiveServer:
+    """接收文件并返回其绝对路径的 TCP 服务"""
+
+    def __init__(self, save_dir, host="0.0.0.0", port=3658, chunk_size=256 * 1024):
+        """
+        Args:
+            save_dir (Path): 文件保存目录
+            host (str): 监听地址
+            port (int): 监听端口，0 表示随机分配
+            chunk_size (int): 每次读取与写入的字节数
+        """
+        self.save_dir = Path(save_dir).resolve()
+        self.host = host
+        self.port = port
+        self.chunk_size = chunk_size
+        self.connections = 0
+        self.files_received = 0
+        self.bytes_received = 0
+        self.dedup_hits = 0
+        self.files_deleted = 0
+        self._digests = {}        # SHA-256 摘要 -> (绝对路径, 文件大小)
+        self._path_digests = {}   # 绝对路径 -> SHA-256 摘要
+        self._server = None
+
+    async def start(self):
+        """开始监听，返回实际的端口"""
+        self.save_dir.mkdir(parents=True, exist_ok=True)
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"文件接收端已启动: {self.host}:{self.port}，保存到 {self.save_dir}")
+        return self.port
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            head = await reader.readexactly(4)
+            if head == MAGIC:
+                client_version = (await reader.readexactly(1))[0]
+                writer.write(MAGIC + bytes([min(client_version, VERSION)]))
+                await writer.drain()
+                await self._serve_framed(reader, writer)
+            else:
+                await self._serve_legacy(reader, writer, struct.unpack(">I", head)[0])
+        except asyncio.IncompleteReadError:
+            pass
+        except (ConnectionError, OSError) as e:
+            logger.warning(f"连接异常: {e}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _serve_legacy(self, reader, writer, name_len):
+        name = (await reader.readexactly(name_len)).decode("utf-8")
+        size = FILE_SIZE.unpack(await reader.readexactly(FILE_SIZE.size))[0]
+        path = await self._receive_file(reader, name, size)
+        payload = path.encode("utf-8")
+        writer.write(struct.pack(">I", len(payload)) + payload)
+        await writer.drain()
+
+    async def _serve_framed(self, reader, writer):
+        streams = {}      # 请求ID -> _IncomingStream
+        try:
+            while True:
+                try:
+                    op = (await reader.readexactly(1))[0]
+                except asyncio.IncompleteReadError:
+                    return
+                if op == OP_PUT:
+                    rest = await reader.readexactly(REQUEST_HEADER.size - 1)
+                    _, request_id, name_len = REQUEST_HEADER.unpack(bytes([op]) + rest)
+                    name = (await reader.readexactly(name_len)).decode("utf-8")
+                    size = FILE_SIZE.unpack(await reader.readexactly(FILE_SIZE.size))[0]
+                    try:
+                        path = await self._receive_file(reader, name, size)
+                        writer.write(encode_response(request_id, STATUS_OK, path))
+                    except OSError as e:
+                        writer.write(encode_response(request_id, STATUS_ERROR, str(e)))
+                elif op in (OP_STREAM_OPEN, OP_STREAM_DATA, OP_STREAM_END, OP_STREAM_ABORT, OP_LOOKUP, OP_DELETE):
+                    rest = await reader.readexactly(STREAM_HEADER.size - 1)
+                    _, request_id, length = STREAM_HEADER.unpack(bytes([op]) + rest)
+                    payload = await reader.readexactly(length)
+                    response = self._handle_stream_frame(streams, op, request_id, payload)
+                    if response is None:
+                        continue
+                    writer.write(response)
+                else:
+                    logger.warning(f"未知操作 {op}，关闭连接")
+                    return
+                await writer.drain()
+        finally:
+            # 连接断开时删除未完成的流式文件
+            for stream in streams.values():
+                stream.abort()
+
+    def _handle_stream_frame(self, streams, op, request_id, payload):
+        """处理一个流帧，需要响应时返回编码后的响应"""
+        if op == OP_LOOKUP:
+            path = self.lookup(payload)
+            if path is None:
+                return encode_response(request_id, STATUS_NOT_FOUND, "")
+            self.dedup_hits += 1
+            return encode_response(request_id, STATUS_OK, path)
+        if op == OP_DELETE:
+            if self.delete(payload.decode("utf-8", "replace")):
+                return encode_response(request_id, STATUS_OK, "")
+            return encode_response(request_id, STATUS_NOT_FOUND, "")
+        if op == OP_STREAM_OPEN:
+            name = os.path.basename(payload.decode("utf-8")) or "file"
+            streams[request_id] = _IncomingStream(self.save_dir / name)
+            return None
+        stream = streams.get(request_id)
+        if stream is None:
+            return encode_response(request_id, STATUS_ERROR, "未知的流") if op != OP_STREAM_DATA else None
+        if op == OP_STREAM_DATA:
+            stream.write(payload)
+            self.bytes_received += len(payload)
+            return None
+        del streams[request_id]
+        if op == OP_STREAM_ABORT:
+            stream.abort()
+            return encode_response(request_id, STATUS_ERROR, "已取消")
+        try:
+            path = stream.finish()
+        except OSError as e:
+            return encode_response(request_id, STATUS_ERROR, str(e))
+        self.files_received += 1
+        self._index(path, stream.digest.digest(), stream.size)
+        return encode_response(request_id, STATUS_OK, path)
+
+    def lookup(self, digest):
+        """
+        按内容摘要查找已接收的文件
+
+        文件已被删除或大小发生变化（被其他内容覆盖）时视为不存在。
+
+        Args:
+            digest (bytes): SHA-256 摘要
+
+        Returns:
+            str: 文件的绝对路径，不存在时返回None
+        """
+        entry = self._digests.get(digest)
+        if entry is None:
+            return None
+        path, size = entry
+        try:
+            if os.path.getsize(path) == size:
+                return path
+        except OSError:
+            pass
+        self._forget(path)
+        return None
+
+    def delete(self, path):
+        """
+        删除保存目录中的文件
+
+        Args:
+            path (str): 接收端返回过的绝对路径
+
+        Returns:
+            bool: 文件存在并已删除时返回True
+        """
+        target = Path(path)
+        if not target.is_absolute() or target.parent.resolve() != self.save_dir:
+            logger.warning(f"拒绝删除保存目录以外的文件: {path}")
+            return False
+        self._forget(str(target))
+        try:
+            target.unlink()
+        except OSError:
+            return False
+        self.files_deleted += 1
+        return True
+
+    def _index(self, path, digest, size):
+        self._forget(path)
+        self._digests[digest] = (path, size)
+        self._path_digests[path] = digest
+
+    def _forget(self, path):
+        digest = self._path_digests.pop(path, None)
+        if digest is not None and self._digests.get(digest, (None,))[0] == path:
+            del self._digests[digest]
+
+    async def _receive_file(self, reader, name, size):
+        """
+        读取 size 字节写入保存目录
+
+        写入失败时仍会读完文件内容，保证同一连接上后续请求的边界正确。
+
+        Returns:
+            str: 文件的绝对路径
+        """
+        path = self.save_dir / (os.path.basename(name) or "file")
+        remaining = size
+        error = None
+        digest = hashlib.sha256()
+        f = None
+        try:
+            f = open(path, "wb")
+        except OSError as e:
+            error = e
+        try:
+            while remaining:
+                chunk = await reader.readexactly(min(self.chunk_size, remaining))
+                remaining -= len(chunk)
+                digest.update(chunk)
+                if f is not None and error is None:
+                    try:
+                        f.write(chunk)
+                    except OSError as e:
+                        error = e
+        finally:
+            if f is not None:
+                f.close()
+        self.bytes_received += size
+        if error is not None:
+            self._forget(str(path))
+            raise error
+        self.files_received += 1
+        self._index(str(path), digest.digest(), size)
+        return str(path)
+
+
+class _IncomingStream:
+    """接收中的流式文件，写入失败时记录错误并丢弃之后的数据"""
+
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.error = None
+        try:
+            self.file = open(path, "wb")
+        except OSError as e:
+            self.file = None
+            self.error = e
+
+    def write(self, data):
+        self.size += len(data)
+        self.digest.update(data)
+        if self.file is not None and self.error is None:
+            try:
+                self.file.write(data)
+            except OSError as e:
+                self.error = e
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+        if self.error is not None:
+            self._remove()
+            raise self.error
+        return str(self.path)
+
+    def abort(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self._remove()
+
+    def _remove(self):
+        try:
+            self.path.unlink()
+        except OSError:
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NAP 文件接收端")
+    parser.add_argument("--dir", default="received", help="文件保存目录")
+    parser.add_argument("--host", default="0.0.0.0", help="监听地址")
+    parser.add_argument("--port", type=int, default=3658, help="监听端口")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    async def serve():
+        server = FileReceiveServer(args.dir, args.host, args.port)
+        await server.start()
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,44 @@ import os
 import struct
 from astrbot.api import logger
 
+# 无法使用 sendfile 时每次读取的字节数
+FALLBACK_CHUNK_SIZE = 1024 * 1024
+
+
+async def write_file_body(writer, f, count, zero_copy=True):
+    """
+    把已打开文件从当前位置开始的 count 字节写入连接
+
+    传输支持时使用 loop.sendfile（由内核直接从页缓存复制到套接字，不经过用户态），
+    否则（如 TLS 连接或不支持 sendfile 的事件循环）在线程池中按 1MB 读取后写入，读取不阻塞事件循环。
+
+    Args:
+        writer (asyncio.StreamWriter): 连接
+        f (file): 以二进制模式打开的普通文件
+        count (int): 要发送的字节数
+        zero_copy (bool): 是否尝试 sendfile
+
+    Returns:
+        int: 实际发送的字节数，文件提前结束时小于 count
+    """
+    if zero_copy and count:
+        loop = asyncio.get_running_loop()
+        try:
+            # sendfile 会先等待 writer 中已缓冲的数据（如文件头）发送完毕
+            return await loop.sendfile(writer.transport, f, f.tell(), count, fallback=False)
+        except (asyncio.SendfileNotAvailableError, NotImplementedError, AttributeError):
+            pass
+    sent = 0
+    while sent < count:
+        data = await asyncio.to_thread(f.read, min(FALLBACK_CHUNK_SIZE, count - sent))
+        if not data:
+            break
+        writer.write(data)
+        sent += len(data)
+        await writer.drain()
+    return sent
+
+
 async def send_file(filename, host, port):
     reader = None
     writer = None
@@ -21,13 +59,14 @@ async def send_file(filename, host, port):
 
         # 发送文件内容
         await writer.drain()
-        with open(filename, "rb") as f:
-            while True:
-                data = f.read(4096)
-                if not data:
-                    break
-                writer.write(data)
-                await writer.drain()
+        f = await asyncio.to_thread(open, filename, "rb")
+        try:
+            sent = await write_file_body(writer, f, file_size)
+        finally:
+            f.close()
+        if sent != file_size:
+            logger.error(f"文件 {file_name} 大小在发送过程中发生变化")
+            return None
         logger.info(f"文件 {file_name} 发送成功")
 
         # 接收接收端发送的文件绝对路径
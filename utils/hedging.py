@@ -0,0 +1,79 @@
+import time
+from collections import deque
+
+
+class HedgePolicy:
+    """
+    对冲请求策略
+
+    主请求在阈值时间内没有响应时，使用另一个健康的密钥发起第二个请求，先成功的结果生效。
+    阈值取固定配置与近期成功请求耗时的 p90 中的较大者；对冲次数按分钟限额，避免额度消耗翻倍。
+    """
+
+    def __init__(self, delay_seconds=20, max_per_minute=5, use_p90=True, min_samples=20, sample_size=200):
+        """
+        Args:
+            delay_seconds (float): 发起对冲请求前的最短等待时间（秒）
+            max_per_minute (int): 每分钟最多发起的对冲请求数，0 表示不对冲
+            use_p90 (bool): 是否使用近期耗时的 p90 作为阈值
+            min_samples (int): 使用 p90 前至少需要的样本数
+            sample_size (int): 保留的最近耗时样本数
+        """
+        self.delay_seconds = delay_seconds
+        self.max_per_minute = max_per_minute
+        self.use_p90 = use_p90
+        self.min_samples = min_samples
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._samples = deque(maxlen=sample_size)
+        self._recent = deque()      # 最近一分钟内发起对冲的时间
+
+    def observe(self, seconds):
+        """
+        记录一次请求的耗时（秒）
+
+        对冲中被取消的请求也应记录取消时已经过的时间，否则样本只包含较快的胜出者，p90 会偏低。
+        """
+        self._samples.append(seconds)
+
+    def delay(self):
+        """
+        当前的对冲等待阈值
+
+        Returns:
+            float: 秒数
+        """
+        if self.use_p90 and len(self._samples) >= self.min_samples:
+            ordered = sorted(self._samples)
+            p90 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))]
+            return max(self.delay_seconds, p90)
+        return self.delay_seconds
+
+    def available(self):
+        """本分钟内是否仍有对冲额度（不消耗额度）"""
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] > 60:
+            self._recent.popleft()
+        return len(self._recent) < self.max_per_minute
+
+    def try_acquire(self):
+        """
+        申请一次对冲额度
+
+        Returns:
+            bool: 本分钟内仍有额度时返回True
+        """
+        if not self.available():
+            return False
+        self._recent.append(time.monotonic())
+        self.hedged += 1
+        return True
+
+    def stats(self):
+        """
+        获取对冲统计
+
+        Returns:
+            dict: 当前阈值、已发起的对冲次数与对冲请求胜出次数
+        """
+        return {"delay": self.delay(), "hedged": self.hedged, "wins": self.hedge_wins}
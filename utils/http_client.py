@@ -0,0 +1,66 @@
+import asyncio
+import aiohttp
+from astrbot.api import logger
+
+
+# 连接池默认参数
+DEFAULT_CONNECTION_LIMIT = 100      # 全局最大连接数
+DEFAULT_LIMIT_PER_HOST = 32         # 单个主机最大连接数
+DEFAULT_DNS_CACHE_TTL = 300         # DNS 缓存时间（秒）
+DEFAULT_KEEPALIVE_TIMEOUT = 75      # 空闲连接保活时间（秒）
+
+# 只有存在 SSL 传输泄漏的 Python 版本才需要清理已关闭的连接；新版 aiohttp 在其他版本上会对该参数发出弃用警告，
+# 旧版 aiohttp 没有这个常量，此时总是开启
+_ENABLE_CLEANUP_CLOSED = getattr(aiohttp.connector, "NEEDS_CLEANUP_CLOSED", True)
+
+
+class SharedHttpClient:
+    """插件生命周期内共享的 HTTP 客户端，复用 TCP/TLS 连接"""
+
+    def __init__(self, limit=DEFAULT_CONNECTION_LIMIT, limit_per_host=DEFAULT_LIMIT_PER_HOST,
+                 dns_cache_ttl=DEFAULT_DNS_CACHE_TTL, keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+
+    def get_session(self):
+        """
+        获取共享会话，首次调用或会话已关闭时创建
+
+        Returns:
+            aiohttp.ClientSession: 共享的客户端会话
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+                enable_cleanup_closed=_ENABLE_CLEANUP_CLOSED,
+            )
+            # 超时由每个请求单独指定，会话本身不设置总超时
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None),
+            )
+            logger.debug(
+                f"已创建共享HTTP客户端 (limit={self.limit}, limit_per_host={self.limit_per_host})"
+            )
+        return self._session
+
+    async def close(self):
+        """关闭共享会话并等待底层连接释放"""
+        session = self._session
+        self._session = None
+        if session is None or session.closed:
+            return
+        try:
+            await session.close()
+            # 给 SSL 连接留出正常关闭的时间，避免 "Unclosed connection" 警告
+            await asyncio.sleep(0.25)
+            logger.info("共享HTTP客户端已关闭")
+        except Exception as e:
+            logger.warning(f"关闭共享HTTP客户端时出错: {e}")
@@ -0,0 +1,295 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+import aiohttp
+from astrbot.api import logger
+from .single_flight import SingleFlight
+
+
+class ImageFetchError(IOError):
+    """参考图片下载失败"""
+
+
+class ImageTooLargeError(ImageFetchError):
+    """参考图片超过下载大小限制"""
+
+
+class ReferenceImageFetcher:
+    """
+    带缓存的参考图片下载器
+
+    - 内存中按 URL / 文件 ID 记录图片元数据（摘要、ETag、Last-Modified），
+      并按 LRU 缓存最近使用的图片内容
+    - 磁盘上按内容摘要保存图片，多个 URL 指向同一内容时只保存一份
+    - 新鲜期内直接使用缓存，过期后带条件请求重新验证（304 时不重新下载）
+    - 非 HTTP 来源（本地文件、base64）交给组件自身的 convert_to_base64 处理，下载失败时同样退回该方法
+    """
+
+    def __init__(self, session_provider, cache_dir, max_download_bytes=15 * 1024 * 1024,
+                 timeout=20, memory_bytes=64 * 1024 * 1024, disk_bytes=200 * 1024 * 1024,
+                 fresh_seconds=600, max_index_entries=4096):
+        """
+        Args:
+            session_provider (callable): 返回共享 aiohttp.ClientSession 的函数
+            cache_dir (Path): 磁盘缓存目录
+            max_download_bytes (int): 单张图片下载大小上限
+            timeout (int): 单次下载超时（秒）
+            memory_bytes (int): 内存缓存的图片总字节数上限
+            disk_bytes (int): 磁盘缓存总字节数上限
+            fresh_seconds (int): 新鲜期（秒），期内不发起任何网络请求
+            max_index_entries (int): 元数据索引条目上限
+        """
+        self.session_provider = session_provider
+        self.cache_dir = Path(cache_dir)
+        self.max_download_bytes = max_download_bytes
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.fresh_seconds = fresh_seconds
+        self.max_index_entries = max_index_entries
+        self.hits = 0
+        self.revalidated = 0
+        self.downloads = 0
+        self.fallbacks = 0
+        self._index = OrderedDict()     # key -> {"digest", "etag", "last_modified", "fetched_at"}
+        self._blobs = OrderedDict()     # digest -> bytes
+        self._blob_bytes = 0
+        self._disk_writes = 0
+        self._loaded = False
+        # 同一图片被并发请求时只下载一次
+        self._in_flight = SingleFlight()
+
+    @staticmethod
+    def _source(comp):
+        """图片组件的来源地址与缓存键（优先使用平台提供的文件ID，URL 中的签名参数可能每次不同）"""
+        url = getattr(comp, "url", None) or getattr(comp, "file", None) or ""
+        key = getattr(comp, "file_unique", None) or getattr(comp, "file", None) or url
+        return url, key
+
+    async def fetch_base64(self, comp):
+        """
+        获取图片组件的 base64 数据
+
+        Args:
+            comp (Image): 消息中的图片组件
+
+        Returns:
+            str: base64 编码的图片
+        """
+        url, key = self._source(comp)
+        if not url.startswith(("http://", "https://")):
+            return await comp.convert_to_base64()
+        try:
+            data = await self.fetch(url, key)
+        except ImageTooLargeError:
+            raise
+        except ImageFetchError as e:
+            # 组件自身的转换方式可能仍然可用（例如平台提供了本地文件或使用了不同的下载方式）
+            logger.warning(f"{e}，改用图片组件自身的转换方式")
+            self.fallbacks += 1
+            return await comp.convert_to_base64()
+        return base64.b64encode(data).decode()
+
+    async def fetch(self, url, key=None):
+        """
+        下载图片，优先使用缓存
+
+        Args:
+            url (str): 图片地址
+            key (str): 缓存键，默认使用 URL
+
+        Returns:
+            bytes: 图片数据
+
+        Raises:
+            ImageFetchError: 下载失败或超过大小限制
+        """
+        key = key or url
+        return await self._in_flight.do(key, lambda: self._fetch(url, key))
+
+    async def _fetch(self, url, key):
+        await self._ensure_loaded()
+        meta = self._index.get(key)
+        if meta is not None:
+            self._index.move_to_end(key)
+            if time.time() - meta["fetched_at"] < self.fresh_seconds:
+                data = await self._load_blob(meta["digest"])
+                if data is not None:
+                    self.hits += 1
+                    logger.debug("参考图片命中缓存，跳过下载")
+                    return data
+
+        headers = {}
+        if meta is not None and await self._has_blob(meta["digest"]):
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        session = self.session_provider()
+        try:
+            async with session.get(url, headers=headers, timeout=self.timeout) as response:
+                if response.status == 304 and meta is not None:
+                    data = await self._load_blob(meta["digest"])
+                    if data is not None:
+                        meta["fetched_at"] = time.time()
+                        self.revalidated += 1
+                        logger.debug("参考图片未变化（304），使用缓存")
+                        return data
+                    # 缓存内容已丢失，重新完整下载
+                    return await self._download(session, url, key)
+                return await self._read_response(response, url, key)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise ImageFetchError(f"下载参考图片失败: {e}") from e
+
+    async def _download(self, session, url, key):
+        try:
+            async with session.get(url, timeout=self.timeout) as response:
+                return await self._read_response(response, url, key)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise ImageFetchError(f"下载参考图片失败: {e}") from e
+
+    async def _read_response(self, response, url, key):
+        if response.status != 200:
+            raise ImageFetchError(f"下载参考图片失败: HTTP {response.status}")
+        if response.content_length and response.content_length > self.max_download_bytes:
+            raise ImageTooLargeError(f"参考图片过大: {response.content_length} bytes")
+        buffer = bytearray()
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            buffer += chunk
+            if len(buffer) > self.max_download_bytes:
+                raise ImageTooLargeError(f"参考图片超过 {self.max_download_bytes} bytes")
+        data = bytes(buffer)
+        self.downloads += 1
+
+        digest = hashlib.sha256(data).hexdigest()
+        self._index[key] = {
+            "digest": digest,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        }
+        self._index.move_to_end(key)
+        while len(self._index) > self.max_index_entries:
+            self._index.popitem(last=False)
+        self._remember_blob(digest, data)
+        await self._store_blob(digest, data)
+        return data
+
+    def _remember_blob(self, digest, data):
+        if digest in self._blobs:
+            self._blobs.move_to_end(digest)
+            return
+        self._blobs[digest] = data
+        self._blob_bytes += len(data)
+        while self._blob_bytes > self.memory_bytes and len(self._blobs) > 1:
+            _, evicted = self._blobs.popitem(last=False)
+            self._blob_bytes -= len(evicted)
+
+    def _blob_path(self, digest):
+        return self.cache_dir / f"{digest}.bin"
+
+    async def _has_blob(self, digest):
+        return digest in self._blobs or await asyncio.to_thread(self._blob_path(digest).exists)
+
+    async def _load_blob(self, digest):
+        data = self._blobs.get(digest)
+        if data is not None:
+            self._blobs.move_to_end(digest)
+            return data
+        try:
+            data = await asyncio.to_thread(self._blob_path(digest).read_bytes)
+        except OSError:
+            return None
+        if hashlib.sha256(data).hexdigest() != digest:
+            logger.warning("磁盘缓存的参考图片已损坏，重新下载")
+            return None
+        self._remember_blob(digest, data)
+        return data
+
+    async def _store_blob(self, digest, data):
+        try:
+            await asyncio.to_thread(self._write_blob, digest, data)
+        except OSError as e:
+            logger.warning(f"写入参考图片缓存失败: {e}")
+            return
+        self._disk_writes += 1
+        if self._disk_writes % 50 == 0:
+            await asyncio.to_thread(self._trim_disk)
+
+    def _write_blob(self, digest, data):
+        path = self._blob_path(digest)
+        if path.exists():
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def _trim_disk(self):
+        """磁盘缓存超过上限时按修改时间删除最旧的文件"""
+        files = []
+        with os.scandir(self.cache_dir) as it:
+            for item in it:
+                if item.name.endswith(".bin"):
+                    stat = item.stat()
+                    files.append((stat.st_mtime, stat.st_size, item.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    async def _ensure_loaded(self):
+        """首次使用时加载持久化的元数据索引"""
+        if self._loaded:
+            return
+        self._loaded = True
+        index_path = self.cache_dir / "index.json"
+        try:
+            raw = await asyncio.to_thread(index_path.read_text, "utf-8")
+            for key, meta in json.loads(raw).items():
+                self._index[key] = meta
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"加载参考图片缓存索引失败: {e}")
+
+    async def close(self):
+        """持久化元数据索引"""
+        if not self._loaded:
+            return
+        try:
+            await asyncio.to_thread(self._save_index)
+        except OSError as e:
+            logger.warning(f"保存参考图片缓存索引失败: {e}")
+
+    def _save_index(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = self.cache_dir / "index.json.tmp"
+        tmp.write_text(json.dumps(self._index, ensure_ascii=False), "utf-8")
+        os.replace(tmp, self.cache_dir / "index.json")
+
+    def stats(self):
+        """
+        获取下载器统计
+
+        Returns:
+            dict: 缓存命中、重新验证、实际下载、下载失败后退回组件转换的次数与内存缓存大小
+        """
+        return {
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "downloads": self.downloads,
+            "fallbacks": self.fallbacks,
+            "memory_bytes": self._blob_bytes,
+        }
@@ -0,0 +1,170 @@
+import asyncio
+import base64
+import binascii
+import io
+from concurrent.futures import ThreadPoolExecutor
+from astrbot.api import logger
+from .transcode_worker import convert_for_format
+
+try:
+    from PIL import Image as PILImage
+except ImportError:  # Pillow 为可选依赖，缺失时只做格式识别
+    PILImage = None
+
+
+# 文件头魔数 -> MIME 类型
+_MAGIC_NUMBERS = (
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+)
+
+# 未超过该大小且尺寸合规的图片保持原样上传，避免重复压缩损失画质
+_PASSTHROUGH_BYTES = 256 * 1024
+
+_OUTPUT_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+
+def sniff_image_mime(data):
+    """
+    根据文件头识别图片格式
+
+    Args:
+        data (bytes): 图片数据（至少前 12 字节）
+
+    Returns:
+        str: MIME 类型，无法识别时返回None
+    """
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    for magic, mime in _MAGIC_NUMBERS:
+        if data.startswith(magic):
+            return mime
+    return None
+
+
+def sniff_base64_mime(base64_image):
+    """
+    识别 base64 编码图片的格式，只解码开头的少量字符
+
+    Args:
+        base64_image (str): 不带 data URI 前缀的 base64 数据
+
+    Returns:
+        str: MIME 类型，无法识别时返回None
+    """
+    try:
+        return sniff_image_mime(base64.b64decode(base64_image[:24]))
+    except (binascii.Error, ValueError):
+        return None
+
+
+def _split_data_uri(image):
+    """拆分 data URI，返回 (声明的 MIME 类型或None, base64 数据)"""
+    if image.startswith("data:"):
+        header, _, data = image.partition(",")
+        return header[5:].split(";")[0] or None, data
+    return None, image
+
+
+def preprocess_image_bytes(data, max_edge=1536, output_format="jpeg", quality=85):
+    """
+    缩放并重新压缩图片（CPU 密集，应在工作线程中执行）
+
+    Args:
+        data (bytes): 原始图片数据
+        max_edge (int): 最长边上限，0 表示不缩放
+        output_format (str): 输出格式 jpeg / webp / original
+        quality (int): 压缩质量
+
+    Returns:
+        tuple: (图片数据, MIME 类型)
+    """
+    mime = sniff_image_mime(data) or "image/png"
+    if PILImage is None or output_format not in _OUTPUT_FORMATS:
+        return data, mime
+
+    with PILImage.open(io.BytesIO(data)) as image:
+        # 动图只取第一帧
+        image.seek(0)
+        needs_resize = bool(max_edge) and max(image.size) > max_edge
+        if not needs_resize and len(data) <= _PASSTHROUGH_BYTES:
+            return data, mime
+
+        image.load()
+        if needs_resize:
+            image.thumbnail((max_edge, max_edge), PILImage.LANCZOS)
+
+        pil_format, output_mime = _OUTPUT_FORMATS[output_format]
+        image = convert_for_format(image, pil_format)
+
+        buffer = io.BytesIO()
+        image.save(buffer, format=pil_format, quality=quality, optimize=True)
+        output = buffer.getvalue()
+
+    if not needs_resize and len(output) >= len(data):
+        # 重新压缩没有收益时保留原图
+        return data, mime
+    return output, output_mime
+
+
+class ReferenceImagePreprocessor:
+    """
+    参考图片预处理：识别真实格式、限制最长边并重新压缩
+
+    处理在独立的线程池中进行（Pillow 在解码、缩放、编码时会释放 GIL），不阻塞事件循环。
+    """
+
+    def __init__(self, max_edge=1536, output_format="jpeg", quality=85, max_workers=2):
+        """
+        Args:
+            max_edge (int): 最长边上限（像素），0 表示不缩放
+            output_format (str): 重新压缩的格式 jpeg / webp，original 表示只识别格式不重新压缩
+            quality (int): 压缩质量（1-100）
+            max_workers (int): 工作线程数
+        """
+        self.max_edge = max_edge
+        self.output_format = output_format
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="aiimg-preprocess")
+        if PILImage is None and output_format in _OUTPUT_FORMATS:
+            logger.warning("未安装 Pillow，参考图片将不会被缩放或重新压缩")
+
+    def _process_sync(self, image):
+        declared_mime, base64_data = _split_data_uri(image)
+        data = base64.b64decode(base64_data)
+        output, mime = preprocess_image_bytes(data, self.max_edge, self.output_format, self.quality)
+        if output is data and declared_mime and sniff_image_mime(data) is None:
+            mime = declared_mime
+        logger.debug(f"参考图片预处理: {len(data)} -> {len(output)} bytes ({mime})")
+        return f"data:{mime};base64,{base64.b64encode(output).decode()}"
+
+    async def process(self, image):
+        """
+        预处理单张参考图片
+
+        Args:
+            image (str): base64 编码的图片，可以带 data URI 前缀
+
+        Returns:
+            str: 带正确 MIME 类型的 data URI；处理失败时返回原始数据
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, self._process_sync, image)
+        except Exception as e:
+            logger.warning(f"参考图片预处理失败，使用原图: {e}")
+            return image
+
+    async def process_all(self, images):
+        """并发预处理多张参考图片，保持原有顺序"""
+        return list(await asyncio.gather(*(self.process(image) for image in images)))
+
+    def close(self):
+        """关闭工作线程池"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,116 @@
+import asyncio
+import dataclasses
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from astrbot.api import logger
+from .transcode_worker import PILImage, transcode_image_file
+
+
+def _pool_context():
+    """
+    进程池的启动方式：优先 forkserver，不支持时使用 spawn
+
+    不使用 fork：fork 出的工作进程会复制整个 AstrBot 进程，包括事件循环、套接字以及其他线程持有的锁。
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+
+class ImageTranscoder:
+    """
+    生成结果的输出转码：转换为 WebP / JPEG、限制尺寸并去除元数据，缩小发送到聊天平台的文件
+
+    转码在独立的进程池中进行（编码大图是 CPU 密集操作，避免占用事件循环所在进程的 GIL），进程池在首次使用时创建。
+    """
+
+    def __init__(self, output_format="original", quality=85, max_width=0, max_height=0, strip_metadata=True,
+                 keep_original=False, max_workers=2):
+        """
+        Args:
+            output_format (str): 输出格式 webp / jpeg，original 表示保持原格式
+            quality (int): 压缩质量（1-100）
+            max_width (int): 最大宽度（像素），0 表示不限制
+            max_height (int): 最大高度（像素），0 表示不限制
+            strip_metadata (bool): 是否去除元数据（仅在转码时生效）
+            keep_original (bool): 是否在 images 目录中保留原图
+            max_workers (int): 工作进程数
+        """
+        self.output_format = output_format
+        self.quality = quality
+        self.max_width = max_width
+        self.max_height = max_height
+        self.strip_metadata = strip_metadata
+        self.keep_original = keep_original
+        self.max_workers = max(1, max_workers)
+        self.transcoded = 0
+        self.bytes_saved = 0
+        self._executor = None
+        if PILImage is None and self.enabled:
+            logger.warning("未安装 Pillow，生成的图像将不会被转码")
+
+    @property
+    def enabled(self):
+        """是否配置了任何转码操作"""
+        return self.output_format in ("webp", "jpeg") or bool(self.max_width or self.max_height)
+
+    async def transcode(self, result):
+        """
+        转码生成结果中的图像
+
+        同一响应中的其余图像（extra_images）并发转码。
+
+        Args:
+            result (ImageGenerationResult): 图像保存在本地的生成结果
+
+        Returns:
+            ImageGenerationResult: 转码后的结果（新对象）；未启用、没有收益或转码失败时返回原结果
+        """
+        if not self.enabled or PILImage is None:
+            return result
+        if result.extra_images:
+            extra_images = await asyncio.gather(*(self.transcode(image) for image in result.extra_images))
+            result = dataclasses.replace(result, extra_images=list(extra_images))
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=_pool_context())
+        start = time.monotonic()
+        loop = asyncio.get_running_loop()
+        try:
+            transcoded = await loop.run_in_executor(
+                self._executor, transcode_image_file, result.image_path, self.output_format, self.quality,
+                self.max_width, self.max_height, self.strip_metadata, self.keep_original,
+            )
+        except BrokenProcessPool as e:
+            # 工作进程异常退出后进程池不可再用，下次使用时重建
+            logger.warning(f"转码进程池已失效，使用原图: {e}")
+            self._executor = None
+            return result
+        except Exception as e:
+            logger.warning(f"图像转码失败，使用原图: {e}")
+            return result
+        if transcoded is None:
+            return result
+
+        path, image_format, size, original_path = transcoded
+        self.transcoded += 1
+        self.bytes_saved += max(0, result.size - size)
+        timings = dict(result.timings)
+        timings["transcode"] = time.monotonic() - start
+        logger.info(f"图像已转码: {result.size} -> {size} bytes ({image_format})，保存到: {path}")
+        return dataclasses.replace(
+            result,
+            image_path=path,
+            image_url=f"file://{path}",
+            image_format=image_format,
+            size=size,
+            timings=timings,
+            original_path=original_path,
+            original_size=result.size if original_path else 0,
+        )
+
+    def close(self):
+        """关闭工作进程池"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,294 @@
+import time
+from collections import deque
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from astrbot.api import logger
+from .circuit_breaker import CircuitBreaker
+
+
+# 用量统计窗口（秒），免费额度按天计算
+USAGE_WINDOW = 24 * 3600
+
+
+@dataclass
+class KeyLease:
+    """一次请求对某个API密钥的占用凭据"""
+    index: int
+    key: str
+    acquired_at: float
+
+
+class KeyState:
+    """单个API密钥的健康与用量状态"""
+
+    def __init__(self, index, key, breaker):
+        self.index = index                # 从1开始的序号，仅用于日志，避免输出密钥本身
+        self.breaker = breaker
+        self.key = key
+        self.cooldown_until = 0.0         # time.monotonic() 时间，之前不可用
+        self.in_flight = 0
+        self.outcomes = deque()           # (时间, 是否出错)
+        self.request_times = deque()      # 窗口内的请求时间
+        self.usage_log = deque()          # (时间, 消耗tokens)
+        self.total_tokens = 0
+        self.total_cost = 0.0
+        self.rate_limit = None            # 来自 X-RateLimit-Limit
+        self.rate_remaining = None        # 来自 X-RateLimit-Remaining
+        self.rate_reset_at = 0.0          # time.monotonic() 时间，之后 rate_remaining 不再有效
+        self.last_used = 0.0
+        self.requests_total = 0           # 累计计数，用于运行指标
+        self.rate_limited_total = 0
+        self.errors_total = 0
+
+    def prune(self, now, error_window):
+        """丢弃统计窗口之外的记录"""
+        while self.outcomes and now - self.outcomes[0][0] > error_window:
+            self.outcomes.popleft()
+        while self.request_times and now - self.request_times[0] > USAGE_WINDOW:
+            self.request_times.popleft()
+        while self.usage_log and now - self.usage_log[0][0] > USAGE_WINDOW:
+            self.usage_log.popleft()
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return sum(1 for _, failed in self.outcomes if failed) / len(self.outcomes)
+
+    def window_tokens(self):
+        return sum(tokens for _, tokens in self.usage_log)
+
+
+class ApiKeyPool:
+    """
+    带健康检查的API密钥池
+
+    为每个密钥记录冷却截止时间、近期错误率、并发请求数与已消耗用量，
+    每次请求选择负载最低的健康密钥，并在用量接近上限前提前将其轮换出去。
+    """
+
+    def __init__(self, api_keys, daily_request_limit=0, daily_token_limit=0,
+                 rotate_threshold=0.9, default_cooldown=60, error_window=300,
+                 failure_threshold=5, breaker_open_seconds=60):
+        """
+        Args:
+            api_keys (list): API密钥列表
+            daily_request_limit (int): 单个密钥每日请求上限，0 表示不限制
+            daily_token_limit (int): 单个密钥每日 token 上限，0 表示不限制
+            rotate_threshold (float): 用量达到上限的该比例后优先使用其他密钥
+            default_cooldown (int): 限流响应未给出重置时间时的默认冷却秒数
+            error_window (int): 统计错误率的时间窗口（秒）
+            failure_threshold (int): 密钥连续认证失败或限流多少次后熔断
+            breaker_open_seconds (int): 密钥熔断的初始冷却时间（秒）
+        """
+        if isinstance(api_keys, str):
+            api_keys = [api_keys]
+        self.keys = [
+            KeyState(i + 1, key, CircuitBreaker(
+                f"API密钥 #{i + 1}", failure_threshold=failure_threshold, open_seconds=breaker_open_seconds,
+            ))
+            for i, key in enumerate(api_keys or []) if key
+        ]
+        self.daily_request_limit = daily_request_limit
+        self.daily_token_limit = daily_token_limit
+        self.rotate_threshold = rotate_threshold
+        self.default_cooldown = default_cooldown
+        self.error_window = error_window
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _usage_ratio(self, state, now):
+        """密钥已消耗的额度比例（取请求数、token数、响应头剩余额度中的最大值）"""
+        if state.rate_remaining is not None and now >= state.rate_reset_at:
+            # 额度已重置，响应头中的剩余额度过期（否则用尽过一次的密钥会一直被视为接近上限）
+            state.rate_remaining = None
+        ratios = []
+        if self.daily_request_limit:
+            ratios.append(len(state.request_times) / self.daily_request_limit)
+        if self.daily_token_limit:
+            ratios.append(state.window_tokens() / self.daily_token_limit)
+        if state.rate_limit and state.rate_remaining is not None:
+            ratios.append(1 - state.rate_remaining / state.rate_limit)
+        return max(ratios) if ratios else 0.0
+
+    def acquire(self, exclude=()):
+        """
+        选择一个可用密钥并占用
+
+        Args:
+            exclude (iterable): 本次请求已尝试过的密钥序号
+
+        Returns:
+            KeyLease: 密钥占用凭据，没有可用密钥时返回None
+        """
+        now = time.monotonic()
+        healthy = []
+        draining = []
+        for state in self.keys:
+            if state.index in exclude or state.cooldown_until > now or not state.breaker.available(now):
+                continue
+            state.prune(now, self.error_window)
+            usage_ratio = self._usage_ratio(state, now)
+            score = (state.in_flight, round(state.error_rate(), 1), usage_ratio, state.last_used)
+            if usage_ratio >= self.rotate_threshold:
+                draining.append((score, state))
+            else:
+                healthy.append((score, state))
+
+        candidates = healthy or draining
+        if not candidates:
+            return None
+        _, state = min(candidates, key=lambda item: item[0])
+        if not healthy:
+            logger.warning(f"所有健康密钥均不可用，使用接近额度上限的密钥 #{state.index}")
+
+        state.breaker.allow(now)
+        state.in_flight += 1
+        state.requests_total += 1
+        state.last_used = now
+        state.request_times.append(now)
+        return KeyLease(index=state.index, key=state.key, acquired_at=now)
+
+    def release(self, lease, status=None, headers=None, usage=None, cancelled=False):
+        """
+        归还密钥并根据响应更新其状态
+
+        Args:
+            lease (KeyLease): acquire 返回的凭据
+            status (int): HTTP 状态码，网络错误时为None
+            headers (Mapping): 响应头，用于解析 Retry-After 与限流信息
+            usage (dict): 响应中的 usage 字段
+            cancelled (bool): 请求被主动取消（如对冲请求中落败的一方），不计入错误率
+        """
+        state = self.keys[lease.index - 1]
+        now = time.monotonic()
+        state.in_flight = max(0, state.in_flight - 1)
+        if cancelled:
+            state.breaker.record_cancel()
+            return
+        if status in (401, 402, 403, 429):
+            state.breaker.record_failure()
+        elif status is not None and status < 500:
+            state.breaker.record_success()
+        else:
+            # 网络错误与服务端错误由端点熔断器处理，这里只归还探测名额
+            state.breaker.record_cancel()
+        failed = status is None or status in (401, 402, 403, 429) or status >= 500
+        if status in (402, 429):
+            state.rate_limited_total += 1
+        elif failed:
+            state.errors_total += 1
+
+        if headers:
+            self._apply_rate_limit_headers(state, headers, now)
+
+        if status == 429:
+            cooldown = parse_retry_after(headers) if headers else None
+            if cooldown is None:
+                cooldown = max(state.cooldown_until - now, self.default_cooldown)
+            self._cool_down(state, now, cooldown, "速率限制")
+        elif status == 402:
+            # 额度不足，需要较长时间才会恢复
+            self._cool_down(state, now, max(self.default_cooldown, 3600), "额度不足")
+
+        if isinstance(usage, dict):
+            tokens = usage.get("total_tokens") or 0
+            state.usage_log.append((now, tokens))
+            state.total_tokens += tokens
+            cost = usage.get("cost")
+            if isinstance(cost, (int, float)):
+                state.total_cost += cost
+
+        state.outcomes.append((now, failed))
+
+    def _apply_rate_limit_headers(self, state, headers, now):
+        """
+        解析 X-RateLimit-* 响应头，剩余额度为0时冷却到重置时间
+
+        剩余额度只在重置时间之前有效，未给出重置时间时保留 default_cooldown 秒。
+        """
+        limit = _parse_number(headers.get("X-RateLimit-Limit"))
+        remaining = _parse_number(headers.get("X-RateLimit-Remaining"))
+        if limit:
+            state.rate_limit = limit
+        if remaining is None:
+            return
+        reset_in = _parse_reset(headers.get("X-RateLimit-Reset"))
+        state.rate_remaining = remaining
+        state.rate_reset_at = now + (reset_in if reset_in else self.default_cooldown)
+        if remaining == 0 and reset_in:
+            self._cool_down(state, now, reset_in, "额度已用尽")
+
+    def _cool_down(self, state, now, seconds, reason):
+        state.cooldown_until = max(state.cooldown_until, now + seconds)
+        logger.warning(f"API密钥 #{state.index} 进入冷却 {seconds:.0f} 秒（{reason}）")
+
+    def next_available_in(self):
+        """距离最早一个冷却或熔断中的密钥恢复还有多少秒，有可用密钥时返回0"""
+        now = time.monotonic()
+        if not self.keys:
+            return None
+        return min(
+            max(state.cooldown_until - now, state.breaker.retry_in(now), 0.0)
+            for state in self.keys
+        )
+
+    def snapshot(self):
+        """
+        获取所有密钥的状态快照（不包含密钥本身）
+
+        Returns:
+            list: 每个密钥的状态字典
+        """
+        now = time.monotonic()
+        result = []
+        for state in self.keys:
+            state.prune(now, self.error_window)
+            result.append({
+                "index": state.index,
+                "cooldown": max(0.0, state.cooldown_until - now),
+                "in_flight": state.in_flight,
+                "error_rate": state.error_rate(),
+                "requests_24h": len(state.request_times),
+                "tokens_24h": state.window_tokens(),
+                "usage_ratio": self._usage_ratio(state, now),
+                "requests_total": state.requests_total,
+                "rate_limited_total": state.rate_limited_total,
+                "errors_total": state.errors_total,
+                "breaker": state.breaker.snapshot(),
+            })
+        return result
+
+
+def _parse_number(value):
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_retry_after(headers):
+    """解析 Retry-After 响应头（秒数或HTTP日期），返回需要等待的秒数"""
+    value = headers.get("Retry-After")
+    if not value:
+        return _parse_reset(headers.get("X-RateLimit-Reset"))
+    seconds = _parse_number(value)
+    if seconds is not None:
+        return max(0.0, seconds)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_reset(value):
+    """解析 X-RateLimit-Reset（OpenRouter 使用毫秒时间戳），返回距离重置的秒数"""
+    reset = _parse_number(value)
+    if reset is None:
+        return None
+    if reset > 1e11:
+        reset /= 1000
+    if reset > 1e9:
+        return max(0.0, reset - time.time())
+    # 较小的数值视为相对秒数
+    return reset
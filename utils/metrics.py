@@ -0,0 +1,241 @@
+import asyncio
+import bisect
+import time
+from collections import deque
+from contextlib import contextmanager
+from aiohttp import web
+from astrbot.api import logger
+
+
+# 直方图分桶上限（秒），覆盖从毫秒级的磁盘写入到分钟级的上游等待
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+
+class LatencyHistogram:
+    """
+    单个阶段的耗时统计
+
+    同时维护累计分桶（用于 Prometheus 导出）与最近一段时间的样本（用于计算滚动分位数）。
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=900, max_samples=2048):
+        """
+        Args:
+            buckets (tuple): 分桶上限（秒），升序
+            window (int): 滚动分位数的时间窗口（秒）
+            max_samples (int): 窗口内最多保留的样本数
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.window = window
+        self._samples = deque(maxlen=max_samples)    # (时间, 耗时)
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self._samples.append((time.monotonic(), seconds))
+
+    def percentiles(self, quantiles=(0.5, 0.95, 0.99)):
+        """
+        计算滚动窗口内的分位数
+
+        Returns:
+            dict: 分位数 -> 耗时（秒），窗口内没有样本时为空
+        """
+        cutoff = time.monotonic() - self.window
+        while self._samples and self._samples[0][0] < cutoff:
+            self._samples.popleft()
+        values = sorted(value for _, value in self._samples)
+        if not values:
+            return {}
+        return {q: values[min(len(values) - 1, int(len(values) * q))] for q in quantiles}
+
+    def window_count(self):
+        return len(self._samples)
+
+
+class MetricsRegistry:
+    """
+    插件运行指标：各阶段耗时直方图、计数器与实时读取的指标
+
+    计数器与直方图在事件循环中更新，不需要加锁。
+    """
+
+    def __init__(self, prefix="aiimg"):
+        self.prefix = prefix
+        self.histograms = {}      # 阶段 -> LatencyHistogram
+        self.counters = {}        # (名称, 标签元组) -> 数值
+        self._gauges = {}         # 名称 -> (说明, 返回 {标签元组: 数值} 的函数, 指标类型)
+        self._help = {}
+
+    def observe(self, phase, seconds):
+        """记录一个阶段的耗时（秒）"""
+        histogram = self.histograms.get(phase)
+        if histogram is None:
+            histogram = self.histograms[phase] = LatencyHistogram()
+        histogram.observe(seconds)
+
+    def observe_timings(self, timings):
+        """记录 ImageGenerationResult.timings 中的所有阶段"""
+        for phase, seconds in (timings or {}).items():
+            if isinstance(seconds, (int, float)):
+                self.observe(phase, seconds)
+
+    @contextmanager
+    def timer(self, phase):
+        """统计 with 块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def inc(self, name, value=1, **labels):
+        """增加计数器"""
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def counter(self, name, **labels):
+        return self.counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def register_gauge(self, name, description, func, metric_type="gauge"):
+        """
+        注册在读取时才计算的指标（如进行中的请求数、缓存命中率、其他组件维护的累计计数）
+
+        Args:
+            name (str): 指标名称
+            description (str): 指标说明
+            func (callable): 返回数值，或 {标签元组: 数值} 的函数
+            metric_type (str): gauge 或 counter（单调递增的累计值）
+        """
+        self._gauges[name] = (description, func, metric_type)
+
+    def describe(self, name, description):
+        """设置计数器在 Prometheus 导出中的说明"""
+        self._help[name] = description
+
+    def phase_summary(self):
+        """
+        各阶段的滚动分位数
+
+        Returns:
+            dict: 阶段 -> {"count", "p50", "p95", "p99"}
+        """
+        summary = {}
+        for phase, histogram in self.histograms.items():
+            values = histogram.percentiles()
+            if values:
+                summary[phase] = {
+                    "count": histogram.window_count(),
+                    "p50": values[0.5],
+                    "p95": values[0.95],
+                    "p99": values[0.99],
+                }
+        return summary
+
+    def render_prometheus(self):
+        """
+        以 Prometheus 文本格式导出所有指标
+
+        Returns:
+            str: 指标文本
+        """
+        lines = []
+        name = f"{self.prefix}_phase_seconds"
+        if self.histograms:
+            lines.append(f"# HELP {name} Latency of each image generation phase")
+            lines.append(f"# TYPE {name} histogram")
+            for phase, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{phase="{phase}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{phase="{phase}"}} {histogram.sum:.6f}')
+                lines.append(f'{name}_count{{phase="{phase}"}} {histogram.count}')
+
+        counters = {}
+        for (counter_name, labels), value in self.counters.items():
+            counters.setdefault(counter_name, []).append((labels, value))
+        for counter_name, samples in sorted(counters.items()):
+            full_name = f"{self.prefix}_{counter_name}_total"
+            lines.append(f"# HELP {full_name} {self._help.get(counter_name, counter_name)}")
+            lines.append(f"# TYPE {full_name} counter")
+            for labels, value in sorted(samples):
+                lines.append(f"{full_name}{_format_labels(labels)} {value}")
+
+        for gauge_name, (description, func, metric_type) in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logger.debug(f"读取指标 {gauge_name} 失败: {e}")
+                continue
+            full_name = f"{self.prefix}_{gauge_name}" + ("_total" if metric_type == "counter" else "")
+            lines.append(f"# HELP {full_name} {description}")
+            lines.append(f"# TYPE {full_name} {metric_type}")
+            samples = value.items() if isinstance(value, dict) else [((), value)]
+            for labels, sample in samples:
+                lines.append(f"{full_name}{_format_labels(labels)} {sample}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class PrometheusExporter:
+    """在本地端口以 Prometheus 文本格式提供 /metrics"""
+
+    def __init__(self, registry, host="127.0.0.1", port=9464):
+        """
+        Args:
+            registry (MetricsRegistry): 指标注册表
+            host (str): 监听地址，默认只监听本机
+            port (int): 监听端口
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._runner = None
+        self._task = None
+
+    async def _handle(self, request):
+        return web.Response(text=self.registry.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    def start(self):
+        """在当前事件循环中启动 HTTP 服务"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._serve())
+
+    async def _serve(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, self.host, self.port).start()
+        except OSError as e:
+            # 端口被占用等错误只记录日志，不影响插件运行
+            logger.error(f"启动指标导出服务失败 ({self.host}:{self.port}): {e}")
+            await runner.cleanup()
+            return
+        self._runner = runner
+        logger.info(f"指标导出服务已启动: http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        """停止 HTTP 服务"""
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,558 @@
+import asyncio
+import hashlib
+import itertools
+import os
+import time
+from collections import OrderedDict, deque
+from astrbot.api import logger
+from .file_send_server import send_file, write_file_body
+from .nap_protocol import (DEDUP_VERSION, DELETE_VERSION, MAGIC, OP_STREAM_ABORT, OP_STREAM_DATA, OP_STREAM_END,
+                           OP_STREAM_OPEN, RESPONSE_HEADER, STATUS_OK, STREAM_VERSION, encode_delete, encode_hello,
+                           encode_lookup, encode_put, encode_stream_frame)
+from .stream_decoder import FileImageSink, SinkError, new_image_path
+
+
+class _FramedConnection:
+    """
+    一个分帧协议连接
+
+    请求在写锁内完整写出（请求头与文件内容不会与其他请求交错），不等待响应即可发送下一个请求；
+    后台任务按顺序读取响应并交给对应的等待者。连接出错时所有等待中的请求都会失败，连接不再使用。
+    """
+
+    def __init__(self, reader, writer, idle_timeout, version):
+        self.reader = reader
+        self.writer = writer
+        self.idle_timeout = idle_timeout
+        self.version = version            # 握手协商的协议版本
+        self.pending = deque()            # (请求ID, future)，与响应顺序一致
+        self.reserved = 0                 # 已分配到本连接、尚未完成的请求数（包括等待写锁的请求）
+        self.closed = False
+        self.files_sent = 0
+        self._write_lock = asyncio.Lock()
+        self._idle_handle = None
+        self._reader_task = asyncio.create_task(self._read_responses())
+
+    async def put(self, request_id, path, file_name, file_size):
+        """
+        发送一个文件并等待接收端的响应
+
+        Returns:
+            tuple: (状态, 绝对路径或错误信息)
+        """
+        future = asyncio.get_running_loop().create_future()
+        # 先打开文件，文件不存在时不会影响连接
+        f = await asyncio.to_thread(open, path, "rb")
+        try:
+            async with self._write_lock:
+                if self.closed:
+                    raise ConnectionError("连接已关闭")
+                self._cancel_idle()
+                self.pending.append((request_id, future))
+                try:
+                    self.writer.write(encode_put(request_id, file_name, file_size))
+                    if await write_file_body(self.writer, f, file_size) != file_size:
+                        raise OSError("文件大小在发送过程中发生变化")
+                except BaseException as e:
+                    # 请求只写出了一部分，连接上的数据边界已经错乱
+                    self.close(e if isinstance(e, Exception) else ConnectionError("发送被取消"))
+                    raise
+                self.files_sent += 1
+        finally:
+            f.close()
+        return await future
+
+    async def send_frame(self, frame, request_id=None):
+        """
+        发送一个流帧
+
+        Args:
+            frame (bytes): 编码后的帧
+            request_id (int): 该帧需要响应时的请求ID
+
+        Returns:
+            asyncio.Future: 需要响应时返回等待响应的 future，否则返回None
+        """
+        future = None
+        async with self._write_lock:
+            if self.closed:
+                raise ConnectionError("连接已关闭")
+            self._cancel_idle()
+            if request_id is not None:
+                future = asyncio.get_running_loop().create_future()
+                self.pending.append((request_id, future))
+            try:
+                # 帧在 write 时已完整进入缓冲区，drain 被取消不会破坏数据边界
+                self.writer.write(frame)
+                await self.writer.drain()
+            except Exception as e:
+                self.close(e)
+                raise
+        return future
+
+    async def _read_responses(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(RESPONSE_HEADER.size)
+                request_id, status, length = RESPONSE_HEADER.unpack(header)
+                text = (await self.reader.readexactly(length)).decode("utf-8")
+                if not self.pending or self.pending[0][0] != request_id:
+                    raise ConnectionError(f"收到意外的响应 #{request_id}")
+                _, future = self.pending.popleft()
+                if not future.done():
+                    future.set_result((status, text))
+                if not self.pending:
+                    self._schedule_idle()
+        except asyncio.CancelledError:
+            raise
+        except asyncio.IncompleteReadError:
+            self.close(ConnectionError("接收端关闭了连接"))
+        except (ConnectionError, OSError, UnicodeDecodeError) as e:
+            self.close(e)
+
+    def _schedule_idle(self):
+        self._cancel_idle()
+        self._idle_handle = asyncio.get_running_loop().call_later(self.idle_timeout, self._close_if_idle)
+
+    def _cancel_idle(self):
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def _close_if_idle(self):
+        if not self.pending and not self.reserved:
+            self.close()
+
+    def close(self, error=None):
+        """关闭连接，等待中的请求以 ConnectionError 失败"""
+        if self.closed:
+            return
+        self.closed = True
+        self._cancel_idle()
+        error = error if isinstance(error, ConnectionError) else ConnectionError(str(error or "连接已关闭"))
+        while self.pending:
+            _, future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+        if asyncio.current_task() is not self._reader_task:
+            self._reader_task.cancel()
+        self.writer.close()
+
+
+class NapFileClient:
+    """
+    NAP 文件传输客户端
+
+    分帧协议下维护少量长连接：请求优先发往等待中请求最少的连接，连接上的请求数达到流水线上限且连接数未满时才新建连接，
+    空闲超过 idle_timeout 的连接自动关闭。旧协议的接收端每个连接只处理一个文件，此时退回到 send_file。
+
+    开启去重时记录发送过的文件内容摘要与接收端路径；再次发送相同内容时先用摘要向接收端确认文件仍然存在，
+    命中则不再发送文件内容（需要接收端支持协议版本3）。
+    """
+
+    def __init__(self, host, port, protocol="framed", max_connections=2, max_pipeline=8, idle_timeout=60,
+                 connect_timeout=10, response_timeout=120, dedup=True, max_dedup_entries=4096):
+        """
+        Args:
+            host (str): 接收端地址
+            port (int): 接收端端口
+            protocol (str): framed（分帧流水线协议）或 legacy（每个文件一个连接）
+            max_connections (int): 分帧协议下的最大连接数
+            max_pipeline (int): 单个连接上同时等待响应的请求数，超过时优先新建连接
+            idle_timeout (float): 连接空闲多久后关闭（秒）
+            connect_timeout (float): 建立连接与握手的超时（秒）
+            response_timeout (float): 单个文件从开始发送到收到响应的超时（秒）
+            dedup (bool): 是否按内容去重（仅分帧协议）
+            max_dedup_entries (int): 记录的摘要 -> 接收端路径数量上限，超出时淘汰最久未使用的记录
+        """
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.max_connections = max(1, max_connections)
+        self.max_pipeline = max(1, max_pipeline)
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.response_timeout = response_timeout
+        self.connections_opened = 0
+        self.files_sent = 0
+        self.bytes_sent = 0
+        self.dedup = dedup
+        self.max_dedup_entries = max(1, max_dedup_entries)
+        self.dedup_hits = 0
+        self.bytes_saved = 0
+        self._remote_paths = OrderedDict()    # 文件内容的 SHA-256 摘要 -> 接收端路径
+        self._connections = []
+        self._connect_lock = asyncio.Lock()
+        self._request_ids = itertools.count(1)
+
+    async def send_file(self, path):
+        """
+        发送文件到接收端
+
+        Args:
+            path (str): 本地文件路径
+
+        Returns:
+            str: 接收端保存的绝对路径，失败时返回None
+        """
+        if self.protocol != "framed":
+            remote_path = await send_file(path, self.host, self.port)
+            if remote_path:
+                self.files_sent += 1
+                self.connections_opened += 1
+            return remote_path
+
+        file_name = os.path.basename(path)
+        start = time.monotonic()
+        digest = None
+        try:
+            file_size = os.path.getsize(path)
+            if self.dedup:
+                digest = await asyncio.to_thread(_file_digest, path)
+        except OSError as e:
+            logger.error(f"文件操作失败: {e}")
+            return None
+
+        # 复用的连接可能已被接收端关闭，此时在新连接上重发一次（重复发送同一文件是幂等的）
+        for attempt in range(2):
+            reused = False
+            try:
+                connection, reused = await self._acquire()
+                connection.reserved += 1
+                try:
+                    # 发送过相同内容时先确认接收端仍保留该文件，命中则跳过文件内容
+                    if digest in self._remote_paths and connection.version >= DEDUP_VERSION:
+                        remote_path = await asyncio.wait_for(self._lookup(connection, digest), self.response_timeout)
+                        if remote_path:
+                            self.dedup_hits += 1
+                            self.bytes_saved += file_size
+                            logger.info(f"文件 {file_name} 内容已存在于接收端，跳过发送: {remote_path}")
+                            return remote_path
+                    status, text = await asyncio.wait_for(
+                        connection.put(next(self._request_ids), path, file_name, file_size), self.response_timeout
+                    )
+                finally:
+                    connection.reserved -= 1
+            except asyncio.TimeoutError:
+                logger.error(f"发送文件 {file_name} 超时")
+                return None
+            except ConnectionError as e:
+                if attempt == 0 and reused:
+                    logger.debug(f"复用的连接已断开，重新连接: {e}")
+                    continue
+                logger.error(f"网络连接失败: {e}")
+                return None
+            except OSError as e:
+                logger.error(f"文件传输失败: {e}")
+                return None
+            if status != STATUS_OK:
+                logger.error(f"接收端保存文件 {file_name} 失败: {text}")
+                return None
+            self.files_sent += 1
+            self.bytes_sent += file_size
+            if digest is not None:
+                self._remember(digest, text)
+            logger.info(f"文件 {file_name} 发送成功（{file_size} bytes，{time.monotonic() - start:.2f}s），接收端路径: {text}")
+            return text
+
+    async def _lookup(self, connection, digest):
+        """
+        按内容摘要向接收端查找文件，未找到时从本地记录中移除
+
+        Returns:
+            str: 接收端已有文件的路径，不存在时返回None
+        """
+        request_id = next(self._request_ids)
+        future = await connection.send_frame(encode_lookup(request_id, digest), request_id=request_id)
+        status, text = await future
+        if status == STATUS_OK:
+            self._remote_paths.move_to_end(digest)
+            return text
+        self._remote_paths.pop(digest, None)
+        return None
+
+    def _remember(self, digest, remote_path):
+        self._remote_paths[digest] = remote_path
+        self._remote_paths.move_to_end(digest)
+        while len(self._remote_paths) > self.max_dedup_entries:
+            self._remote_paths.popitem(last=False)
+
+    async def delete(self, remote_path, wait=True):
+        """
+        删除接收端上的文件（需要接收端支持协议版本4）
+
+        Args:
+            remote_path (str): 接收端返回过的绝对路径
+            wait (bool): 是否等待接收端的响应；为False时只保证请求已发出
+
+        Returns:
+            bool: 已删除（不等待响应时为已发出删除请求）时返回True
+        """
+        if self.protocol != "framed":
+            return False
+        for digest in [digest for digest, path in self._remote_paths.items() if path == remote_path]:
+            del self._remote_paths[digest]
+        try:
+            connection, _ = await self._acquire()
+            if connection.version < DELETE_VERSION:
+                logger.debug("接收端不支持删除文件，保留未使用的图像")
+                return False
+            request_id = next(self._request_ids)
+            future = await connection.send_frame(encode_delete(request_id, remote_path), request_id=request_id)
+            if not wait:
+                future.add_done_callback(lambda done: done.cancelled() or done.exception())
+                return True
+            status, _ = await asyncio.wait_for(future, self.response_timeout)
+        except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+            logger.warning(f"删除接收端文件失败: {e}")
+            return False
+        return status == STATUS_OK
+
+    async def open_stream(self, file_name):
+        """
+        开始一次大小未知的流式上传
+
+        Args:
+            file_name (str): 接收端保存的文件名
+
+        Returns:
+            NapUploadStream: 上传流
+
+        Raises:
+            ConnectionError: 未使用 framed 协议、接收端不支持流式上传或连接失败
+        """
+        if self.protocol != "framed":
+            raise ConnectionError("流式发送需要 framed 协议")
+        for attempt in range(2):
+            connection, reused = await self._acquire()
+            if connection.version < STREAM_VERSION:
+                raise ConnectionError("接收端不支持流式上传，请更新接收端")
+            request_id = next(self._request_ids)
+            connection.reserved += 1
+            try:
+                await connection.send_frame(encode_stream_frame(OP_STREAM_OPEN, request_id, file_name.encode("utf-8")))
+            except ConnectionError:
+                connection.reserved -= 1
+                if attempt == 0 and reused:
+                    continue
+                raise
+            except BaseException:
+                connection.reserved -= 1
+                raise
+            return NapUploadStream(self, connection, request_id)
+
+    async def _acquire(self):
+        """
+        选择一个连接
+
+        Returns:
+            tuple: (连接, 是否为已有连接)
+        """
+        self._connections = [conn for conn in self._connections if not conn.closed]
+        best = min(self._connections, key=lambda conn: conn.reserved, default=None)
+        if best is not None and (best.reserved < self.max_pipeline or len(self._connections) >= self.max_connections):
+            return best, True
+        async with self._connect_lock:
+            # 等待锁期间其他请求可能已经建立了新连接
+            self._connections = [conn for conn in self._connections if not conn.closed]
+            idle = [conn for conn in self._connections if conn.reserved < self.max_pipeline]
+            if idle:
+                return min(idle, key=lambda conn: conn.reserved), True
+            if len(self._connections) >= self.max_connections:
+                return min(self._connections, key=lambda conn: conn.reserved), True
+            try:
+                connection = await asyncio.wait_for(self._connect(), self.connect_timeout)
+            except asyncio.TimeoutError:
+                raise ConnectionError("连接或握手超时（接收端可能不支持分帧协议）")
+            self._connections.append(connection)
+            return connection, False
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(encode_hello())
+            await writer.drain()
+            reply = await reader.readexactly(len(MAGIC) + 1)
+        except asyncio.IncompleteReadError:
+            writer.close()
+            raise ConnectionError("接收端不支持分帧协议，请将 nap_protocol 设置为 legacy")
+        except BaseException:
+            writer.close()
+            raise
+        if reply[:len(MAGIC)] != MAGIC or reply[-1] < 1:
+            writer.close()
+            raise ConnectionError("接收端不支持分帧协议，请将 nap_protocol 设置为 legacy")
+        self.connections_opened += 1
+        logger.debug(f"已建立到 {self.host}:{self.port} 的文件传输连接（共 {len(self._connections) + 1} 个）")
+        return _FramedConnection(reader, writer, self.idle_timeout, reply[-1])
+
+    def stats(self):
+        """
+        获取传输统计
+
+        Returns:
+            dict: 当前连接数、累计建立的连接数、发送的文件数与字节数、去重命中数与节省的字节数
+        """
+        return {
+            "connections": sum(1 for conn in self._connections if not conn.closed),
+            "opened": self.connections_opened,
+            "files": self.files_sent,
+            "bytes": self.bytes_sent,
+            "dedup_hits": self.dedup_hits,
+            "bytes_saved": self.bytes_saved,
+        }
+
+    async def close(self):
+        """关闭所有连接"""
+        connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        for connection in connections:
+            try:
+                await connection.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+
+def _file_digest(path, chunk_size=1024 * 1024):
+    """计算文件内容的 SHA-256 摘要（在线程池中调用）"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.digest()
+
+
+class NapUploadStream:
+    """一次流式上传，由 NapFileClient.open_stream 创建"""
+
+    def __init__(self, client, connection, request_id):
+        self.client = client
+        self.connection = connection
+        self.request_id = request_id
+        self.size = 0
+        self._released = False
+
+    async def write(self, data):
+        """发送一段文件数据"""
+        await self.connection.send_frame(encode_stream_frame(OP_STREAM_DATA, self.request_id, data))
+        self.size += len(data)
+
+    async def finish(self):
+        """
+        完成上传并等待接收端的响应
+
+        Returns:
+            str: 接收端保存的绝对路径
+
+        Raises:
+            ConnectionError: 连接断开或接收端保存失败
+        """
+        try:
+            future = await self.connection.send_frame(encode_stream_frame(OP_STREAM_END, self.request_id),
+                                                      request_id=self.request_id)
+            status, text = await asyncio.wait_for(future, self.client.response_timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError("等待接收端响应超时")
+        finally:
+            self._release()
+        if status != STATUS_OK:
+            raise ConnectionError(f"接收端保存文件失败: {text}")
+        self.client.files_sent += 1
+        self.client.bytes_sent += self.size
+        return text
+
+    async def abort(self):
+        """放弃上传，接收端删除不完整的文件"""
+        if self._released:
+            return
+        self._release()
+        if self.connection.closed:
+            return
+        try:
+            future = await self.connection.send_frame(encode_stream_frame(OP_STREAM_ABORT, self.request_id),
+                                                      request_id=self.request_id)
+            # 取消的响应没有调用方等待
+            future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        except (ConnectionError, OSError):
+            pass
+
+    def _release(self):
+        if not self._released:
+            self._released = True
+            self.connection.reserved -= 1
+
+
+class NapStreamSink:
+    """
+    StreamingImageExtractor 的 sink：把解码后的图像字节直接流式发送到 NAP 接收端，不写本地文件
+
+    无法建立流时退回到写入本地 images 目录（此时 local 为True）；发送过程中连接断开时抛出 SinkError。
+    已发送完成的图像没有被使用时通过 discard 从接收端删除。
+    """
+
+    def __init__(self, client, image_format, prefix="gemini_image"):
+        """
+        Args:
+            client (NapFileClient): 使用 framed 协议的传输客户端
+            image_format (str): 图像格式（文件扩展名）
+            prefix (str): 文件名前缀
+        """
+        self.client = client
+        self.image_format = image_format
+        self.prefix = prefix
+        self.name = new_image_path("", image_format, prefix).name
+        self.size = 0
+        self.local = False
+        self._stream = None
+        self._fallback = None
+        self._location = None
+
+    async def open(self):
+        try:
+            self._stream = await self.client.open_stream(self.name)
+        except (ConnectionError, OSError) as e:
+            logger.warning(f"无法直接发送到 NAP，改为保存到本地: {e}")
+            self._fallback = FileImageSink(self.image_format, prefix=self.prefix)
+            self.local = True
+            await self._fallback.open()
+
+    async def write(self, data):
+        if self._fallback is not None:
+            await self._fallback.write(data)
+        else:
+            try:
+                await self._stream.write(data)
+            except (ConnectionError, OSError) as e:
+                raise SinkError(f"发送图像到 NAP 失败: {e}") from e
+        self.size += len(data)
+
+    async def close(self):
+        """
+        完成发送
+
+        Returns:
+            str: 接收端的绝对路径（退回本地时为本地路径）
+        """
+        if self._fallback is not None:
+            return await self._fallback.close()
+        try:
+            self._location = await self._stream.finish()
+        except (ConnectionError, OSError) as e:
+            raise SinkError(f"发送图像到 NAP 失败: {e}") from e
+        return self._location
+
+    async def discard(self):
+        """删除已发送完成、但最终没有被使用的图像（不等待接收端响应）"""
+        if self._location is not None:
+            await self.client.delete(self._location, wait=False)
+            self._location = None
+
+    async def abort(self):
+        if self._fallback is not None:
+            await self._fallback.abort()
+        elif self._stream is not None:
+            await self._stream.abort()
@@ -0,0 +1,85 @@
+"""
+NAP 文件传输协议
+
+旧协议（send_file）：每个连接只传一个文件，
+    客户端 -> [文件名长度 u32][文件名][文件大小 u64][文件内容]
+    接收端 -> [绝对路径长度 u32][绝对路径]，随后关闭连接
+
+分帧协议：连接建立后先握手，之后同一个连接上可以连续发送多个请求而不等待响应（流水线），
+接收端按请求顺序返回响应，连接可以长期复用。
+    握手：客户端 -> MAGIC + [版本 u8]，接收端 -> MAGIC + [双方都支持的最高版本 u8]
+    PUT 请求：[操作 u8][请求ID u32][文件名长度 u16][文件名][文件大小 u64][文件内容]
+    响应：[请求ID u32][状态 u8][内容长度 u32][内容]，成功时内容为绝对路径，失败时为错误信息
+版本2增加了大小未知的流式上传，用于边解码边发送：
+    流帧：[操作 u8][请求ID u32][内容长度 u32][内容]
+    STREAM_OPEN 的内容为文件名，STREAM_DATA 为文件数据，STREAM_END 完成文件并返回响应，
+    STREAM_ABORT 放弃并删除不完整的文件（同样返回一个失败响应）。
+    不同请求的流帧可以交错发送；响应按 PUT / STREAM_END / STREAM_ABORT 的发送顺序返回。
+版本3增加了按内容去重：
+    LOOKUP 使用流帧格式，内容为文件的 SHA-256 摘要（32字节）。接收端已有相同内容的文件时返回 STATUS_OK 与其绝对路径，
+    否则返回 STATUS_NOT_FOUND，客户端再用 PUT 发送文件。接收端对收到的每个文件计算摘要，重复发送同一张图像只需几十个字节。
+版本4增加了删除已完成的文件：
+    DELETE 使用流帧格式，内容为接收端返回过的绝对路径。用于流式发送完成、但最终没有被使用的图像
+    （例如对冲中被取消的请求、之后被内容过滤拦截的响应），接收端只删除保存目录中的文件。
+旧接收端不认识握手，因此分帧协议需要在配置中显式开启；参考接收端（file_receive_server）同时支持两种协议。
+本模块只包含协议常量与编解码，不依赖 AstrBot，接收端可以单独部署。
+"""
+import struct
+
+MAGIC = b"NAPF"
+VERSION = 4
+# 支持流式上传的最低版本
+STREAM_VERSION = 2
+# 支持按内容去重的最低版本
+DEDUP_VERSION = 3
+# 支持删除文件的最低版本
+DELETE_VERSION = 4
+
+# 操作
+OP_PUT = 1
+OP_STREAM_OPEN = 2
+OP_STREAM_DATA = 3
+OP_STREAM_END = 4
+OP_STREAM_ABORT = 5
+OP_LOOKUP = 6
+OP_DELETE = 7
+
+# 响应状态
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_NOT_FOUND = 2
+
+REQUEST_HEADER = struct.Struct(">BIH")    # 操作、请求ID、文件名长度
+STREAM_HEADER = struct.Struct(">BII")     # 操作、请求ID、内容长度
+FILE_SIZE = struct.Struct(">Q")
+RESPONSE_HEADER = struct.Struct(">IBI")   # 请求ID、状态、内容长度
+
+
+def encode_hello(version=VERSION):
+    return MAGIC + bytes([version])
+
+
+def encode_put(request_id, file_name, file_size):
+    """编码 PUT 请求头（不含文件内容）"""
+    name = file_name.encode("utf-8")
+    return REQUEST_HEADER.pack(OP_PUT, request_id, len(name)) + name + FILE_SIZE.pack(file_size)
+
+
+def encode_stream_frame(op, request_id, payload=b""):
+    """编码一个流帧"""
+    return STREAM_HEADER.pack(op, request_id, len(payload)) + payload
+
+
+def encode_lookup(request_id, digest):
+    """编码按内容摘要查找文件的请求"""
+    return encode_stream_frame(OP_LOOKUP, request_id, digest)
+
+
+def encode_delete(request_id, remote_path):
+    """编码删除接收端文件的请求"""
+    return encode_stream_frame(OP_DELETE, request_id, remote_path.encode("utf-8"))
+
+
+def encode_response(request_id, status, text):
+    payload = text.encode("utf-8")
+    return RESPONSE_HEADER.pack(request_id, status, len(payload)) + payload
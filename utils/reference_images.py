@@ -0,0 +1,130 @@
+import asyncio
+from dataclasses import dataclass
+from astrbot.api import logger
+from astrbot.core.message.components import Image, Reply
+from .result_cache import digest_reference_image
+
+
+@dataclass
+class ReferenceImage:
+    """从消息中提取的参考图片"""
+    data: str       # base64 编码的图片
+    digest: str     # 内容摘要，用于去重与结果缓存
+    size: int       # 解码后的近似字节数
+    source: str     # "message" 或 "reply"
+
+
+class ReferenceImageExtractor:
+    """
+    从当前消息与引用消息中提取参考图片
+
+    所有图片并发转换（受并发上限约束），按内容摘要去重，
+    并限制图片数量与总字节数。
+    """
+
+    def __init__(self, max_images=6, max_total_bytes=20 * 1024 * 1024, concurrency=4, fetcher=None):
+        """
+        Args:
+            max_images (int): 最多使用的参考图片数量
+            max_total_bytes (int): 参考图片总字节数上限
+            concurrency (int): 同时转换的图片数量上限
+            fetcher (ReferenceImageFetcher): 带缓存的下载器，未提供时直接调用组件的 convert_to_base64
+        """
+        self.fetcher = fetcher
+        self.max_images = max_images
+        self.max_total_bytes = max_total_bytes
+        self.concurrency = concurrency
+
+    @staticmethod
+    def collect_components(event):
+        """
+        收集消息与引用消息中的图片组件，按出现顺序排列
+
+        Returns:
+            list: (来源, Image组件) 列表，来源相同的重复组件只保留一次
+        """
+        components = []
+        seen = set()
+        if not (hasattr(event, 'message_obj') and event.message_obj and hasattr(event.message_obj, 'message')):
+            return components
+
+        def add(source, comp):
+            # 同一图片可能同时出现在消息与引用中，按 url/file 预先去重以避免重复转换
+            identity = getattr(comp, "url", None) or getattr(comp, "file", None) or id(comp)
+            if identity in seen:
+                return
+            seen.add(identity)
+            components.append((source, comp))
+
+        for comp in event.message_obj.message:
+            if isinstance(comp, Image):
+                add("message", comp)
+            elif isinstance(comp, Reply):
+                # Reply组件的chain字段包含被引用的消息内容
+                if comp.chain:
+                    for reply_comp in comp.chain:
+                        if isinstance(reply_comp, Image):
+                            add("reply", reply_comp)
+                else:
+                    logger.debug("引用消息的chain为空，无法获取图片内容")
+        return components
+
+    async def _convert(self, semaphore, source, comp):
+        async with semaphore:
+            try:
+                if self.fetcher is not None:
+                    return source, await self.fetcher.fetch_base64(comp)
+                return source, await comp.convert_to_base64()
+            except (IOError, ValueError, OSError) as e:
+                logger.warning(f"转换{'引用' if source == 'reply' else '当前'}消息中的参考图片到base64失败: {e}")
+            except Exception as e:
+                logger.error(f"处理{'引用' if source == 'reply' else '当前'}消息中的图片时出现未预期的错误: {e}")
+            return source, None
+
+    async def extract(self, event):
+        """
+        提取参考图片
+
+        Args:
+            event (AstrMessageEvent): 消息事件
+
+        Returns:
+            list: ReferenceImage 列表，顺序与消息中出现的顺序一致
+        """
+        components = self.collect_components(event)
+        if not components:
+            return []
+        # 为按摘要去重留出余量，同时避免消息中图片过多时转换全部图片
+        limit = self.max_images * 2
+        if len(components) > limit:
+            logger.warning(f"消息中包含 {len(components)} 张图片，只处理前 {limit} 张")
+            components = components[:limit]
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        converted = await asyncio.gather(
+            *(self._convert(semaphore, source, comp) for source, comp in components)
+        )
+
+        images = []
+        digests = set()
+        total_bytes = 0
+        for source, data in converted:
+            if not data:
+                continue
+            digest = digest_reference_image(data)
+            if digest in digests:
+                logger.debug("跳过重复的参考图片")
+                continue
+            size = len(data) * 3 // 4
+            if len(images) >= self.max_images:
+                logger.warning(f"参考图片超过 {self.max_images} 张，忽略多余的图片")
+                break
+            if total_bytes + size > self.max_total_bytes:
+                logger.warning(f"参考图片总大小超过 {self.max_total_bytes // 1024 // 1024} MB，忽略该图片")
+                continue
+            digests.add(digest)
+            total_bytes += size
+            images.append(ReferenceImage(data=data, digest=digest, size=size, source=source))
+            if source == "reply":
+                logger.info("从引用消息中获取到图片")
+        return images
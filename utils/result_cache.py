@@ -0,0 +1,250 @@
+import asyncio
+import hashlib
+import os
+import re
+import shutil
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from astrbot.api import logger
+
+
+@dataclass
+class CacheEntry:
+    """缓存中的单个生成结果"""
+    path: str
+    size: int
+    created_at: float
+    image_format: str
+    extra_images: list = field(default_factory=list)   # 同一结果中的其余图像（CacheEntry）
+
+    @property
+    def total_size(self):
+        """包含其余图像在内的总大小"""
+        return self.size + sum(image.size for image in self.extra_images)
+
+
+def normalize_prompt(prompt):
+    """规范化提示词：统一全角/半角字符并合并空白"""
+    prompt = unicodedata.normalize("NFKC", prompt or "")
+    return re.sub(r"\s+", " ", prompt).strip()
+
+
+def digest_reference_image(base64_image):
+    """
+    计算参考图片的摘要
+
+    Args:
+        base64_image (str): base64 编码的图片，可以带 data URI 前缀
+
+    Returns:
+        str: sha256 十六进制摘要
+    """
+    if base64_image.startswith("data:"):
+        base64_image = base64_image.split(",", 1)[-1]
+    return hashlib.sha256(base64_image.encode("ascii", "ignore")).hexdigest()
+
+
+def make_cache_key(model, prompt, reference_digests=(), variant=0):
+    """
+    由模型、规范化后的提示词与参考图片摘要计算缓存键
+
+    Args:
+        model (str): 模型名称
+        prompt (str): 提示词
+        reference_digests (iterable): 参考图片摘要，顺序有意义
+        variant (int): 多张变体生成时的序号（从1开始），0 表示单张生成
+
+    Returns:
+        str: 缓存键
+    """
+    hasher = hashlib.sha256()
+    for part in (model, normalize_prompt(prompt), *reference_digests):
+        hasher.update(part.encode("utf-8"))
+        hasher.update(b"\0")
+    if variant:
+        hasher.update(f"variant:{variant}".encode("utf-8"))
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    """
+    按内容寻址的生成结果缓存
+
+    结果文件保存在独立的缓存目录中（不受 images 目录清理影响），
+    内存中维护 LRU 索引，按总字节数与 TTL 淘汰。
+    一个结果包含多张图像时，其余图像保存为 {key}-{序号}.{格式}，与主图像作为一个缓存项一起命中与淘汰。
+    """
+
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024, ttl_seconds=24 * 3600):
+        """
+        Args:
+            cache_dir (Path): 缓存目录
+            max_bytes (int): 缓存文件总大小上限
+            ttl_seconds (int): 缓存有效期（秒）
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = 0
+        self._entries = OrderedDict()
+        self._loaded = False
+        self._lock = asyncio.Lock()
+
+    async def _ensure_loaded(self):
+        """首次使用时从磁盘重建索引（按修改时间排序）"""
+        if self._loaded:
+            return
+        entries = await asyncio.to_thread(self._scan_dir)
+        for key, entry in entries:
+            self._entries[key] = entry
+            self.total_bytes += entry.total_size
+        self._loaded = True
+        if entries:
+            logger.info(f"已加载 {len(entries)} 条缓存结果 ({self.total_bytes / 1024 / 1024:.1f} MB)")
+
+    def _scan_dir(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        primaries = {}
+        extras = {}
+        with os.scandir(self.cache_dir) as it:
+            for item in it:
+                if not item.is_file() or item.name.endswith(".tmp"):
+                    continue
+                name, _, image_format = item.name.partition(".")
+                key, _, index = name.partition("-")
+                if index and not index.isdigit():
+                    continue
+                stat = item.stat()
+                entry = CacheEntry(item.path, stat.st_size, stat.st_mtime, image_format)
+                if index:
+                    extras.setdefault(key, []).append((int(index), entry))
+                else:
+                    primaries[key] = entry
+        for key, images in extras.items():
+            if key not in primaries:
+                # 主图像写入前中断留下的其余图像
+                for _, image in images:
+                    _remove_file(image.path)
+                continue
+            primaries[key].extra_images = [image for _, image in sorted(images, key=lambda pair: pair[0])]
+        return sorted(primaries.items(), key=lambda pair: pair[1].created_at)
+
+    async def get(self, key):
+        """
+        查找缓存结果
+
+        Args:
+            key (str): make_cache_key 生成的缓存键
+
+        Returns:
+            CacheEntry: 命中时返回缓存项，否则返回None
+        """
+        async with self._lock:
+            await self._ensure_loaded()
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry.created_at > self.ttl_seconds:
+                await self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    async def put(self, key, source_path, image_format, extra_images=()):
+        """
+        将生成结果放入缓存（优先使用硬链接，失败时复制）
+
+        Args:
+            key (str): 缓存键
+            source_path (str): 生成的图像文件路径
+            image_format (str): 图像格式
+            extra_images (iterable): 同一结果中其余图像的 (文件路径, 图像格式)
+
+        Returns:
+            CacheEntry: 新的缓存项，写入失败时返回None
+        """
+        async with self._lock:
+            await self._ensure_loaded()
+            if key in self._entries:
+                await self._remove(key)
+            now = time.time()
+            extras = []
+            try:
+                # 先写入其余图像，主图像存在即表示整个结果已完整写入
+                for index, (path, extra_format) in enumerate(extra_images, 1):
+                    target = self.cache_dir / f"{key}-{index}.{extra_format}"
+                    size = await asyncio.to_thread(_link_or_copy, path, target)
+                    extras.append(CacheEntry(str(target), size, now, extra_format))
+                target = self.cache_dir / f"{key}.{image_format}"
+                size = await asyncio.to_thread(_link_or_copy, source_path, target)
+            except OSError as e:
+                logger.warning(f"写入结果缓存失败: {e}")
+                for image in extras:
+                    await asyncio.to_thread(_remove_file, image.path)
+                return None
+            entry = CacheEntry(str(target), size, now, image_format, extras)
+            self._entries[key] = entry
+            self.total_bytes += entry.total_size
+            await self._evict()
+            return entry
+
+    async def _evict(self):
+        """淘汰过期项，并按 LRU 顺序淘汰直到总大小不超过上限"""
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if now - entry.created_at > self.ttl_seconds]
+        for key in expired:
+            await self._remove(key)
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key = next(iter(self._entries))
+            await self._remove(key)
+
+    async def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry.total_size
+        for image in (entry, *entry.extra_images):
+            await asyncio.to_thread(_remove_file, image.path)
+
+    def stats(self):
+        """
+        获取缓存统计
+
+        Returns:
+            dict: 命中数、未命中数、命中率、条目数与总大小
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+        }
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"删除缓存文件失败: {e}")
+
+
+def _link_or_copy(source, target):
+    """硬链接源文件到缓存目录，跨文件系统时退回复制，返回文件大小"""
+    target = Path(target)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp = target.with_name(target.name + ".tmp")
+    try:
+        os.link(source, tmp)
+    except OSError:
+        shutil.copyfile(source, tmp)
+    os.replace(tmp, target)
+    return target.stat().st_size
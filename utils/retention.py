@@ -0,0 +1,178 @@
+import asyncio
+import heapq
+import os
+import time
+from pathlib import Path
+from astrbot.api import logger
+
+
+# 由插件生成、可以被清理的图像文件前缀
+RETAINED_PREFIXES = ("gemini_image_", "siliconflow_image_")
+
+
+class ImageRetentionSweeper:
+    """
+    images 目录的后台清理器
+
+    启动时扫描一次目录建立按修改时间排序的过期堆，之后新文件通过 track 登记，
+    后台任务定期弹出过期文件并在超过磁盘配额时按时间顺序删除最旧的文件。
+    所有文件系统操作都在线程池中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, images_dir, ttl_seconds=15 * 60, max_bytes=0, interval=60,
+                 rescan_interval=3600, prefixes=RETAINED_PREFIXES):
+        """
+        Args:
+            images_dir (Path): 图像目录
+            ttl_seconds (int): 图像保留时间（秒）
+            max_bytes (int): 图像总大小上限，0 表示不限制
+            interval (int): 清理间隔（秒）
+            rescan_interval (int): 重新扫描目录的间隔（秒），用于发现未登记的文件，0 表示不重新扫描
+            prefixes (tuple): 受管理的文件名前缀
+        """
+        self.images_dir = Path(images_dir)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.rescan_interval = rescan_interval
+        self.prefixes = tuple(prefixes)
+        self.total_bytes = 0
+        self.removed_files = 0
+        self._heap = []           # (mtime, path)
+        self._files = {}          # path -> (mtime, size)
+        self._task = None
+        self._last_scan = 0.0
+
+    def start(self):
+        """在当前事件循环中启动后台清理任务"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止后台清理任务"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def track(self, path, size=None, mtime=None):
+        """
+        登记新保存的图像文件
+
+        Args:
+            path (str): 文件路径
+            size (int): 文件大小，未知时为0
+            mtime (float): 修改时间，默认为当前时间
+        """
+        path = str(path)
+        if not os.path.basename(path).startswith(self.prefixes):
+            return
+        mtime = time.time() if mtime is None else mtime
+        size = size or 0
+        previous = self._files.get(path)
+        if previous:
+            self.total_bytes -= previous[1]
+        self._files[path] = (mtime, size)
+        self.total_bytes += size
+        heapq.heappush(self._heap, (mtime, path))
+
+    def track_result(self, result):
+        """
+        登记生成结果中的所有本地文件：主图像、同一响应中的其余图像，以及转码时保留的原图
+
+        Args:
+            result (ImageGenerationResult): 保存在本地的生成结果
+        """
+        for image in (result, *result.extra_images):
+            self.track(image.image_path, image.size)
+            if image.original_path:
+                self.track(image.original_path, image.original_size)
+
+    async def _run(self):
+        try:
+            await self.rescan()
+            while True:
+                await asyncio.sleep(self.interval)
+                if self.rescan_interval and time.monotonic() - self._last_scan > self.rescan_interval:
+                    await self.rescan()
+                await self.sweep()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"图像清理任务异常退出: {e}")
+
+    async def rescan(self):
+        """扫描图像目录，重建过期堆"""
+        scan_start = time.time()
+        entries = await asyncio.to_thread(self._scan)
+        # 扫描期间新登记的文件可能不在扫描结果中，需要保留
+        recent = [(path, mtime, size) for path, (mtime, size) in self._files.items() if mtime >= scan_start]
+        self._files = {path: (mtime, size) for path, mtime, size in entries + recent}
+        self._heap = [(mtime, path) for path, (mtime, size) in self._files.items()]
+        heapq.heapify(self._heap)
+        self.total_bytes = sum(size for _, size in self._files.values())
+        self._last_scan = time.monotonic()
+        logger.debug(f"图像目录索引完成: {len(self._files)} 个文件, {self.total_bytes / 1024 / 1024:.1f} MB")
+        await self.sweep()
+
+    def _scan(self):
+        if not self.images_dir.exists():
+            return []
+        entries = []
+        with os.scandir(self.images_dir) as it:
+            for item in it:
+                if not item.name.startswith(self.prefixes):
+                    continue
+                try:
+                    if item.is_file():
+                        stat = item.stat()
+                        entries.append((item.path, stat.st_mtime, stat.st_size))
+                except OSError:
+                    continue
+        return entries
+
+    async def sweep(self):
+        """
+        删除过期文件，并在超过磁盘配额时删除最旧的文件
+
+        Returns:
+            int: 本次删除的文件数
+        """
+        cutoff = time.time() - self.ttl_seconds
+        victims = []
+        while self._heap:
+            mtime, path = self._heap[0]
+            current = self._files.get(path)
+            if current is None or current[0] != mtime:
+                # 已删除或重新登记过的旧堆项
+                heapq.heappop(self._heap)
+                continue
+            over_quota = self.max_bytes and self.total_bytes > self.max_bytes
+            if mtime >= cutoff and not over_quota:
+                break
+            heapq.heappop(self._heap)
+            del self._files[path]
+            self.total_bytes -= current[1]
+            victims.append(path)
+
+        if victims:
+            removed = await asyncio.to_thread(_remove_files, victims)
+            self.removed_files += removed
+            logger.info(f"已清理 {removed} 个过期或超出配额的图像文件")
+        return len(victims)
+
+
+def _remove_files(paths):
+    removed = 0
+    for path in paths:
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"清理文件 {path} 时出错: {e}")
+    return removed
@@ -0,0 +1,187 @@
+import asyncio
+import random
+import time
+from astrbot.api import logger
+
+
+# 错误分类
+RATE_LIMITED = "rate_limited"     # 429 / 402 / 密钥无效，需要换密钥或等待冷却
+TRANSIENT = "transient"           # 5xx、上游繁忙
+NETWORK = "network"               # 连接失败、超时
+EMPTY_IMAGE = "empty_image"       # 请求成功但模型没有返回图像
+FATAL = "fatal"                   # 其他 4xx、内容过滤等，重试没有意义
+
+RETRYABLE = (RATE_LIMITED, TRANSIENT, NETWORK, EMPTY_IMAGE)
+
+
+def classify_status(status):
+    """
+    按 HTTP 状态码对失败分类
+
+    Args:
+        status (int): HTTP 状态码，网络错误时为None
+
+    Returns:
+        str: 错误分类
+    """
+    if status is None:
+        return NETWORK
+    if status in (401, 402, 403, 429):
+        return RATE_LIMITED
+    if status in (408, 425) or status >= 500:
+        return TRANSIENT
+    return FATAL
+
+
+class RetryBudget:
+    """
+    全局重试预算
+
+    每个新请求存入 ratio 个令牌，每次重试消耗一个令牌，另外按 min_per_second 缓慢补充，
+    使重试量最多约为正常请求量的 ratio 倍，上游故障时重试不会成倍放大流量。
+    """
+
+    def __init__(self, ratio=0.2, min_per_second=0.1, max_tokens=10):
+        """
+        Args:
+            ratio (float): 每个请求存入的令牌数
+            min_per_second (float): 每秒补充的令牌数，保证低流量时也能重试
+            max_tokens (float): 令牌上限
+        """
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.exhausted = 0
+        self._updated = time.monotonic()
+
+    def _refill(self, amount=0.0):
+        now = time.monotonic()
+        amount += (now - self._updated) * self.min_per_second
+        self._updated = now
+        self.tokens = min(self.max_tokens, self.tokens + amount)
+
+    def deposit(self):
+        """记录一个新请求"""
+        self._refill(self.ratio)
+
+    def try_spend(self):
+        """
+        申请一次重试
+
+        Returns:
+            bool: 预算充足时返回True
+        """
+        self._refill()
+        if self.tokens < 1:
+            self.exhausted += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+class RetryPolicy:
+    """
+    可配置的重试策略，OpenRouter 与 SiliconFlow 共用
+
+    失败按类型决定是否重试，重试前按带抖动的指数退避等待（有 Retry-After 时至少等待该时间），
+    并受单次请求的截止时间与全局重试预算约束。
+    """
+
+    def __init__(self, max_retries=3, base_delay=1.0, max_delay=20.0, deadline=180.0,
+                 retry_empty_image=True, budget=None):
+        """
+        Args:
+            max_retries (int): 单次请求的最大重试次数
+            base_delay (float): 退避基准时间（秒）
+            max_delay (float): 单次退避的上限（秒）
+            deadline (float): 单次请求（含所有重试）的截止时间（秒）
+            retry_empty_image (bool): 模型没有返回图像时是否重试
+            budget (RetryBudget): 全局重试预算，None 表示不限制
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_empty_image = retry_empty_image
+        self.budget = budget
+        self.retries = 0
+
+    def begin(self):
+        """
+        开始一次新请求
+
+        Returns:
+            RetryState: 本次请求的重试状态
+        """
+        if self.budget is not None:
+            self.budget.deposit()
+        return RetryState(self)
+
+    def backoff(self, retry_number, retry_after=None):
+        """
+        第 retry_number 次重试前的等待时间（带抖动的指数退避，取上限的一半到上限之间的随机值）
+
+        Args:
+            retry_number (int): 从1开始的重试序号
+            retry_after (float): 上游要求的最短等待时间（秒）
+
+        Returns:
+            float: 等待秒数
+        """
+        cap = min(self.max_delay, self.base_delay * (2 ** (retry_number - 1)))
+        delay = random.uniform(cap / 2, cap)
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+
+class RetryState:
+    """单次请求的重试状态"""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.retries = 0
+        self.deadline_at = time.monotonic() + policy.deadline if policy.deadline else None
+
+    def remaining(self):
+        """距离截止时间还有多少秒，没有截止时间时返回None"""
+        if self.deadline_at is None:
+            return None
+        return max(0.0, self.deadline_at - time.monotonic())
+
+    def timeout(self, default):
+        """单次上游调用的超时：不超过默认值与剩余时间"""
+        remaining = self.remaining()
+        return default if remaining is None else max(1.0, min(default, remaining))
+
+    async def wait(self, kind, retry_after=None):
+        """
+        判断是否重试，需要重试时等待退避时间
+
+        Args:
+            kind (str): 错误分类
+            retry_after (float): 上游要求的最短等待时间（秒）
+
+        Returns:
+            bool: 应该重试时返回True（已完成等待）
+        """
+        policy = self.policy
+        if kind not in RETRYABLE or (kind == EMPTY_IMAGE and not policy.retry_empty_image):
+            return False
+        if self.retries >= policy.max_retries:
+            logger.warning(f"已重试 {self.retries} 次，放弃请求")
+            return False
+        delay = policy.backoff(self.retries + 1, retry_after)
+        remaining = self.remaining()
+        if remaining is not None and delay >= remaining:
+            logger.warning(f"重试需要等待 {delay:.1f} 秒，超过剩余时间 {remaining:.1f} 秒，放弃请求")
+            return False
+        if policy.budget is not None and not policy.budget.try_spend():
+            logger.warning("全局重试预算已用尽，放弃重试")
+            return False
+        self.retries += 1
+        policy.retries += 1
+        logger.info(f"{delay:.1f} 秒后进行第 {self.retries} 次重试（{kind}）")
+        await asyncio.sleep(delay)
+        return True
@@ -0,0 +1,51 @@
+import asyncio
+from astrbot.api import logger
+
+
+class SingleFlight:
+    """
+    合并相同键的并发调用
+
+    同一时刻相同键只会执行一次底层调用，其余调用方等待并共享其结果。
+    调用方被取消时只会取消自己的等待，共享的底层调用继续执行。
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, func):
+        """
+        执行或加入一次调用
+
+        Args:
+            key (str): 调用的合并键
+            func (callable): 无参数、返回协程的函数，仅在没有进行中的相同调用时执行
+
+        Returns:
+            底层调用的返回值（异常同样会传递给所有等待者）
+        """
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+            logger.info("相同请求正在进行中，等待其结果")
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # 所有等待者都已取消时避免 "Task exception was never retrieved" 警告
+        if not task.cancelled():
+            task.exception()
+
+    def running(self, key):
+        """相同键的调用是否正在进行（此时 do 会加入该调用）"""
+        return key in self._calls
+
+    def in_flight(self):
+        """当前进行中的底层调用数量"""
+        return len(self._calls)
@@ -0,0 +1,315 @@
+import binascii
+import json
+import os
+import re
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+import aiofiles
+from astrbot.api import logger
+
+
+# 每次从响应中读取的字节数，决定了单个请求的峰值内存
+STREAM_CHUNK_SIZE = 64 * 1024
+
+_DATA_URI_PREFIX = b"data:image/"
+# 部分服务端会把 "/" 转义为 "\/"
+_DATA_URI_START = re.compile(rb"data:image\\?/")
+_BASE64_MARKER = b";base64,"
+# data URI 头部（格式 + ;base64,）的最大长度，超过则视为普通文本
+_MAX_HEADER_LEN = 64
+# 连续的 base64 字符，允许 JSON 转义的 "\/" 以及换行转义 "\n" "\r"
+_BASE64_RUN = re.compile(rb"[A-Za-z0-9+/=]*(?:\\[/nr][A-Za-z0-9+/=]*)*")
+# 图像以外的 JSON 骨架最大长度，防止异常响应占用过多内存
+_MAX_SKELETON_BYTES = 4 * 1024 * 1024
+
+
+class SinkError(Exception):
+    """写入 sink 失败（例如流式发送的连接断开），与上游请求本身的错误区分"""
+
+
+def default_images_dir():
+    """插件默认的图像保存目录"""
+    return Path(__file__).parent.parent / "images"
+
+
+def new_image_path(images_dir, image_format, prefix="gemini_image"):
+    """
+    生成唯一的图像文件路径（使用时间戳和UUID避免冲突）
+
+    Args:
+        images_dir (Path): 图像目录
+        image_format (str): 图像格式（文件扩展名）
+        prefix (str): 文件名前缀
+
+    Returns:
+        Path: 图像文件路径
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    unique_id = str(uuid.uuid4())[:8]
+    return Path(images_dir) / f"{prefix}_{timestamp}_{unique_id}.{image_format}"
+
+
+class FileImageSink:
+    """将解码后的图像字节写入 images 目录下的文件"""
+
+    def __init__(self, image_format, images_dir=None, prefix="gemini_image"):
+        self.images_dir = Path(images_dir) if images_dir else default_images_dir()
+        self.path = new_image_path(self.images_dir, image_format, prefix)
+        self.size = 0
+        self._file = None
+
+    async def open(self):
+        self.images_dir.mkdir(parents=True, exist_ok=True)
+        self._file = await aiofiles.open(self.path, "wb")
+
+    async def write(self, data):
+        await self._file.write(data)
+        self.size += len(data)
+
+    async def close(self):
+        """
+        完成写入
+
+        Returns:
+            str: 图像文件的绝对路径
+        """
+        await self._file.close()
+        self._file = None
+        return str(self.path.absolute())
+
+    async def abort(self):
+        """放弃写入并删除不完整的文件"""
+        if self._file is not None:
+            try:
+                await self._file.close()
+            except Exception:
+                pass
+            self._file = None
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"删除不完整的图像文件失败: {e}")
+
+
+@dataclass
+class StreamedImage:
+    """流式解码得到的单张图像"""
+    placeholder: str
+    image_format: str
+    location: str
+    size: int
+    local: bool = True        # location 是否为本机文件（流式发送到 NAP 时为接收端路径）
+    discard: object = None    # 删除非本机图像的协程函数（由 sink 的可选 discard 方法提供）
+
+
+class StreamingImageExtractor:
+    """
+    增量解析 chat/completions 响应体
+
+    响应中每个 data:image/...;base64, URI 在读取过程中被逐块解码并写入 sink，
+    其余的 JSON 内容（骨架）保留在内存中，URI 的位置替换为占位字符串。
+    峰值内存只与分块大小有关，与图像大小无关。
+    """
+
+    def __init__(self, sink_factory=None, max_images=1):
+        """
+        Args:
+            sink_factory (callable): 接收图像格式、返回 sink 的工厂函数，默认写入 images 目录；
+                sink 提供 open / write / close（返回图像位置）/ abort 与 size，可选的 local 属性表示位置是否为本机文件，
+                可选的 discard 方法删除已完成但未被使用的非本机图像
+            max_images (int): 最多解码保存的图像数量，其余图像数据被直接跳过
+        """
+        self.sink_factory = sink_factory or FileImageSink
+        self.max_images = max_images
+        self.images = []
+        self.bytes_received = 0
+        self.sink_seconds = 0.0         # 写入 sink（磁盘）所用的时间
+        self._skeleton = bytearray()
+        self._state = "scan"
+        self._carry = b""
+        self._header = bytearray()
+        self._pending = bytearray()
+        self._sink = None
+        self._image_format = None
+        self._uri_count = 0
+
+    async def feed(self, chunk):
+        """处理一段响应数据"""
+        self.bytes_received += len(chunk)
+        data = self._carry + chunk if self._carry else chunk
+        self._carry = b""
+        pos = 0
+        while pos < len(data):
+            if self._state == "scan":
+                pos = self._scan(data, pos)
+            elif self._state == "header":
+                pos = self._read_header(data, pos)
+                if self._state == "data":
+                    await self._open_image()
+            else:
+                pos = await self._read_base64(data, pos)
+        if len(self._skeleton) > _MAX_SKELETON_BYTES:
+            raise ValueError("响应中的非图像内容过大")
+
+    def _scan(self, data, pos):
+        match = _DATA_URI_START.search(data, pos)
+        if match is None:
+            # 保留末尾可能是前缀一部分的字节，留到下一块再判断
+            keep = len(_DATA_URI_PREFIX)
+            split = max(pos, len(data) - keep)
+            self._skeleton += data[pos:split]
+            self._carry = data[split:]
+            return len(data)
+        self._skeleton += data[pos:match.start()]
+        self._header = bytearray()
+        self._state = "header"
+        return match.end()
+
+    def _read_header(self, data, pos):
+        before = len(self._header)
+        taken = data[pos:pos + _MAX_HEADER_LEN - before]
+        self._header += taken
+        marker = self._header.find(_BASE64_MARKER)
+        if marker >= 0:
+            header_end = marker + len(_BASE64_MARKER)
+            self._image_format = self._header[:marker].decode("ascii", "replace").split(";")[0] or "png"
+            self._state = "data"
+            return pos + header_end - before
+        if len(self._header) >= _MAX_HEADER_LEN or b'"' in self._header:
+            # 不是 base64 data URI，把已读取的内容放回骨架，本块剩余部分重新扫描
+            self._skeleton += _DATA_URI_PREFIX + self._header[:before]
+            self._header = bytearray()
+            self._state = "scan"
+            return pos
+        return pos + len(taken)
+
+    async def _open_image(self):
+        self._uri_count += 1
+        self._pending = bytearray()
+        self._sink = None
+        if len(self.images) < self.max_images:
+            self._sink = self.sink_factory(self._image_format)
+            start = time.perf_counter()
+            await self._sink.open()
+            self.sink_seconds += time.perf_counter() - start
+
+    async def _read_base64(self, data, pos):
+        end = _BASE64_RUN.match(data, pos).end()
+        segment = data[pos:end]
+        if b"\\" in segment:
+            segment = segment.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b"")
+        if self._sink is not None:
+            self._pending += segment
+            usable = len(self._pending) - len(self._pending) % 4
+            if usable:
+                await self._write(self._sink, binascii.a2b_base64(bytes(self._pending[:usable])))
+                del self._pending[:usable]
+
+        if end == len(data):
+            return end
+        if end == len(data) - 1 and data[end:] == b"\\":
+            # 转义序列被分块截断，留到下一块
+            self._carry = data[end:]
+            return len(data)
+        await self._close_image()
+        return end
+
+    async def _write(self, sink, data):
+        start = time.perf_counter()
+        await sink.write(data)
+        self.sink_seconds += time.perf_counter() - start
+
+    async def _close_image(self):
+        placeholder = f"__streamed_image_{self._uri_count}__"
+        self._skeleton += placeholder.encode("ascii")
+        self._state = "scan"
+        sink = self._sink
+        self._sink = None
+        if sink is None:
+            return
+        try:
+            if self._pending:
+                # 补齐缺失的填充字符
+                padding = b"=" * (-len(self._pending) % 4)
+                await self._write(sink, binascii.a2b_base64(bytes(self._pending) + padding))
+            start = time.perf_counter()
+            location = await sink.close()
+            self.sink_seconds += time.perf_counter() - start
+        except (binascii.Error, ValueError) as e:
+            logger.warning(f"图像 base64 解码失败: {e}")
+            await sink.abort()
+            return
+        finally:
+            self._pending = bytearray()
+        self.images.append(StreamedImage(placeholder, self._image_format, location, sink.size,
+                                         getattr(sink, "local", True), getattr(sink, "discard", None)))
+        logger.debug(f"流式解码图像完成: {location} ({sink.size} bytes)")
+
+    async def finish(self):
+        """
+        结束解析
+
+        Returns:
+            dict: 去除图像数据后的响应 JSON，图像位置为占位字符串
+
+        Raises:
+            ValueError: 响应不是有效的 JSON
+        """
+        if self._state == "data":
+            await self._close_image()
+        elif self._state == "header":
+            self._skeleton += _DATA_URI_PREFIX + self._header
+        self._skeleton += self._carry
+        self._carry = b""
+        try:
+            return json.loads(bytes(self._skeleton))
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise ValueError(f"响应不是有效的JSON: {e}") from e
+
+    def find(self, value):
+        """
+        查找骨架中某个字段值对应的流式图像
+
+        Args:
+            value (str): 骨架中的字段值（完整占位字符串或包含占位字符串的文本）
+
+        Returns:
+            StreamedImage: 对应的图像，未找到时返回None
+        """
+        if not isinstance(value, str):
+            return None
+        for image in self.images:
+            if image.placeholder in value:
+                return image
+        return None
+
+    async def abort(self, keep=()):
+        """
+        删除未被使用的图像（例如请求失败或被取消时），非本机图像通过 sink 的 discard 删除
+
+        Args:
+            keep (iterable): 需要保留的图像
+        """
+        if self._sink is not None:
+            await self._sink.abort()
+            self._sink = None
+        keep = {id(image) for image in keep}
+        for image in self.images:
+            if id(image) in keep:
+                continue
+            if not image.local:
+                if image.discard is not None:
+                    try:
+                        await image.discard()
+                    except Exception as e:
+                        logger.warning(f"删除未使用的远程图像失败: {e}")
+            elif os.path.isfile(image.location):
+                try:
+                    os.remove(image.location)
+                except OSError as e:
+                    logger.warning(f"删除未使用的图像文件失败: {e}")
@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from astrbot.api import logger
+
+
+class TraceRecord:
+    """
+    单次图像生成的结构化追踪记录
+
+    只记录时间、大小、序号与结果分类，不记录提示词、密钥或图像内容。
+    所有时间戳都是相对于记录创建时刻的偏移（秒）。
+    """
+
+    def __init__(self, command="generate", trace_id=None):
+        """
+        Args:
+            command (str): 触发生成的命令
+            trace_id (str): 关联ID，默认随机生成（回放时沿用原记录的ID）
+        """
+        self.trace_id = trace_id or uuid.uuid4().hex[:16]
+        self.command = command
+        self.timestamp = time.time()
+        self._start = time.monotonic()
+        self.phases = {}              # 阶段 -> [开始偏移, 耗时]
+        self.attempts = []            # 每次上游请求的记录
+        self.reference_count = 0
+        self.payload_bytes = 0
+        self.outcome = None
+        self.error_class = None
+        self.cached = False
+        self.coalesced = False
+        self.emitted = False
+
+    def offset(self, at=None):
+        """time.monotonic() 时刻相对于记录开始的偏移（秒）"""
+        return (time.monotonic() if at is None else at) - self._start
+
+    def mark(self, name, start, duration):
+        """
+        记录一个阶段
+
+        Args:
+            name (str): 阶段名称
+            start (float): 阶段开始的 time.monotonic() 时间
+            duration (float): 阶段耗时（秒）
+        """
+        self.phases[name] = [round(self.offset(start), 4), round(duration, 4)]
+
+    @contextmanager
+    def phase(self, name):
+        """记录 with 块的开始时间与耗时"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.mark(name, start, time.monotonic() - start)
+
+    def add_attempt(self, key_index, endpoint_index, start, kind, status=None, timings=None, response_bytes=0,
+                    retry_after=None):
+        """
+        记录一次上游请求
+
+        Args:
+            key_index (int): 使用的密钥序号（从1开始）
+            endpoint_index (int): 使用的端点序号（从1开始）
+            start (float): 发出请求的 time.monotonic() 时间
+            kind (str): 请求结果分类（image / rate_limited / timeout / cancelled 等）
+            status (int): HTTP 状态码，未收到响应时为None
+            timings (dict): 本次请求的 upstream / download / disk 耗时（秒）
+            response_bytes (int): 收到的响应体字节数
+            retry_after (float): 响应头中的 Retry-After（秒）
+        """
+        attempt = {
+            "key": key_index,
+            "endpoint": endpoint_index,
+            "sent": round(self.offset(start), 4),
+            "elapsed": round(time.monotonic() - start, 4),
+            "status": status,
+            "kind": kind,
+            "response_bytes": response_bytes,
+        }
+        for name in ("upstream", "download", "disk"):
+            if timings and name in timings:
+                attempt[name] = round(timings[name], 4)
+        if retry_after is not None:
+            attempt["retry_after"] = round(retry_after, 3)
+        self.attempts.append(attempt)
+
+    def finish(self, outcome, error=None):
+        """
+        设置最终结果
+
+        Args:
+            outcome (str): cached / success / failure / blocked / rejected / error
+            error (BaseException): 导致失败的异常，只记录其类名
+        """
+        self.outcome = outcome
+        self.error_class = type(error).__name__ if error is not None else None
+
+    def to_dict(self):
+        winner = next((item for item in self.attempts if item["kind"] == "image"), None)
+        last = winner or (self.attempts[-1] if self.attempts else None)
+        return {
+            "id": self.trace_id,
+            "ts": round(self.timestamp, 3),
+            "command": self.command,
+            "outcome": self.outcome,
+            "error_class": self.error_class,
+            "key_index": last["key"] if last else None,
+            "reference_count": self.reference_count,
+            "payload_bytes": self.payload_bytes,
+            "response_bytes": sum(item["response_bytes"] for item in self.attempts),
+            "cached": self.cached,
+            "coalesced": self.coalesced,
+            "duration": round(self.offset(), 4),
+            "phases": self.phases,
+            "attempts": self.attempts,
+        }
+
+
+class TraceLogger:
+    """
+    将追踪记录以 JSONL 格式追加写入文件
+
+    写入在线程池中批量执行，不阻塞事件循环；文件超过大小上限时轮转为 .1、.2 等备份。
+    """
+
+    def __init__(self, path, max_bytes=20 * 1024 * 1024, backup_count=3, enabled=True):
+        """
+        Args:
+            path (Path): 追踪文件路径
+            max_bytes (int): 单个文件的大小上限，0 表示不轮转
+            backup_count (int): 保留的轮转备份数量
+            enabled (bool): 是否写入文件；关闭时仍可创建记录，但不会输出
+        """
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.enabled = enabled
+        self.written = 0
+        self._pending = []
+        self._task = None
+
+    def begin(self, command="generate", trace_id=None):
+        """
+        创建一条追踪记录
+
+        Returns:
+            TraceRecord: 新记录
+        """
+        return TraceRecord(command, trace_id)
+
+    def emit(self, record):
+        """提交一条已完成的记录，同一条记录只会写入一次"""
+        if record is None or record.emitted:
+            return
+        record.emitted = True
+        if not self.enabled:
+            return
+        self._pending.append(json.dumps(record.to_dict(), ensure_ascii=False))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        while self._pending:
+            lines, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self._write_lines, lines)
+                self.written += len(lines)
+            except OSError as e:
+                logger.warning(f"写入追踪记录失败: {e}")
+
+    def _write_lines(self, lines):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.max_bytes and self.path.exists() and self.path.stat().st_size >= self.max_bytes:
+            self._rotate()
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def _rotate(self):
+        for i in range(self.backup_count - 1, 0, -1):
+            source = self.path.with_name(f"{self.path.name}.{i}")
+            if source.exists():
+                os.replace(source, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.backup_count:
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink()
+
+    async def close(self):
+        """等待未写入的记录写完"""
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
@@ -0,0 +1,107 @@
+"""
+生成结果转码的工作进程函数
+
+ImageTranscoder 在进程池中执行本模块的函数。spawn / forkserver 方式启动的工作进程会重新导入函数所在的模块，
+因此本模块只依赖标准库与 Pillow，不导入 AstrBot 与插件的其他模块。
+"""
+import io
+import os
+from pathlib import Path
+
+try:
+    from PIL import Image as PILImage
+except ImportError:  # Pillow 为可选依赖
+    PILImage = None
+
+
+def convert_for_format(image, pil_format):
+    """
+    转换为目标格式支持的色彩模式
+
+    Args:
+        image (PIL.Image.Image): 已加载的图片
+        pil_format (str): Pillow 格式名 JPEG / WEBP / PNG
+
+    Returns:
+        PIL.Image.Image: 转换后的图片（无需转换时返回原对象）
+    """
+    if pil_format == "JPEG":
+        if image.mode in ("RGBA", "LA", "P"):
+            # JPEG 不支持透明通道，合成到白色背景
+            rgba = image.convert("RGBA")
+            image = PILImage.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+    elif image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    return image
+
+
+# 输出格式 -> (Pillow 格式名, 文件扩展名)
+_TRANSCODE_FORMATS = {
+    "jpeg": ("JPEG", "jpeg"),
+    "webp": ("WEBP", "webp"),
+    "png": ("PNG", "png"),
+}
+
+
+def transcode_image_file(path, output_format="webp", quality=85, max_width=0, max_height=0,
+                         strip_metadata=True, keep_original=False):
+    """
+    转码图像文件（CPU 密集，在工作进程中执行）
+
+    转码后的文件与原文件同名、扩展名为新格式；没有缩放且体积没有变小时保留原文件不变。
+
+    Args:
+        path (str): 图像文件路径
+        output_format (str): 输出格式 webp / jpeg，original 表示保持原格式（只缩放或去除元数据）
+        quality (int): 压缩质量（1-100）
+        max_width (int): 最大宽度（像素），0 表示不限制
+        max_height (int): 最大高度（像素），0 表示不限制
+        strip_metadata (bool): 是否去除 EXIF 与 ICC 等元数据
+        keep_original (bool): 是否保留原文件
+
+    Returns:
+        tuple: (图像路径, 图像格式, 文件大小, 保留的原文件路径或None)，未转码时返回None
+    """
+    source = Path(path)
+    source_size = source.stat().st_size
+    with PILImage.open(source) as image:
+        source_format = (image.format or source.suffix.lstrip(".")).lower()
+        target_format = source_format if output_format == "original" else output_format
+        if target_format not in _TRANSCODE_FORMATS:
+            return None
+        pil_format, extension = _TRANSCODE_FORMATS[target_format]
+
+        # 动图只取第一帧
+        image.seek(0)
+        image.load()
+        needs_resize = bool(max_width and image.width > max_width) or bool(max_height and image.height > max_height)
+        if needs_resize:
+            image.thumbnail((max_width or image.width, max_height or image.height), PILImage.LANCZOS)
+
+        save_args = {"quality": quality, "optimize": True} if pil_format != "PNG" else {}
+        # 显式传入元数据，不依赖各格式编码器是否自动沿用 image.info
+        for key, empty in (("icc_profile", None), ("exif", b"")):
+            save_args[key] = empty if strip_metadata else image.info.get(key, empty)
+        if pil_format != "PNG":
+            image = convert_for_format(image, pil_format)
+
+        buffer = io.BytesIO()
+        image.save(buffer, format=pil_format, **save_args)
+        output = buffer.getvalue()
+
+    if not needs_resize and len(output) >= source_size:
+        # 转码没有收益时保留原图
+        return None
+
+    target = source.with_suffix(f".{extension}")
+    if keep_original and target == source:
+        target = source.with_name(f"{source.stem}_transcoded.{extension}")
+    temp = target.with_name(f"{target.name}.tmp")
+    temp.write_bytes(output)
+    os.replace(temp, target)
+    if not keep_original and target != source:
+        source.unlink()
+    return str(target.absolute()), extension, len(output), str(source.absolute()) if keep_original else None
@@ -3,363 +3,513 @@ import aiohttp
 import asyncio
 import aiofiles
 import base64
+import json
 import os
-import re
-import uuid
-from datetime import datetime, timedelta
-import glob
-from pathlib import Path
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from astrbot.api import logger
 from astrbot.api.star import StarTools
-
-
-class ImageGeneratorState:
-    """图像生成器状态管理类，用于处理并发安全"""
-    def __init__(self):
-        self.last_saved_image = {"url": None, "path": None}
-        self.api_key_index = 0
-        self._lock = asyncio.Lock()
-    
-    async def get_next_api_key(self, api_keys):
-        """获取下一个可用的API密钥"""
-        async with self._lock:
-            if not api_keys or not isinstance(api_keys, list):
-                raise ValueError("API密钥列表不能为空")
-            current_key = api_keys[self.api_key_index % len(api_keys)]
-            return current_key
-    
-    async def rotate_to_next_api_key(self, api_keys):
-        """轮换到下一个API密钥"""
-        async with self._lock:
-            if api_keys and isinstance(api_keys, list) and len(api_keys) > 1:
-                self.api_key_index = (self.api_key_index + 1) % len(api_keys)
-                logger.info(f"已轮换到下一个API密钥，当前索引: {self.api_key_index}")
-    
-    async def update_saved_image(self, url, path):
-        """更新保存的图像信息"""
-        async with self._lock:
-            self.last_saved_image = {"url": url, "path": path}
-    
-    async def get_saved_image_info(self):
-        """获取最后保存的图像信息"""
-        async with self._lock:
-            return self.last_saved_image["url"], self.last_saved_image["path"]
-
-
-# 全局状态管理实例
-_state = ImageGeneratorState()
-
-
-async def cleanup_old_images(data_dir=None):
+from .image_preprocess import sniff_base64_mime
+from .endpoint_router import EndpointRouter, EndpointState
+from .key_pool import ApiKeyPool, KeyLease, parse_retry_after
+from .retry_policy import EMPTY_IMAGE, FATAL, NETWORK, RATE_LIMITED, TRANSIENT, RetryPolicy, classify_status
+from .stream_decoder import STREAM_CHUNK_SIZE, FileImageSink, SinkError, StreamingImageExtractor
+
+
+# 默认使用的 OpenRouter 免费图像模型
+DEFAULT_OPENROUTER_MODEL = "google/gemini-2.5-flash-image-preview:free"
+
+
+@dataclass
+class ImageGenerationResult:
+    """单次图像生成请求的结果，每个请求独立持有，不经过任何共享状态"""
+    image_path: str
+    image_url: str
+    image_format: str = "png"
+    size: int = 0
+    api_key_index: int = None
+    timings: dict = field(default_factory=dict)
+    cached: bool = False
+    endpoint: str = None
+    remote: bool = False      # image_path 为 NAP 接收端上的路径（图像未写入本地磁盘）
+    original_path: str = None # 转码时保留的原图路径
+    original_size: int = 0    # 保留的原图大小
+    extra_images: list = field(default_factory=list)   # 同一响应中的其余图像（ImageGenerationResult）
+
+
+@asynccontextmanager
+async def _session_scope(session=None):
     """
-    清理超过15分钟的图像文件
-    
-    Args:
-        data_dir (Path): 数据目录路径，如果为None则使用当前脚本目录
-    """
-    try:
-        # 如果没有传入data_dir，使用当前脚本目录
-        if data_dir is None:
-            script_dir = Path(__file__).parent.parent
-            data_dir = script_dir
-        
-        images_dir = data_dir / "images"
-
-        if not images_dir.exists():
-            return
-
-        current_time = datetime.now()
-        cutoff_time = current_time - timedelta(minutes=15)
-
-        # 查找images目录下的所有图像文件
-        image_patterns = ["gemini_image_*.png", "gemini_image_*.jpg", "gemini_image_*.jpeg"]
-
-        for pattern in image_patterns:
-            for file_path in images_dir.glob(pattern):
-                try:
-                    # 获取文件的修改时间
-                    file_mtime = datetime.fromtimestamp(file_path.stat().st_mtime)
-
-                    # 如果文件超过15分钟，删除它
-                    if file_mtime < cutoff_time:
-                        file_path.unlink()
-                        logger.info(f"已清理过期图像: {file_path}")
-
-                except Exception as e:
-                    logger.warning(f"清理文件 {file_path} 时出错: {e}")
-
-    except Exception as e:
-        logger.error(f"图像清理过程出错: {e}")
-
-
-async def save_base64_image(base64_string, image_format="png", data_dir=None):
-    """
-    保存base64图像数据到images文件夹
+    使用调用方提供的共享会话；未提供或已关闭时创建一个临时会话并在结束后关闭
 
     Args:
-        base64_string (str): base64编码的图像数据
-        image_format (str): 图像格式
-        data_dir (Path): 数据目录路径，如果为None则使用当前脚本目录
-
-    Returns:
-        bool: 是否保存成功
+        session (aiohttp.ClientSession): 共享的HTTP会话
     """
-    try:
-        # 如果没有传入data_dir，使用当前脚本目录
-        if data_dir is None:
-            script_dir = Path(__file__).parent.parent
-            data_dir = script_dir
-        
-        images_dir = data_dir / "images"
-        # 确保images目录存在
-        images_dir.mkdir(exist_ok=True)
-        
-        # 先清理旧图像
-        await cleanup_old_images(data_dir)
-
-        # 解码 base64 数据
-        image_data = base64.b64decode(base64_string)
-
-        # 生成唯一文件名（使用时间戳和UUID避免冲突）
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        unique_id = str(uuid.uuid4())[:8]
-        image_path = images_dir / f"gemini_image_{timestamp}_{unique_id}.{image_format}"
-
-        # 保存图像文件
-        async with aiofiles.open(image_path, "wb") as f:
-            await f.write(image_data)
-
-        # 获取绝对路径
-        abs_path = str(image_path.absolute())
-        file_url = f"file://{abs_path}"
+    if session is not None and not session.closed:
+        yield session
+        return
+    async with aiohttp.ClientSession() as temp_session:
+        yield temp_session
 
-        # 更新状态
-        await _state.update_saved_image(file_url, str(image_path))
 
-        logger.info(f"图像已保存到: {abs_path}")
-        logger.debug(f"文件大小: {len(image_data)} bytes")
-
-        return True
-
-    except base64.binascii.Error as e:
-        logger.error(f"Base64 解码失败: {e}")
-        return False
-    except Exception as e:
-        logger.error(f"保存图像文件失败: {e}")
-        return False
-
-
-async def get_next_api_key(api_keys):
-    """
-    获取下一个可用的API密钥
-    
-    Args:
-        api_keys (list): API密钥列表
-        
-    Returns:
-        str: 当前可用的API密钥
+def _build_result(image, key_index, timings, request_start, endpoint=None):
     """
-    return await _state.get_next_api_key(api_keys)
-
+    根据流式解码得到的图像构建本次请求独立的结果对象
 
-async def rotate_to_next_api_key(api_keys):
-    """
-    轮换到下一个API密钥
-    
     Args:
-        api_keys (list): API密钥列表
-    """
-    await _state.rotate_to_next_api_key(api_keys)
-
-
-async def get_saved_image_info():
-    """
-    获取最后保存的图像信息
+        image (StreamedImage): 已写入磁盘（或已流式发送到 NAP）的图像
+        key_index (int): 本次使用的API密钥序号（从1开始）
+        timings (dict): 已记录的阶段耗时（秒）
+        request_start (float): 请求开始的 time.monotonic() 时间
+        endpoint (str): 本次使用的端点主机名
 
     Returns:
-        tuple: (image_url, image_path)
+        ImageGenerationResult: 生成结果
     """
-    return await _state.get_saved_image_info()
-
-
-async def generate_image_openrouter(prompt, api_keys, model="google/gemini-2.5-flash-image-preview:free", max_tokens=1000, input_images=None, api_base=None):
+    timings["total"] = time.monotonic() - request_start
+    logger.info(f"图像已保存到: {image.location}")
+    return ImageGenerationResult(
+        image_path=image.location,
+        image_url=f"file://{image.location}",
+        image_format=image.image_format,
+        size=image.size,
+        api_key_index=key_index,
+        timings=timings,
+        endpoint=endpoint,
+        remote=not image.local,
+    )
+
+
+async def generate_image_openrouter(prompt, api_keys, model=DEFAULT_OPENROUTER_MODEL, max_tokens=1000, input_images=None, api_base=None, session=None, hedge=None, endpoints=None, retry_policy=None, trace=None, sink_factory=None, max_images=1):
     """
     Generate image using OpenRouter API with Gemini model, supports multiple API keys with automatic rotation
 
     Args:
         prompt (str): The prompt for image generation
-        api_keys (list): List of OpenRouter API keys for rotation
+        api_keys (list | ApiKeyPool): OpenRouter API keys, or a shared ApiKeyPool that tracks key health across requests
         model (str): Model to use (default: google/gemini-2.5-flash-image-preview:free)
         max_tokens (int): Maximum tokens for the response
         input_images (list): List of base64 encoded input images (optional)
         api_base (str): Custom API base URL (optional, defaults to OpenRouter)
+        session (aiohttp.ClientSession): Shared HTTP session (optional, a temporary one is created if omitted)
+        hedge (HedgePolicy): Hedging policy (optional); a slow request is raced against a second key
+        endpoints (EndpointRouter): Shared router over several OpenAI-compatible endpoints (optional, overrides api_base)
+        retry_policy (RetryPolicy): Shared retry policy with backoff, deadline and retry budget (optional, defaults apply)
+        trace (TraceRecord): Per-request trace record (optional); receives the payload size and every upstream attempt, and its id is sent as X-Request-Id
+        sink_factory (callable): Called with the image format to create the sink decoded bytes are written to (optional, defaults to a file in the images directory)
+        max_images (int): Maximum number of images saved from one response; images after the first are returned in result.extra_images
 
     Returns:
-        tuple: (image_url, image_path) or (None, None) if failed
+        ImageGenerationResult: Per-request result (path, format, key index, timings) or None if failed
+
+    Raises:
+        ValueError: The request was blocked by the content filter
     """
-    # 兼容性处理：如果传入单个API密钥字符串，转换为列表
-    if isinstance(api_keys, str):
-        api_keys = [api_keys]
+    async with _session_scope(session) as http_session:
+        return await _generate_image_openrouter(
+            http_session, prompt, api_keys, model, max_tokens, input_images, api_base, hedge, endpoints, retry_policy, trace,
+            sink_factory, max_images,
+        )
+
+
+@dataclass
+class _AttemptOutcome:
+    """单个密钥与端点上一次 OpenRouter 请求的结果"""
+    lease: KeyLease
+    endpoint: EndpointState
+    kind: str                                   # image / no_image / content_filter / rate_limited / key_rejected / api_error / server_error / network / timeout / sink_error / error
+    result: ImageGenerationResult = None
+    elapsed: float = 0.0                        # 从发出请求到完成的耗时（秒）
+    status: int = None                          # HTTP 状态码，未收到响应时为None
+    retry_after: float = None                   # 响应头中建议的重试等待时间（秒）
+    other_failures: list = field(default_factory=list)   # 对冲时同样失败的另一个请求（_AttemptOutcome）
+
+
+# 由密钥本身引起的失败，换用其他密钥重试
+_KEY_FAILURES = ("rate_limited", "key_rejected")
+# 由端点引起的失败，计入端点的熔断器并换用其他端点
+_ENDPOINT_FAILURES = ("server_error", "network", "timeout", "error")
+# 请求结果 -> 重试策略的错误分类
+_RETRY_CLASSES = {
+    "no_image": EMPTY_IMAGE,
+    "content_filter": FATAL,
+    "rate_limited": RATE_LIMITED,
+    "key_rejected": RATE_LIMITED,
+    "api_error": FATAL,
+    "server_error": TRANSIENT,
+    "network": NETWORK,
+    "timeout": NETWORK,
+    "sink_error": NETWORK,
+    "error": NETWORK,
+}
+# 表示内容被安全策略拦截的 finish_reason（OpenRouter 统一值与 Gemini 原始值）
+_CONTENT_FILTER_REASONS = ("CONTENT_FILTER", "SAFETY", "PROHIBITED_CONTENT", "IMAGE_SAFETY", "BLOCKLIST", "SPII")
+
+
+async def _generate_image_openrouter(session, prompt, api_keys, model, max_tokens, input_images, api_base, hedge=None, endpoints=None, retry_policy=None, trace=None, sink_factory=None, max_images=1):
+    """在给定的 HTTP 会话上执行 OpenRouter 图像生成，逻辑见 generate_image_openrouter"""
+    # 兼容性处理：传入密钥列表或单个密钥字符串时，构建一个仅用于本次调用的密钥池
+    key_pool = api_keys if isinstance(api_keys, ApiKeyPool) else ApiKeyPool(api_keys)
     
-    if not api_keys:
+    if not len(key_pool):
         logger.error("未提供API密钥")
-        return None, None
+        return None
     
-    # 支持自定义API base
-    if api_base:
-        url = f"{api_base.rstrip('/')}/v1/chat/completions"
-    else:
-        url = "https://openrouter.ai/api/v1/chat/completions"
+    # 支持多个端点；未提供路由器时使用自定义API base或OpenRouter
+    router = endpoints if isinstance(endpoints, EndpointRouter) else EndpointRouter([api_base] if api_base else [])
+
+    # 构建消息内容，支持输入图片
+    message_content = []
     
-    # 尝试每个API密钥，直到成功或全部失败
-    max_attempts = len(api_keys)
+    # 添加文本内容
+    message_content.append({
+        "type": "text",
+        "text": f"Generate an image: {prompt}"
+    })
     
-    for attempt in range(max_attempts):
-        try:
-            current_api_key = await get_next_api_key(api_keys)
-            current_index = (_state.api_key_index % len(api_keys)) + 1
-            logger.info(f"尝试使用API密钥 #{current_index}")
+    # 如果有输入图片，添加到消息中
+    if input_images:
+        for base64_image in input_images:
+            # 确保base64数据包含正确的data URI格式
+            if not base64_image.startswith('data:image/'):
+                # 根据文件头识别真实格式，无法识别时按PNG处理
+                mime = sniff_base64_mime(base64_image) or "image/png"
+                base64_image = f"data:{mime};base64,{base64_image}"
             
-            # 构建消息内容，支持输入图片
-            message_content = []
-            
-            # 添加文本内容
             message_content.append({
-                "type": "text",
-                "text": f"Generate an image: {prompt}"
+                "type": "image_url",
+                "image_url": {
+                    "url": base64_image
+                }
             })
-            
-            # 如果有输入图片，添加到消息中
-            if input_images:
-                for base64_image in input_images:
-                    # 确保base64数据包含正确的data URI格式
-                    if not base64_image.startswith('data:image/'):
-                        # 假设是PNG格式，添加data URI前缀
-                        base64_image = f"data:image/png;base64,{base64_image}"
-                    
-                    message_content.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": base64_image
-                        }
-                    })
-
-            # 为 Gemini 图像生成构建payload
-            payload = {
-                "model": model,
-                "messages": [
-                    {
-                        "role": "user",
-                        "content": message_content if len(message_content) > 1 else f"Generate an image: {prompt}"
-                    }
-                ],
-                "max_tokens": max_tokens,
-                "temperature": 0.7
-            }
 
-            headers = {
-                "Authorization": f"Bearer {current_api_key}",
-                "Content-Type": "application/json",
-                "HTTP-Referer": "https://github.com/astrbot",
-                "X-Title": "AstrBot LLM Draw Plus"
+    # 为 Gemini 图像生成构建payload，所有密钥共用同一份
+    payload = {
+        "model": model,
+        "messages": [
+            {
+                "role": "user",
+                "content": message_content if len(message_content) > 1 else f"Generate an image: {prompt}"
             }
+        ],
+        "max_tokens": max_tokens,
+        "temperature": 0.7
+    }
 
-            # 调试输出：打印请求结构
-            logger.debug(f"模型: {model}")
-            logger.debug(f"输入图片数量: {len(input_images) if input_images else 0}")
-            if input_images:
-                logger.debug(f"第一张图片base64长度: {len(input_images[0])}")
-            logger.debug(f"消息内容结构: {type(payload['messages'][0]['content'])}")
-            if isinstance(payload['messages'][0]['content'], list):
-                content_types = [item.get('type', 'unknown') for item in payload['messages'][0]['content']]
-                logger.debug(f"消息内容类型: {content_types}")
-
-            timeout = aiohttp.ClientTimeout(total=60)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                async with session.post(url, json=payload, headers=headers) as response:
-                    data = await response.json()
-                    
-                    logger.debug(f"API响应状态: {response.status}")
-                    logger.debug(f"响应数据键: {list(data.keys()) if isinstance(data, dict) else 'Not dict'}")
-
-                    if response.status == 200 and "choices" in data:
-                        choice = data["choices"][0]
-                        message = choice["message"]
-                        content = message["content"]
-
-                        # 检查 Gemini 标准的 message.images 字段
-                        if "images" in message and message["images"]:
-                            logger.info(f"Gemini 返回了 {len(message['images'])} 个图像")
-
-                            for i, image_item in enumerate(message["images"]):
-                                if "image_url" in image_item and "url" in image_item["image_url"]:
-                                    image_url = image_item["image_url"]["url"]
-
-                                    # 检查是否是 base64 格式
-                                    if image_url.startswith("data:image/"):
-                                        try:
-                                            # 解析 data URI: data:image/png;base64,iVBORw0KGg...
-                                            header, base64_data = image_url.split(",", 1)
-                                            image_format = header.split("/")[1].split(";")[0]
-
-                                            if await save_base64_image(base64_data, image_format):
-                                                return await get_saved_image_info()
-
-                                        except Exception as e:
-                                            logger.warning(f"解析图像 {i+1} 失败: {e}")
-                                            continue
-
-                        # 如果没有找到标准images字段，尝试在content中查找
-                        elif isinstance(content, str):
-                            # 查找内联的 base64 图像数据
-                            base64_pattern = r"data:image/([^;]+);base64,([A-Za-z0-9+/=]+)"
-                            matches = re.findall(base64_pattern, content)
-
-                            if matches:
-                                image_format, base64_string = matches[0]
-                                if await save_base64_image(base64_string, image_format):
-                                    return await get_saved_image_info()
-
-                        logger.info("API调用成功，但未找到图像数据")
-                        return None, None
-
-                    elif response.status == 429 or (response.status == 402 and "insufficient" in str(data).lower()):
-                        # 额度耗尽或速率限制，尝试下一个密钥
-                        error_msg = data.get("error", {}).get("message", f"HTTP {response.status}")
-                        logger.warning(f"API密钥 #{current_index} 额度耗尽或速率限制: {error_msg}")
-                        
-                        if attempt < max_attempts - 1:  # 如果还有其他密钥可以尝试
-                            await rotate_to_next_api_key(api_keys)
-                            continue
-                        else:
-                            logger.error("所有API密钥都已达到限制")
-                            return None, None
-                    else:
-                        error_msg = data.get("error", {}).get("message", f"HTTP {response.status}")
-                        logger.error(f"OpenRouter API 错误: {error_msg}")
-                        if "error" in data:
-                            logger.debug(f"完整错误信息: {data['error']}")
-                        return None, None
-
-        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-            logger.warning(f"网络请求失败 (密钥 #{current_index}): {str(e)}")
-            if attempt < max_attempts - 1:
-                await rotate_to_next_api_key(api_keys)
+    # 调试输出：打印请求结构
+    logger.debug(f"模型: {model}")
+    logger.debug(f"输入图片数量: {len(input_images) if input_images else 0}")
+    if input_images:
+        logger.debug(f"第一张图片base64长度: {len(input_images[0])}")
+    logger.debug(f"消息内容结构: {type(payload['messages'][0]['content'])}")
+    if isinstance(payload['messages'][0]['content'], list):
+        content_types = [item.get('type', 'unknown') for item in payload['messages'][0]['content']]
+        logger.debug(f"消息内容类型: {content_types}")
+    
+    # 由密钥池选择负载最低的健康密钥、由路由器选择预期最快的端点。
+    # 限流或密钥无效时立即换用其他密钥，端点出错时换用其他端点（此时允许复用未被限流的密钥）；
+    # 没有可换的密钥或端点、或模型未返回图像时，按重试策略退避后重试
+    retry = (retry_policy or RetryPolicy()).begin()
+    request_start = time.monotonic()
+    # 请求体只序列化一次，所有密钥、端点与重试共用
+    body = json.dumps(payload).encode()
+    request_timings = {"serialize": time.monotonic() - request_start}
+    logger.debug(f"请求体大小: {len(body)} bytes")
+    if trace is not None:
+        trace.payload_bytes = len(body)
+        trace.mark("serialize", request_start, request_timings["serialize"])
+    tried_keys = set()
+    limited_keys = set()
+    failed_endpoints = set()
+    outcome = None
+
+    def start(lease, endpoint):
+        return _attempt_openrouter(
+            session, endpoint, body, key_pool, router, lease, request_start, request_timings, retry.timeout(60), trace,
+            sink_factory, max_images,
+        )
+    
+    while True:
+        # 所有端点都处于熔断状态时直接失败，不再逐个密钥等待超时
+        endpoint = router.acquire(exclude=failed_endpoints)
+        if endpoint is None:
+            logger.error(f"所有API端点均处于熔断状态（最早 {router.next_available_in():.0f} 秒后重试）")
+            return None
+        lease = key_pool.acquire(exclude=tried_keys)
+        if lease is None and outcome is not None and outcome.kind not in _KEY_FAILURES and router.untried(failed_endpoints):
+            lease = key_pool.acquire(exclude=limited_keys)
+        if lease is None:
+            router.release(endpoint, cancelled=True)
+            # 等待最早的密钥冷却结束（冷却时间来自 Retry-After 等响应头）
+            wait = key_pool.next_available_in()
+            kind = _RETRY_CLASSES[outcome.kind] if outcome is not None else RATE_LIMITED
+            if await retry.wait(kind, retry_after=wait):
+                tried_keys.clear()
+                limited_keys.clear()
+                failed_endpoints.clear()
                 continue
-            else:
-                return None, None
-        except Exception as e:
-            logger.error(f"调用 OpenRouter API 时发生异常 (密钥 #{current_index}): {str(e)}")
-            if attempt < max_attempts - 1:
-                await rotate_to_next_api_key(api_keys)
+            if outcome is None:
+                logger.error(f"没有可用的API密钥，所有密钥均在冷却或熔断中（最早 {wait:.0f} 秒后恢复）")
+            elif outcome.kind in _KEY_FAILURES:
+                logger.error("所有API密钥都已达到限制")
+            return None
+        tried_keys.add(lease.index)
+
+        if hedge is None:
+            outcome = await start(lease, endpoint)
+        else:
+            outcome = await _hedged_attempt(start, key_pool, router, lease, endpoint, tried_keys, failed_endpoints, hedge)
+
+        if outcome.result is not None:
+            return outcome.result
+        if outcome.kind == "content_filter":
+            raise ValueError("内容过滤器阻止了图像生成")
+        if outcome.kind == "api_error":
+            return None
+        # 对冲的另一个请求同样失败时，它的密钥与端点也不再在本轮使用
+        for other in outcome.other_failures:
+            if other.kind in _KEY_FAILURES:
+                limited_keys.add(other.lease.index)
+            elif other.kind in _ENDPOINT_FAILURES:
+                failed_endpoints.add(other.endpoint.index)
+        if outcome.kind in _KEY_FAILURES:
+            # 额度耗尽、速率限制或密钥无效，立即尝试下一个密钥
+            limited_keys.add(outcome.lease.index)
+            continue
+        if outcome.kind in _ENDPOINT_FAILURES:
+            # 网络错误、超时或服务端错误，换用其他端点
+            failed_endpoints.add(outcome.endpoint.index)
+            if router.untried(failed_endpoints):
+                logger.warning(f"端点 {outcome.endpoint.host} 请求失败，切换到其他端点")
                 continue
-            else:
-                return None, None
-    
-    return None, None
+        if not await retry.wait(_RETRY_CLASSES[outcome.kind], retry_after=outcome.retry_after):
+            return None
+        tried_keys = set(limited_keys)
+        failed_endpoints.clear()
+
+
+async def _hedged_attempt(start, key_pool, router, lease, endpoint, tried_keys, failed_endpoints, hedge):
+    """
+    执行一次请求；超过对冲阈值仍未完成时，使用另一个健康的密钥（尽量换用另一个端点）并行发起第二个请求
+
+    先得到图像的请求生效，另一个请求被取消（其未完成的图像文件在取消时删除）。
+    胜出请求与被取消请求已经过的时间都计入对冲阈值的样本。
+
+    Returns:
+        _AttemptOutcome: 成功的结果；都失败时返回最先完成的失败结果，另一个失败结果放在 other_failures 中
+    """
+    attempt_start = time.monotonic()
+    primary = asyncio.ensure_future(start(lease, endpoint))
+    started = {primary: attempt_start}
+    pending = {primary}
+    try:
+        delay = hedge.delay()
+        done, pending = await asyncio.wait(pending, timeout=delay)
+        if not done and hedge.available():
+            hedge_lease = key_pool.acquire(exclude=tried_keys)
+            if hedge_lease is None and len(router) > 1:
+                # 密钥都已使用过时，在另一个端点上复用主请求以外的密钥
+                hedge_lease = key_pool.acquire(exclude={lease.index})
+            hedge_endpoint = None
+            if hedge_lease is not None:
+                hedge_endpoint = router.acquire(exclude=failed_endpoints | {endpoint.index})
+            if hedge_endpoint is not None:
+                # 确实发起对冲请求时才消耗额度
+                hedge.try_acquire()
+                tried_keys.add(hedge_lease.index)
+                logger.info(f"密钥 #{lease.index} 超过 {delay:.1f} 秒未完成，使用密钥 #{hedge_lease.index}"
+                            f"（端点 {hedge_endpoint.host}）发起对冲请求")
+                hedge_task = asyncio.ensure_future(start(hedge_lease, hedge_endpoint))
+                started[hedge_task] = time.monotonic()
+                pending.add(hedge_task)
+            elif hedge_lease is not None:
+                key_pool.release(hedge_lease, cancelled=True)
+
+        failures = []
+        while True:
+            # 同时完成时以先发起的请求为准
+            for task in sorted(done, key=started.get):
+                outcome = task.result()
+                if outcome.result is None:
+                    failures.append(outcome)
+                    continue
+                hedge.observe(outcome.elapsed)
+                now = time.monotonic()
+                for loser in pending:
+                    hedge.observe(now - started[loser])
+                if outcome.lease is not lease:
+                    hedge.hedge_wins += 1
+                    logger.info(f"对冲请求（密钥 #{outcome.lease.index}）先完成")
+                return outcome
+            if not pending:
+                outcome = failures[0]
+                outcome.other_failures = failures[1:]
+                return outcome
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def _attempt_openrouter(session, endpoint, body, key_pool, router, lease, request_start, request_timings=None, timeout=60, trace=None, sink_factory=None, max_images=1):
+    """
+    使用指定密钥向指定端点发起一次请求，图像数据边读边解码写入磁盘
 
+    请求结束（包括被取消）时归还密钥与端点，删除未被使用的图像文件，并在追踪记录中登记本次请求。
 
-async def generate_image(prompt, api_key, model="stabilityai/stable-diffusion-3-5-large", seed=None, image_size="1024x1024"):
+    Returns:
+        _AttemptOutcome: 请求结果，网络错误等异常也会转换为结果返回
+    """
+    current_index = lease.index
+    # 本次尝试的响应信息，在 finally 中归还给密钥池
+    response_status = None
+    response_headers = None
+    response_usage = None
+    cancelled = False
+    outcome = None
+    kept_images = []
+    extractor = StreamingImageExtractor(sink_factory=sink_factory, max_images=max(1, max_images))
+    timings = dict(request_timings or {})
+    attempt_start = time.monotonic()
+    try:
+        logger.info(f"尝试使用API密钥 #{current_index}")
+        if len(router) > 1:
+            logger.debug(f"使用端点 #{endpoint.index}: {endpoint.host}")
+
+        headers = {
+            "Authorization": f"Bearer {lease.key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": "https://github.com/astrbot",
+            "X-Title": "AstrBot LLM Draw Plus"
+        }
+        if trace is not None:
+            headers["X-Request-Id"] = trace.trace_id
+
+        async with session.post(endpoint.url, data=body, headers=headers,
+                                timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            timings["upstream"] = time.monotonic() - attempt_start
+            response_status = response.status
+            response_headers = response.headers
+
+            # 流式读取响应，图像数据边读边解码写入磁盘
+            download_start = time.monotonic()
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                await extractor.feed(chunk)
+            data = await extractor.finish()
+            timings["download"] = time.monotonic() - download_start
+            timings["disk"] = extractor.sink_seconds
+            if isinstance(data, dict):
+                response_usage = data.get("usage")
+            
+            logger.debug(f"API响应状态: {response.status}，响应大小: {extractor.bytes_received} bytes")
+            logger.debug(f"响应数据键: {list(data.keys()) if isinstance(data, dict) else 'Not dict'}")
+
+            if response.status == 200 and "choices" in data:
+                choice = data["choices"][0]
+                message = choice["message"]
+                content = message["content"]
+
+                images = []
+                # 检查 Gemini 标准的 message.images 字段，保存其中的每一张图像（最多 max_images 张）
+                if "images" in message and message["images"]:
+                    logger.info(f"Gemini 返回了 {len(message['images'])} 个图像")
+
+                    for i, image_item in enumerate(message["images"]):
+                        if "image_url" in image_item and "url" in image_item["image_url"]:
+                            image = extractor.find(image_item["image_url"]["url"])
+                            if image:
+                                images.append(image)
+                            elif len(images) < max_images:
+                                logger.warning(f"图像 {i+1} 不是有效的 base64 图像数据")
+
+                # 如果没有找到标准images字段，尝试在content中查找内联的 base64 图像数据
+                elif isinstance(content, str):
+                    image = extractor.find(content)
+                    if image:
+                        images.append(image)
+
+                if images:
+                    kept_images.extend(images)
+                    result = _build_result(images[0], current_index, timings, request_start, endpoint.host)
+                    result.extra_images = [
+                        _build_result(image, current_index, {}, request_start, endpoint.host) for image in images[1:]
+                    ]
+                    outcome = _AttemptOutcome(lease, endpoint, "image", result, time.monotonic() - attempt_start)
+                    return outcome
+
+                finish_reasons = {
+                    str(choice.get("finish_reason") or "").upper(),
+                    str(choice.get("native_finish_reason") or "").upper(),
+                }
+                if finish_reasons.intersection(_CONTENT_FILTER_REASONS):
+                    logger.warning(f"请求被内容过滤器拦截: {choice.get('native_finish_reason') or choice.get('finish_reason')}")
+                    outcome = _AttemptOutcome(lease, endpoint, "content_filter")
+                    return outcome
+
+                logger.info("API调用成功，但未找到图像数据")
+                outcome = _AttemptOutcome(lease, endpoint, "no_image")
+                return outcome
+
+            elif response.status == 429 or (response.status == 402 and "insufficient" in str(data).lower()):
+                # 额度耗尽或速率限制，由调用方尝试下一个密钥
+                error_msg = data.get("error", {}).get("message", f"HTTP {response.status}")
+                logger.warning(f"API密钥 #{current_index} 额度耗尽或速率限制: {error_msg}")
+                outcome = _AttemptOutcome(lease, endpoint, "rate_limited")
+                return outcome
+            elif response.status in (401, 403):
+                error_msg = data.get("error", {}).get("message", f"HTTP {response.status}")
+                logger.warning(f"API密钥 #{current_index} 无效或无权限: {error_msg}")
+                outcome = _AttemptOutcome(lease, endpoint, "key_rejected")
+                return outcome
+            else:
+                error_msg = data.get("error", {}).get("message", f"HTTP {response.status}")
+                logger.error(f"OpenRouter API 错误: {error_msg}")
+                if "error" in data:
+                    logger.debug(f"完整错误信息: {data['error']}")
+                outcome = _AttemptOutcome(lease, endpoint, "server_error" if response.status >= 500 else "api_error")
+                return outcome
+
+    except asyncio.CancelledError:
+        cancelled = True
+        raise
+    except SinkError as e:
+        # 图像写入目标（如 NAP 连接）失败，与密钥和端点无关
+        logger.warning(f"图像写入失败 (密钥 #{current_index}): {str(e)}")
+        outcome = _AttemptOutcome(lease, endpoint, "sink_error")
+        return outcome
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"网络请求失败 (密钥 #{current_index}): {str(e)}")
+        outcome = _AttemptOutcome(lease, endpoint, "timeout" if isinstance(e, asyncio.TimeoutError) else "network")
+        return outcome
+    except Exception as e:
+        logger.error(f"调用 OpenRouter API 时发生异常 (密钥 #{current_index}): {str(e)}")
+        outcome = _AttemptOutcome(lease, endpoint, "error")
+        return outcome
+    finally:
+        key_pool.release(lease, response_status, response_headers, response_usage, cancelled=cancelled)
+        router.release(
+            endpoint,
+            latency=outcome.elapsed if outcome is not None and outcome.kind == "image" else None,
+            failed=outcome is None or outcome.kind in _ENDPOINT_FAILURES,
+            cancelled=cancelled,
+            timeout=outcome is not None and outcome.kind == "timeout",
+        )
+        retry_after = parse_retry_after(response_headers) if response_headers else None
+        if outcome is not None:
+            outcome.status = response_status
+            outcome.retry_after = retry_after
+        if trace is not None:
+            kind = "cancelled" if cancelled else outcome.kind if outcome is not None else "error"
+            trace.add_attempt(current_index, endpoint.index, attempt_start, kind, response_status, timings,
+                              extractor.bytes_received, retry_after)
+        # 删除失败、取消或未被使用的图像文件
+        await extractor.abort(keep=kept_images)
+
+
+async def generate_image(prompt, api_key, model="stabilityai/stable-diffusion-3-5-large", seed=None, image_size="1024x1024", session=None, retry_policy=None):
     """
     生成图像使用SiliconFlow API
     
@@ -369,9 +519,11 @@ async def generate_image(prompt, api_key, model="stabilityai/stable-diffusion-3-
         model (str): 模型名称
         seed (int): 随机种子
         image_size (str): 图像尺寸
+        session (aiohttp.ClientSession): 共享的HTTP会话（可选，未提供时创建临时会话）
+        retry_policy (RetryPolicy): 重试策略（可选，未提供时使用默认策略）
         
     Returns:
-        tuple: (image_url, image_path) or (None, None) if failed
+        ImageGenerationResult: 生成结果（image_url 为远程图像地址），失败时返回None
     """
     url = "https://api.siliconflow.cn/v1/images/generations"
 
@@ -389,58 +541,70 @@ async def generate_image(prompt, api_key, model="stabilityai/stable-diffusion-3-
         "Content-Type": "application/json"
     }
 
-    max_retries = 10  # 最大重试次数
-    retry_count = 0
+    # 按错误类型退避重试，受截止时间与全局重试预算约束
+    retry = (retry_policy or RetryPolicy()).begin()
+    request_start = time.monotonic()
     
-    timeout = aiohttp.ClientTimeout(total=60)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        while retry_count < max_retries:
+    async with _session_scope(session) as session:
+        while True:
+            retry_after = None
             try:
-                async with session.post(url, json=payload, headers=headers) as response:
-                    data = await response.json()
-
-                    if data.get("code") == 50603:
-                        logger.warning("系统繁忙，1秒后重试")
-                        await asyncio.sleep(1)
-                        retry_count += 1
-                        continue
-
-                    if "images" in data:
+                timeout = aiohttp.ClientTimeout(total=retry.timeout(60))
+                async with session.post(url, json=payload, headers=headers, timeout=timeout) as response:
+                    data = await response.json(content_type=None)
+
+                    if not isinstance(data, dict):
+                        # null、列表或字符串等无法识别的响应体：状态码正常时按上游临时故障重试
+                        logger.warning(f"SiliconFlow 返回了无法识别的响应: HTTP {response.status} {type(data).__name__}")
+                        kind = TRANSIENT if response.status == 200 else classify_status(response.status)
+                        retry_after = parse_retry_after(response.headers)
+                    elif data.get("code") == 50603:
+                        logger.warning("系统繁忙，稍后重试")
+                        kind = TRANSIENT
+                    elif "images" in data:
                         for image in data["images"]:
                             image_url = image["url"]
-                            async with session.get(image_url) as img_response:
+                            async with session.get(image_url, timeout=timeout) as img_response:
                                 if img_response.status == 200:
-                                    # 生成唯一文件名
-                                    script_dir = Path(__file__).parent.parent
-                                    images_dir = script_dir / "images"
-                                    images_dir.mkdir(exist_ok=True)
-                                    
-                                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                                    unique_id = str(uuid.uuid4())[:8]
-                                    image_path = images_dir / f"siliconflow_image_{timestamp}_{unique_id}.jpeg"
-                                    
-                                    async with aiofiles.open(image_path, "wb") as f:
-                                        await f.write(await img_response.read())
-                                    
+                                    # 与 chat/completions 的图像相同，分块写入 images 目录
+                                    sink = FileImageSink("jpeg", prefix="siliconflow_image")
+                                    await sink.open()
+                                    try:
+                                        async for chunk in img_response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                                            await sink.write(chunk)
+                                        image_path = await sink.close()
+                                    except BaseException:
+                                        await sink.abort()
+                                        raise
+
                                     logger.info(f"图像已下载: {image_url} -> {image_path}")
-                                    return image_url, str(image_path)
+                                    return ImageGenerationResult(
+                                        image_path=image_path,
+                                        image_url=image_url,
+                                        image_format="jpeg",
+                                        size=sink.size,
+                                        timings={"total": time.monotonic() - request_start},
+                                    )
                                 else:
                                     logger.error(f"下载图像失败: {image_url}")
-                                    return None, None
+                                    return None
+                        logger.warning("响应中的图像列表为空")
+                        kind = EMPTY_IMAGE
+                    elif response.status != 200:
+                        kind = classify_status(response.status)
+                        retry_after = parse_retry_after(response.headers)
+                        logger.warning(f"SiliconFlow API 错误: HTTP {response.status} {data.get('message', '')}")
                     else:
                         logger.warning("响应中未找到图像")
-                        return None, None
+                        kind = EMPTY_IMAGE
                         
-            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                logger.error(f"网络请求失败 (重试 {retry_count + 1}/{max_retries}): {e}")
-                retry_count += 1
-                if retry_count < max_retries:
-                    await asyncio.sleep(2 ** retry_count)  # 指数退避
-                else:
-                    return None, None
-                    
-    logger.error(f"达到最大重试次数 ({max_retries})，生成失败")
-    return None, None
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.error(f"网络请求失败 (已重试 {retry.retries} 次): {e}")
+                kind = NETWORK
+
+            if not await retry.wait(kind, retry_after):
+                logger.error(f"图像生成失败（已重试 {retry.retries} 次）")
+                return None
 
 
 if __name__ == "__main__":
@@ -473,13 +637,14 @@ if __name__ == "__main__":
         logger.info("\n=== 测试1: 先生成一张图片 ===")
         initial_prompt = "一只可爱的红色小熊猫，数字艺术风格"
         
-        image_url, image_path = await generate_image_openrouter(
+        result = await generate_image_openrouter(
             initial_prompt,
             [openrouter_api_key],
             model="google/gemini-2.5-flash-image-preview:free"
         )
         
-        if image_url and image_path:
+        if result:
+            image_path = result.image_path
             logger.info("初始图像生成成功!")
             logger.info(f"文件路径: {image_path}")
             
@@ -497,16 +662,16 @@ if __name__ == "__main__":
                 input_images = [generated_image_base64]
                 
                 logger.info("正在使用生成的图片进行修改...")
-                modified_url, modified_path = await generate_image_openrouter(
+                modified = await generate_image_openrouter(
                     modify_prompt,
                     [openrouter_api_key],
                     model="google/gemini-2.5-flash-image-preview:free",
                     input_images=input_images
                 )
                 
-                if modified_url and modified_path:
+                if modified:
                     logger.info("图片修改成功!")
-                    logger.info(f"修改后文件路径: {modified_path}")
+                    logger.info(f"修改后文件路径: {modified.image_path}")
                 else:
                     logger.error("图片修改失败")
                     